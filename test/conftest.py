@@ -0,0 +1,24 @@
+"""
+Shared pytest configuration of the tests.
+
+Tests marked as benchmark only compare timings, they are skipped unless
+FREEDATA_BENCHMARKS is set:
+
+    FREEDATA_BENCHMARKS=1 python3 -m pytest -s -m benchmark
+"""
+import os
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: timing comparison, run with FREEDATA_BENCHMARKS=1")
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.getenv("FREEDATA_BENCHMARKS"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, set FREEDATA_BENCHMARKS=1 to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
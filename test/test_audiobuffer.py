@@ -7,6 +7,7 @@
 
 import sys
 import threading
+import time
 from time import sleep
 
 import codec2
@@ -79,6 +80,196 @@ def test_audiobuffer():
     assert errors == 0
 
 
+def test_shared_audiobuffer():
+    """
+    Test independent readers of a shared audio buffer
+    """
+    store = codec2.shared_audio_buffer(BUFFER_SZ)
+    fast = store.reader()
+    slow = store.reader()
+    late = store.reader(history=64)
+    fast.active = slow.active = True
+
+    block = np.arange(WRITE_SZ * 10, dtype=np.int16)
+    n_out = errors = 0
+    for _ in range(200):
+        store.push(block)
+        # fast reader consumes everything, slow reader only half of it
+        while fast.nbuffer >= READ_SZ:
+            for i in range(READ_SZ):
+                if fast.buffer[i] != n_out % len(block):
+                    errors += 1
+                n_out += 1
+            fast.pop(READ_SZ)
+        if slow.nbuffer >= len(block) // 2:
+            slow.pop(len(block) // 2)
+
+    assert errors == 0
+    # inactive readers don't receive anything
+    assert late.nbuffer == 0
+    # the slow reader has been overrun and continues with the newest samples
+    assert fast.overflows == 0
+    assert slow.overflows > 0
+    nbuffer = slow.nbuffer
+    assert nbuffer <= BUFFER_SZ
+    assert slow.buffer[nbuffer - 1] == block[-1]
+
+    # after activation, a reader starts with the history window
+    late.active = True
+    assert late.nbuffer == 64
+    assert late.buffer[63] == block[-1]
+    assert late.buffer[0] == block[-64]
+
+
+def test_shared_audiobuffer_late_activation():
+    """
+    Samples pushed after a reader got enabled, but before its decoder activated it, are kept
+    """
+    store = codec2.shared_audio_buffer(BUFFER_SZ)
+    store.push(np.full(WRITE_SZ * 10, -1, dtype=np.int16))
+    reader = store.reader(history=16)
+    store.push(np.full(WRITE_SZ * 10, -1, dtype=np.int16))
+    reader.active = True
+    assert reader.backlog() == 16
+
+    blocks = np.arange(3 * WRITE_SZ * 10, dtype=np.int16).reshape(3, -1)
+    for block in blocks:
+        store.push(block)
+    # the producer sees the samples which are waiting, not the stale cursor
+    assert reader.backlog() == 16 + blocks.size
+    assert reader.ready(16 + blocks.size)
+    assert not reader.ready(16 + blocks.size + 1)
+
+    assert reader.nbuffer == 16 + blocks.size
+    assert np.all(reader.buffer[:16] == -1)
+    assert np.array_equal(reader.buffer[16 : reader.nbuffer], blocks.ravel())
+
+    # disabling resets the start position for the next activation
+    reader.active = False
+    assert reader.nbuffer == 0
+    assert reader.backlog() == 0
+
+
+def test_shared_audiobuffer_activate_at():
+    """
+    A reader continues at a given position, like the decoder of a demodulator process
+    """
+    store = codec2.shared_audio_buffer(BUFFER_SZ)
+    blocks = np.arange(3 * WRITE_SZ * 10, dtype=np.int16).reshape(3, -1)
+    store.push(blocks[0])
+    position = blocks[0].size - 8
+    reader = store.reader(history=16)
+    reader.activate_at(position)
+    for block in blocks[1:]:
+        store.push(block)
+
+    reader.active = True
+    reader.activate_at(position)
+    assert reader.nbuffer == blocks.size - position
+    assert np.array_equal(reader.buffer[: reader.nbuffer], blocks.ravel()[position:])
+    reader.pop(16)
+    assert reader.position == position + 16
+    # an activated reader keeps its cursor
+    reader.activate_at(position)
+    assert reader.position == position + 16
+
+    assert not reader.overrun
+    for _ in range(BUFFER_SZ // blocks[0].size + 1):
+        store.push(blocks[0])
+    assert reader.overrun
+    reader.nbuffer
+    assert not reader.overrun
+
+
+class shifting_audio_buffer:
+    """
+    Previous codec2.audio_buffer implementation, kept as benchmark reference.
+    pop() shifts the remaining samples down to the start of the buffer.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = np.zeros(size, dtype=np.int16)
+        self.nbuffer = 0
+        self.mutex = threading.Lock()
+
+    def push(self, samples):
+        with self.mutex:
+            assert self.nbuffer + len(samples) <= self.size
+            self.buffer[self.nbuffer : self.nbuffer + len(samples)] = samples
+            self.nbuffer += len(samples)
+
+    def pop(self, size):
+        with self.mutex:
+            self.nbuffer -= size
+            self.buffer[: self.nbuffer] = self.buffer[size : size + self.nbuffer]
+            assert self.nbuffer >= 0
+
+
+def run_demodulator_pattern(buffer, blocks, nin, backlog):
+    """
+    Feed `blocks` into `buffer` the way RF.callback does and consume it in
+    chunks of `nin` samples the way RF.demodulate_audio does, while keeping
+    `backlog` samples in the buffer like a decoder which is lagging behind.
+
+    Returns:
+        checksum of all consumed samples, elapsed time in seconds
+    """
+    checksum = 0
+    start = time.perf_counter()
+    for block in blocks:
+        buffer.push(block)
+        while buffer.nbuffer >= nin + backlog:
+            checksum += int(buffer.buffer[0]) + int(buffer.buffer[nin - 1])
+            buffer.pop(nin)
+    return checksum, time.perf_counter() - start
+
+
+@pytest.mark.parametrize("backlog", [0, 4800, 8000])
+def test_audiobuffer_pattern(backlog):
+    """
+    The ring buffer hands out the same samples as the previous shifting buffer
+    """
+    size = 2 * 4800
+    rng = np.random.default_rng(0)
+    blocks = [rng.integers(-32768, 32767, 800, dtype=np.int16) for _ in range(100)]
+
+    checksum_ring, _ = run_demodulator_pattern(codec2.audio_buffer(size), blocks, 1200, backlog)
+    checksum_shift, _ = run_demodulator_pattern(shifting_audio_buffer(size), blocks, 1200, backlog)
+    assert checksum_ring == checksum_shift
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("backlog", [0, 4800, 8000])
+def test_audiobuffer_benchmark(backlog):
+    """
+    Micro-benchmark of the ring buffer against the previous shifting buffer,
+    using the block and nin sizes of the TNC (800 samples per callback at 8 kHz).
+    """
+    size = 2 * 4800
+    nin = 1200
+    rng = np.random.default_rng(0)
+    blocks = [
+        rng.integers(-32768, 32767, 800, dtype=np.int16) for _ in range(2000)
+    ]
+
+    checksum_ring, time_ring = run_demodulator_pattern(
+        codec2.audio_buffer(size), blocks, nin, backlog
+    )
+    checksum_shift, time_shift = run_demodulator_pattern(
+        shifting_audio_buffer(size), blocks, nin, backlog
+    )
+
+    print(
+        f"backlog: {backlog} "
+        f"ring buffer: {time_ring * 1000:.1f} ms "
+        f"shifting buffer: {time_shift * 1000:.1f} ms "
+        f"speedup: {time_shift / time_ring:.2f}"
+    )
+    # both implementations must hand out exactly the same samples
+    assert checksum_ring == checksum_shift
+
+
 if __name__ == "__main__":
     # Run pytest with the current script as the filename.
     ecode = pytest.main(["-v", sys.argv[0]])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the typed codec2 bindings and the bulk demodulator
+
+# pylint: disable=invalid-name
+
+import ctypes
+import itertools
+import os
+import subprocess
+import sys
+import time
+
+import codec2
+import demodulator
+import numpy as np
+import pytest
+
+DATAC13 = codec2.FREEDV_MODE.datac13.value
+SILENCE = 4000  # samples at 8 kHz between bursts
+
+
+def generate_audio(nframes):
+    """8 kHz audio of `nframes` datac13 bursts, separated by silence"""
+    info = codec2.get_mode_info(DATAC13)
+    freedv = codec2.open_instance(DATAC13)
+    frames = [bytes([250, i]) + bytes(range(info.payload_per_frame - 2)) for i in range(nframes)]
+    audio = codec2.modulate(freedv, DATAC13, frames, repeat_delay=SILENCE, tx_delay=SILENCE)
+    codec2.api.freedv_close(freedv)
+    return frames, audio
+
+
+def open_rx_instance():
+    """codec2 instance configured like Demodulator.open"""
+    freedv = codec2.open_instance(DATAC13)
+    codec2.api.freedv_set_frames_per_burst(freedv, 1)
+    return freedv
+
+
+def demodulate_per_call(freedv, samples, nin, bytes_out):
+    """The former demodulator loop, one freedv_rawdatarx call per Python iteration"""
+    audiobuffer = codec2.audio_buffer(len(samples))
+    audiobuffer.push(samples)
+    frames = []
+    rx_status = []
+    while audiobuffer.nbuffer >= nin:
+        nbytes = codec2.api.freedv_rawdatarx(freedv, bytes_out, audiobuffer.buffer.ctypes)
+        rx_status.append(codec2.api.freedv_get_rx_status(freedv))
+        audiobuffer.pop(nin)
+        nin = codec2.api.freedv_nin(freedv)
+        if nbytes == len(bytes_out):
+            frames.append(bytes(bytes_out))
+    return frames, rx_status, nin
+
+
+def test_library_candidates(monkeypatch, tmp_path):
+    """Configured, environment and cached paths are tried before searching"""
+    monkeypatch.setattr(codec2, "_library_path", "/config/libcodec2.so")
+    monkeypatch.setenv(codec2.LIBRARY_PATH_ENV, "/environment/libcodec2.so")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(sys, "platform", "linux")
+    codec2.remember_library_path("/cache/libcodec2.so")
+
+    assert list(itertools.islice(codec2.library_candidates(), 4)) == [
+        ("config", "/config/libcodec2.so"),
+        ("environment", "/environment/libcodec2.so"),
+        ("cache", "/cache/libcodec2.so"),
+        ("loader", codec2.LIBRARY_NAMES[0]),
+    ]
+
+
+def test_lazy_load(tmp_path):
+    """Importing codec2 doesn't load libcodec2, a broken path falls back to the search"""
+    script = (
+        "import codec2\n"
+        "assert codec2._library is None\n"
+        "assert codec2.api.FDMDV_OS_48 == 6 and codec2._library is None\n"
+        "codec2.api.freedv_nin\n"
+        "assert codec2._library is not None\n"
+        "print('load time', codec2.library_load_time)\n"
+    )
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+    env[codec2.LIBRARY_PATH_ENV] = str(tmp_path / "missing.so")
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=env, capture_output=True, text=True, timeout=60, check=False
+    )
+    assert result.returncode == 0, result.stderr
+    assert "load time" in result.stdout
+
+
+def test_prototypes():
+    for name, (restype, argtypes) in codec2.PROTOTYPES.items():
+        function = getattr(codec2.api, name)
+        assert function.restype == restype, name
+        assert function.argtypes == argtypes, name
+
+
+def test_demodulate():
+    """All frames of a block are decoded with one call, like with the per-call loop"""
+    sent, audio = generate_audio(3)
+    info = codec2.get_mode_info(DATAC13)
+    payloads = [bytes(frame[: info.payload_per_frame]) for frame in sent]
+
+    freedv = open_rx_instance()
+    bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)
+    positions = []
+    result = codec2.demodulate(
+        freedv, audio, info.nin, bytes_out, lambda frame, nsamples: positions.append(nsamples)
+    )
+    codec2.api.freedv_close(freedv)
+
+    assert [frame[: info.payload_per_frame] for frame in result.frames] == payloads
+    assert len(positions) == 3
+    assert positions == sorted(positions)
+    assert all(position <= result.nsamples for position in positions)
+    assert 6 in result.rx_status
+    assert len(audio) - result.nsamples < result.nin
+
+    freedv = open_rx_instance()
+    frames, rx_status, nin = demodulate_per_call(freedv, audio, info.nin, bytes_out)
+    codec2.api.freedv_close(freedv)
+    assert frames == result.frames
+    assert rx_status == result.rx_status
+    assert nin == result.nin
+
+
+def test_demodulate_short_block():
+    """Less than nin samples are left for the next call"""
+    info = codec2.get_mode_info(DATAC13)
+    freedv = codec2.open_instance(DATAC13)
+    bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)
+    result = codec2.demodulate(freedv, np.zeros(info.nin - 1, dtype=np.int16), info.nin, bytes_out)
+    codec2.api.freedv_close(freedv)
+    assert result.frames == result.rx_status == []
+    assert result.nsamples == 0
+    assert result.nin == info.nin
+
+
+def scatter_reference(stats):
+    """The former scatter plot loop over every float pair of rx_symbols"""
+    symbols = stats.rx_symbols.reshape(-1).tolist()
+    scatterdata = []
+    for j in range(1, len(symbols), 2):
+        xsymbols = round(symbols[j - 1] // 1000)
+        ysymbols = round(symbols[j] // 1000)
+        if xsymbols != 0.0 and ysymbols != 0.0:
+            scatterdata.append({"x": str(xsymbols), "y": str(ysymbols)})
+    if 150 > len(scatterdata) > 0:
+        return scatterdata
+    return scatterdata[::10]
+
+
+def test_modem_stats():
+    """Stats of a decoded frame are read into the reused structure"""
+    _, audio = generate_audio(1)
+    info = codec2.get_mode_info(DATAC13)
+    bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)
+    stats = codec2.modem_stats()
+    freedv = open_rx_instance()
+    scatter = []
+
+    def on_frame(frame, nsamples):
+        address = ctypes.addressof(stats.stats)
+        stats.update(freedv)
+        # the numpy views still point into the structure
+        assert stats.rx_symbols.ctypes.data == address + codec2.MODEMSTATS.rx_symbols.offset
+        scatter.append(stats.scatter())
+        assert demodulator.scatter_points(scatter[-1]) == scatter_reference(stats)
+
+    result = codec2.demodulate(freedv, audio, info.nin, bytes_out, on_frame)
+    codec2.api.freedv_close(freedv)
+    assert len(result.frames) == 1
+
+    # datac13 has 3 carriers, the fields behind rx_symbols are at the offsets of modem_stats.h
+    assert stats.stats.Nc == 3
+    assert 0 < stats.stats.nr <= codec2.MODEM_STATS_NR_MAX
+    assert stats.stats.sync == 1
+    assert abs(stats.foff) < 5
+    assert scatter[0].dtype == np.int16 and scatter[0].shape[1] == 2
+    assert len(scatter[0])
+
+
+@pytest.mark.benchmark
+def test_scatter_benchmark():
+    """Micro-benchmark of the vectorized scatter plot against the former loop"""
+    stats = codec2.modem_stats()
+    rng = np.random.default_rng(0)
+    stats.rx_symbols[:] = rng.normal(0, 3000, stats.rx_symbols.shape)
+
+    start = time.perf_counter()
+    reference = scatter_reference(stats)
+    time_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    points = demodulator.scatter_points(stats.scatter())
+    time_vectorized = time.perf_counter() - start
+
+    print(
+        f"scatter points: {len(points)} "
+        f"loop: {time_loop * 1000:.1f} ms "
+        f"vectorized: {time_vectorized * 1000:.1f} ms "
+        f"speedup: {time_loop / time_vectorized:.2f}"
+    )
+    assert points == reference
+
+
+@pytest.mark.benchmark
+def test_demodulate_benchmark():
+    """
+    Micro-benchmark of the per-call overhead of the bindings, with the per-call
+    loop of the former demodulator against the bulk demodulator.
+    """
+    info = codec2.get_mode_info(DATAC13)
+    bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)
+    audio = np.zeros(8000 * 10, dtype=np.int16)
+
+    freedv = codec2.open_instance(DATAC13)
+    start = time.perf_counter()
+    _, rx_status, _ = demodulate_per_call(freedv, audio, info.nin, bytes_out)
+    time_per_call = time.perf_counter() - start
+    codec2.api.freedv_close(freedv)
+
+    freedv = codec2.open_instance(DATAC13)
+    start = time.perf_counter()
+    result = codec2.demodulate(freedv, audio, info.nin, bytes_out)
+    time_bulk = time.perf_counter() - start
+    codec2.api.freedv_close(freedv)
+
+    # overhead of a call of a typed function, without work in codec2
+    freedv = codec2.open_instance(DATAC13)
+    freedv_nin = codec2.api.freedv_nin
+    start = time.perf_counter()
+    for _ in range(10000):
+        freedv_nin(freedv)
+    time_nin = time.perf_counter() - start
+    codec2.api.freedv_close(freedv)
+
+    print(
+        f"calls: {len(rx_status)} "
+        f"per call loop: {time_per_call * 1000:.1f} ms "
+        f"bulk: {time_bulk * 1000:.1f} ms "
+        f"speedup: {time_per_call / time_bulk:.2f} "
+        f"freedv_nin: {time_nin / 10000 * 1e6:.2f} us"
+    )
+    assert rx_status == result.rx_status
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the numpy stand-in for libcodec2
+
+# pylint: disable=invalid-name
+
+import ctypes
+import os
+import subprocess
+import sys
+
+import codec2
+import codec2_numpy
+import numpy as np
+import pytest
+
+DATAC13 = codec2.FREEDV_MODE.datac13.value
+SILENCE = 4000  # samples at 8 kHz between bursts
+
+
+def frames_of(mode, nframes):
+    payload_per_frame = codec2_numpy.MODES[mode].bytes_per_frame - 2
+    return [bytes([250, i]) + bytes(j % 256 for j in range(payload_per_frame - 2)) for i in range(nframes)]
+
+
+def open_instance(mode):
+    """Stand-in instance of `mode`, opened like codec2.open_instance"""
+    if mode == codec2.FREEDV_MODE.fsk_ldpc_0.value:
+        return codec2_numpy.freedv_open_advanced(
+            codec2.FREEDV_MODE.fsk_ldpc.value, ctypes.byref(codec2.api.FREEDV_MODE_FSK_LDPC_0_ADV)
+        )
+    if mode == codec2.FREEDV_MODE.fsk_ldpc_1.value:
+        return codec2_numpy.freedv_open_advanced(
+            codec2.FREEDV_MODE.fsk_ldpc.value, ctypes.byref(codec2.api.FREEDV_MODE_FSK_LDPC_1_ADV)
+        )
+    return codec2_numpy.freedv_open(mode)
+
+
+def modulate(mode, frames):
+    """8 kHz audio of one burst per frame, like codec2.modulate with the stand-in"""
+    freedv = open_instance(mode)
+    params = codec2_numpy.MODES[mode]
+    bursts = [np.zeros(SILENCE, dtype=np.int16)]
+    for frame in frames:
+        data = ctypes.create_string_buffer(frame + codec2_numpy.crc16(frame).to_bytes(2, "big"))
+        preamble = np.zeros(params.n_tx_preamble_modem_samples, dtype=np.int16)
+        codec2_numpy.freedv_rawdatapreambletx(freedv, preamble.ctypes)
+        burst = np.zeros(params.n_tx_modem_samples, dtype=np.int16)
+        codec2_numpy.freedv_rawdatatx(freedv, burst.ctypes, data)
+        postamble = np.zeros(params.n_tx_postamble_modem_samples, dtype=np.int16)
+        codec2_numpy.freedv_rawdatapostambletx(freedv, postamble.ctypes)
+        bursts += [preamble, burst, postamble, np.zeros(SILENCE, dtype=np.int16)]
+    codec2_numpy.freedv_close(freedv)
+    return np.concatenate(bursts)
+
+
+def demodulate(mode, audio):
+    """Frames and rx status of demodulating `audio`, like codec2.demodulate with the stand-in"""
+    freedv = open_instance(mode)
+    params = codec2_numpy.MODES[mode]
+    bytes_out = ctypes.create_string_buffer(params.bytes_per_frame)
+    frames = []
+    rx_status = []
+    for start in range(0, len(audio) - params.nin + 1, params.nin):
+        block = np.ascontiguousarray(audio[start : start + params.nin])
+        nbytes = codec2_numpy.freedv_rawdatarx(freedv, bytes_out, block.ctypes)
+        rx_status.append(codec2_numpy.freedv_get_rx_status(freedv))
+        if nbytes == params.bytes_per_frame:
+            frames.append(bytes(bytes_out)[:-2])
+    codec2_numpy.freedv_close(freedv)
+    return frames, rx_status
+
+
+def resample(audio, up):
+    """Re-sample `audio` in blocks with the stand-in resampler, with the filter memory in front"""
+    taps = codec2_numpy.TAPS_8K if up else codec2_numpy.TAPS_48K
+    ratio = codec2_numpy.OS
+    block = 240
+    buffer = np.zeros(taps + block, dtype=np.int16)
+    out = []
+    for start in range(0, len(audio), block):
+        buffer[taps:] = 0
+        buffer[taps : taps + len(audio[start : start + block])] = audio[start : start + block]
+        n = block if up else block // ratio
+        result = np.zeros(n * ratio if up else n, dtype=np.int16)
+        function = codec2_numpy.fdmdv_8_to_48_short if up else codec2_numpy.fdmdv_48_to_8_short
+        function(result.ctypes, buffer.ctypes.data + 2 * taps, n)
+        out.append(result)
+    return np.concatenate(out)
+
+
+@pytest.mark.parametrize("mode", list(codec2_numpy.MODES))
+def test_loopback(mode):
+    """Frames survive both resamplers, noise and an offset to the nin blocks"""
+    frames = frames_of(mode, 2)
+    audio = resample(modulate(mode, frames), up=True)
+    noise = np.random.default_rng(0).normal(0, 500, len(audio))
+    audio = np.clip(audio + noise, -32768, 32767).astype(np.int16)
+    audio = np.concatenate([np.zeros(137, dtype=np.int16), resample(audio, up=False)])
+
+    received, rx_status = demodulate(mode, audio)
+    assert received == frames
+    assert rx_status.count(codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BITS) == 2
+    assert codec2.api.FREEDV_RX_TRIAL_SYNC | codec2.api.FREEDV_RX_SYNC in rx_status
+
+
+def test_frame_timing():
+    """A frame is returned after all n_tx_modem_samples have been received, like with libcodec2"""
+    audio = modulate(DATAC13, frames_of(DATAC13, 1))
+    params = codec2_numpy.MODES[DATAC13]
+    _, rx_status = demodulate(DATAC13, audio)
+    sync = rx_status.index(codec2.api.FREEDV_RX_TRIAL_SYNC | codec2.api.FREEDV_RX_SYNC)
+    decoded = rx_status.index(codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BITS)
+    assert (decoded - sync) * params.nin >= params.n_tx_modem_samples - params.nin
+
+
+def test_noise():
+    """Noise and silence don't decode"""
+    audio = np.random.default_rng(1).normal(0, 3000, 8000 * 10).astype(np.int16)
+    audio = np.concatenate([np.zeros(8000, dtype=np.int16), audio])
+    frames, rx_status = demodulate(DATAC13, audio)
+    assert frames == []
+    assert not any(status & codec2.api.FREEDV_RX_BITS for status in rx_status)
+
+
+def test_crc16():
+    """The CRC of libcodec2, CRC-16/CCITT-FALSE"""
+    assert codec2_numpy.crc16(b"123456789") == 0x29B1
+    data = ctypes.create_string_buffer(b"123456789")
+    assert codec2_numpy.freedv_gen_crc16(data, 9) == 0x29B1
+
+
+def test_frame_loss(monkeypatch):
+    """Frames are dropped with the given probability, the same frames for the same seed"""
+    monkeypatch.setenv(codec2_numpy.FRAME_LOSS_ENV, "0")
+    monkeypatch.setenv(codec2_numpy.FRAME_LOSS_SEED_ENV, "0")
+    frames = frames_of(codec2.FREEDV_MODE.datac0.value, 20)
+    audio = modulate(codec2.FREEDV_MODE.datac0.value, frames)
+    try:
+        codec2_numpy.set_frame_loss(0.5, seed=3)
+        received, rx_status = demodulate(codec2.FREEDV_MODE.datac0.value, audio)
+        codec2_numpy.set_frame_loss(0.5, seed=3)
+        assert demodulate(codec2.FREEDV_MODE.datac0.value, audio)[0] == received
+        assert os.environ[codec2_numpy.FRAME_LOSS_ENV] == "0.5"
+    finally:
+        codec2_numpy.set_frame_loss(0)
+
+    assert 0 < len(received) < len(frames)
+    assert all(frame in frames for frame in received)
+    failed = codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BIT_ERRORS
+    assert rx_status.count(failed) == len(frames) - len(received)
+
+
+def test_modem_stats():
+    """Stats are written into the structures of the bindings"""
+    audio = modulate(DATAC13, frames_of(DATAC13, 1))
+    freedv = codec2_numpy.freedv_open(DATAC13)
+    params = codec2_numpy.MODES[DATAC13]
+    bytes_out = ctypes.create_string_buffer(params.bytes_per_frame)
+    for start in range(0, len(audio) - params.nin + 1, params.nin):
+        block = np.ascontiguousarray(audio[start : start + params.nin])
+        if codec2_numpy.freedv_rawdatarx(freedv, bytes_out, block.ctypes):
+            break
+
+    stats = codec2.modem_stats()
+    codec2_numpy.freedv_get_modem_extended_stats(freedv, ctypes.byref(stats.stats))
+    sync = ctypes.c_int()
+    snr = ctypes.c_float()
+    codec2_numpy.freedv_get_modem_stats(freedv, ctypes.byref(sync), ctypes.byref(snr))
+    codec2_numpy.freedv_close(freedv)
+
+    assert stats.stats.Nc == codec2_numpy.NC
+    assert stats.stats.nr > 0
+    assert stats.stats.snr_est == snr.value >= 20
+    assert len(stats.scatter())
+
+
+def test_backend(tmp_path):
+    """The TNC modulates and demodulates with the stand-in selected by the environment"""
+    script = (
+        "import ctypes\n"
+        "import codec2\n"
+        "assert codec2.get_backend() == 'numpy'\n"
+        "mode = codec2.FREEDV_MODE.datac13.value\n"
+        "info = codec2.get_mode_info(mode)\n"
+        "freedv = codec2.open_instance(mode)\n"
+        "frames = [bytes([250, i]) * (info.payload_per_frame // 2) for i in range(3)]\n"
+        "audio = codec2.modulate(freedv, mode, frames, repeat_delay=4000, tx_delay=4000)\n"
+        "codec2.api.freedv_close(freedv)\n"
+        "freedv = codec2.open_instance(mode)\n"
+        "bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)\n"
+        "result = codec2.demodulate(freedv, audio, info.nin, bytes_out)\n"
+        "assert [frame[: info.payload_per_frame] for frame in result.frames] == frames\n"
+        "print('backend', codec2._library.__name__)\n"
+    )
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+    env[codec2.BACKEND_ENV] = "numpy"
+    env[codec2.LIBRARY_PATH_ENV] = str(tmp_path / "missing.so")
+    env.pop("LD_LIBRARY_PATH", None)
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=env, capture_output=True, text=True, timeout=60, check=False
+    )
+    assert result.returncode == 0, result.stderr
+    assert "backend codec2_numpy" in result.stdout
+
+
+def test_set_backend(monkeypatch):
+    monkeypatch.delenv(codec2.BACKEND_ENV, raising=False)
+    assert codec2.get_backend() == "libcodec2"
+    with pytest.raises(ValueError):
+        codec2.set_backend("fortran")
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
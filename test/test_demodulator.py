@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the event driven demodulator scheduler
+
+# pylint: disable=invalid-name
+
+import os
+import sys
+import threading
+import time
+
+import codec2
+import demodulator
+import numpy as np
+import pytest
+
+BLOCK_SZ = 800
+NIN = 1200
+NBLOCKS = 60
+
+# modes listening at the same time during an ARQ session
+ARQ_MODES = [
+    ("sig0-datac13", codec2.FREEDV_MODE.datac13.value),
+    ("sig1-datac13", codec2.FREEDV_MODE.datac13.value),
+    ("dat0-datac1", codec2.FREEDV_MODE.datac1.value),
+    ("dat0-datac3", codec2.FREEDV_MODE.datac3.value),
+    ("dat0-datac4", codec2.FREEDV_MODE.datac4.value),
+]
+BENCHMARK_SECONDS = 10
+BENCHMARK_BLOCK_SZ = 4000
+
+
+def pop_all(demod):
+    """Stand-in for RF.demodulate_audio, consumes all available audio in steps of nin"""
+    calls = 0
+    while demod.audiobuffer.nbuffer >= demod.nin:
+        demod.audiobuffer.pop(demod.nin)
+        calls += 1
+    if calls:
+        demod.frames += 1
+    return calls
+
+
+def fake_demodulator(name, store):
+    """Demodulator reading the store, which is never opened by pop_all"""
+    demod = demodulator.Demodulator(
+        name, codec2.FREEDV_MODE.datac13.value, store.reader(history=store.size), []
+    )
+    demod.nin = NIN
+    return demod
+
+
+def wait_for(condition, timeout=2.0):
+    """Wait until condition() is True or timeout is reached"""
+    timeout = time.time() + timeout
+    while not condition() and time.time() < timeout:
+        time.sleep(0.001)
+    return condition()
+
+
+def test_demodulator_scheduler():
+    store = codec2.shared_audio_buffer(4 * BLOCK_SZ)
+    scheduler = demodulator.DemodulatorScheduler(pop_all)
+
+    enabled = fake_demodulator("enabled", store)
+    disabled = fake_demodulator("disabled", store)
+    scheduler.add(enabled)
+    scheduler.add(disabled)
+    enabled.audiobuffer.active = True
+
+    block = np.zeros(BLOCK_SZ, dtype=np.int16)
+    for _ in range(NBLOCKS):
+        store.push(block)
+        scheduler.notify()
+        # give the worker a chance to keep up like with real audio blocks
+        wait_for(lambda: not enabled.event.is_set(), 0.1)
+
+    # every sample of the enabled mode has been demodulated
+    samples = NBLOCKS * BLOCK_SZ
+    assert wait_for(lambda: enabled.demod_calls == samples // NIN)
+    assert enabled.audiobuffer.nbuffer == samples % NIN
+
+    # woken only if there was audio, not more often than audio blocks arrived
+    assert 0 < enabled.wakeups <= NBLOCKS
+    assert enabled.latency_max >= enabled.latency > 0
+    assert enabled.cpu_time >= 0
+
+    # a disabled mode never wakes up
+    assert disabled.wakeups == 0
+    assert disabled.demod_calls == 0
+
+    stats = scheduler.stats()
+    assert stats["enabled"]["demod_calls"] == samples // NIN
+    assert stats["disabled"]["wakeups"] == 0
+
+
+def test_demodulator_scheduler_parallel():
+    """Slow demodulators of different modes must not delay each other"""
+    store = codec2.shared_audio_buffer(4 * BLOCK_SZ)
+    barrier = threading.Barrier(2, timeout=2.0)
+
+    def demodulate(demod):
+        # both workers have to be inside demodulate at the same time
+        barrier.wait()
+        return pop_all(demod)
+
+    scheduler = demodulator.DemodulatorScheduler(demodulate)
+    demods = [fake_demodulator(name, store) for name in ["mode0", "mode1"]]
+    for demod in demods:
+        demod.audiobuffer.active = True
+        scheduler.add(demod)
+
+    store.push(np.zeros(2 * BLOCK_SZ, dtype=np.int16))
+    scheduler.notify()
+
+    assert wait_for(lambda: all(demod.demod_calls == 1 for demod in demods))
+    assert not barrier.broken
+
+
+def codec2_demodulate(demod):
+    """Demodulate all available audio, like RF.demodulate_audio without dispatching frames"""
+    return demod.demodulate(lambda frame, position: None)
+
+
+def test_demodulate():
+    """Decoded frames are reported with their position, the codec2 instance is released also on errors"""
+    mode = codec2.FREEDV_MODE.datac13.value
+    freedv = codec2.open_instance(mode)
+    audio = codec2.modulate(freedv, mode, [b"\xffDEMOD"], tx_delay=4000)
+    codec2.api.freedv_close(freedv)
+    audio = np.concatenate([audio, np.zeros(4000, dtype=np.int16)])
+
+    store = codec2.shared_audio_buffer(4 * BLOCK_SZ)
+    demod = demodulator.Demodulator("sig0-datac13", mode, store.reader(history=store.size), [])
+    demod.audiobuffer.active = True
+    frames = []
+    rx_status = []
+    demod_calls = 0
+    for start in range(0, len(audio), BLOCK_SZ):
+        store.push(audio[start : start + BLOCK_SZ])
+        demod_calls += demod.demodulate(lambda frame, position: frames.append((frame, position)), rx_status.append)
+    assert demod.users == 0
+    assert demod_calls == len(rx_status) > 0
+    assert [frame[:6] for frame, _ in frames] == [b"\xffDEMOD"]
+    # the frame ends within the burst, before the trailing silence
+    assert 4000 < frames[0][1] <= len(audio) - 4000 + BLOCK_SZ
+    assert demod.audiobuffer.nbuffer < demod.nin
+
+    def fail(frame, position):
+        raise RuntimeError("frame handler failed")
+
+    # the same burst again, with a failing frame handler
+    with pytest.raises(RuntimeError):
+        for start in range(0, len(audio), BLOCK_SZ):
+            store.push(audio[start : start + BLOCK_SZ])
+            demod.demodulate(fail)
+    assert demod.users == 0
+
+
+def test_demodulator_lazy_open():
+    """codec2 instances are opened on first use and closed after the grace period"""
+    store = codec2.shared_audio_buffer(4 * BLOCK_SZ)
+    scheduler = demodulator.DemodulatorScheduler(codec2_demodulate)
+    demod = demodulator.Demodulator(
+        "sig0-datac13", codec2.FREEDV_MODE.datac13.value, store.reader(history=store.size), [],
+        grace_period=0.2,
+    )
+    scheduler.add(demod)
+    assert demod.freedv is None
+    assert demod.nin == codec2.get_mode_info(codec2.FREEDV_MODE.datac13.value).nin
+
+    # nothing is opened as long as we are not listening to the mode
+    block = np.zeros(BLOCK_SZ, dtype=np.int16)
+    for _ in range(4):
+        store.push(block)
+        scheduler.notify()
+    time.sleep(0.05)
+    assert demod.freedv is None
+    assert demod.wakeups == 0
+
+    demod.audiobuffer.active = True
+    for _ in range(4):
+        store.push(block)
+        scheduler.notify()
+    assert wait_for(lambda: demod.demod_calls > 0)
+    assert demod.freedv is not None
+    assert demod.users == 0
+    assert demod.startup_time > 0
+    assert scheduler.stats()["sig0-datac13"]["startup_time"] > 0
+
+    # still open within the grace period
+    demod.audiobuffer.active = False
+    store.push(block)
+    scheduler.notify()
+    time.sleep(0.05)
+    assert demod.freedv is not None
+
+    # closed once the grace period has passed
+    time.sleep(0.2)
+    store.push(block)
+    scheduler.notify()
+    assert wait_for(lambda: demod.freedv is None)
+
+    # and opened again if we listen again
+    demod.audiobuffer.active = True
+    for _ in range(4):
+        store.push(block)
+        scheduler.notify()
+    assert wait_for(lambda: demod.freedv is not None)
+
+
+def test_demodulator_processes():
+    """A demodulator process decodes the shared audio and reports the frame to the TNC process"""
+    mode = codec2.FREEDV_MODE.datac13.value
+    freedv = codec2.open_instance(mode)
+    audio = codec2.modulate(freedv, mode, [b"\xffPROCESS"], tx_delay=4000)
+    codec2.api.freedv_close(freedv)
+    audio = np.concatenate([audio, np.zeros(4000, dtype=np.int16)])
+
+    store = codec2.process_shared_audio_buffer(4 * BLOCK_SZ)
+    frames = []
+    processes = demodulator.DemodulatorProcesses(
+        store, store.size, lambda *args: None, lambda demod, frame, snr, scatter: frames.append(bytes(frame))
+    )
+    demod = demodulator.Demodulator("sig0-datac13", mode, store.reader(), [], (-50.0, 50.0))
+    processes.add(demod)
+    try:
+        demod.audiobuffer.active = True
+        for start in range(0, len(audio), BLOCK_SZ):
+            store.push(audio[start : start + BLOCK_SZ])
+            processes.notify()
+            # the process has to keep up with the shared buffer, like with real audio blocks
+            assert wait_for(lambda: processes.backlog() < 2 * BLOCK_SZ, timeout=30)
+        assert wait_for(lambda: frames, timeout=5)
+    finally:
+        processes.stop()
+
+    assert [frame[:8] for frame in frames] == [b"\xffPROCESS"]
+    assert wait_for(lambda: demod.demod_calls > 0)
+    assert demod.frames == 1
+
+
+def open_demodulator(name, mode, store):
+    # same settings as RF.init_demodulator and the demodulator processes
+    demod = demodulator.Demodulator(name, mode, store.reader(history=store.size), [], (-50.0, 50.0))
+    # open the codec2 instance before measuring
+    demod.acquire()
+    demod.release()
+    demod.audiobuffer.active = True
+    return demod
+
+
+def run_realtime_factor(store, scheduler, busy):
+    """Push noise as fast as the demodulators can follow, return the real-time factor"""
+    rng = np.random.default_rng(0)
+    blocks = [
+        rng.normal(0, 1000, BENCHMARK_BLOCK_SZ).astype(np.int16)
+        for _ in range(BENCHMARK_SECONDS * 8000 // BENCHMARK_BLOCK_SZ)
+    ]
+    start = time.perf_counter()
+    for block in blocks:
+        store.push(block)
+        scheduler.notify()
+        while busy():
+            time.sleep(0.0005)
+    duration = time.perf_counter() - start
+    return BENCHMARK_SECONDS / duration
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("cores", [1, 2, 4])
+def test_demodulator_processes_benchmark(cores):
+    """Real-time factor of all ARQ modes, demodulated in threads and in processes"""
+    if not hasattr(os, "sched_setaffinity") or len(os.sched_getaffinity(0)) < cores:
+        pytest.skip(f"needs {cores} cpu cores")
+
+    affinity = os.sched_getaffinity(0)
+    # child processes inherit the cpu affinity
+    os.sched_setaffinity(0, sorted(affinity)[:cores])
+    try:
+        # threads, sharing the GIL of a single process
+        store = codec2.shared_audio_buffer(4 * BENCHMARK_BLOCK_SZ)
+        scheduler = demodulator.DemodulatorScheduler(codec2_demodulate)
+        demods = [open_demodulator(name, mode, store) for name, mode in ARQ_MODES]
+        for demod in demods:
+            scheduler.add(demod)
+        rtf_threads = run_realtime_factor(
+            store,
+            scheduler,
+            lambda: any(demod.ready() or demod.event.is_set() for demod in demods),
+        )
+
+        # one process per demodulator
+        store = codec2.process_shared_audio_buffer(4 * BENCHMARK_BLOCK_SZ)
+        processes = demodulator.DemodulatorProcesses(
+            store, store.size, lambda *args: None, lambda *args: None
+        )
+        for name, mode in ARQ_MODES:
+            demod = demodulator.Demodulator(name, mode, store.reader(), [], (-50.0, 50.0))
+            demod.audiobuffer.active = True
+            processes.add(demod)
+        # wait until every process has opened its codec2 instance
+        processes.notify()
+        assert wait_for(
+            lambda: all(state.nin > 0 and state.active for _, state, _, _ in processes.workers),
+            timeout=30,
+        )
+        rtf_processes = run_realtime_factor(
+            store,
+            processes,
+            lambda: any(
+                store._wr - state.position >= state.nin for _, state, _, _ in processes.workers
+            ),
+        )
+        processes.stop()
+    finally:
+        os.sched_setaffinity(0, affinity)
+
+    print(
+        f"cores: {cores} modes: {len(ARQ_MODES)} "
+        f"real-time factor threads: {rtf_threads:.1f} "
+        f"processes: {rtf_processes:.1f}"
+    )
+    assert all(demod.demod_calls > 0 for demod in demods)
+    assert wait_for(
+        lambda: all(demod.demod_calls > 0 for demod in processes.demodulators.values())
+    )
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the cached codec2 mode parameters
+
+# pylint: disable=invalid-name
+
+import sys
+import time
+
+import codec2
+import pytest
+
+MODES = [
+    codec2.FREEDV_MODE.datac0.value,
+    codec2.FREEDV_MODE.datac1.value,
+    codec2.FREEDV_MODE.datac3.value,
+    codec2.FREEDV_MODE.datac4.value,
+    codec2.FREEDV_MODE.datac13.value,
+    codec2.FREEDV_MODE.fsk_ldpc_0.value,
+    codec2.FREEDV_MODE.fsk_ldpc_1.value,
+]
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_mode_info(mode):
+    info = codec2.get_mode_info(mode)
+
+    freedv = codec2.open_instance(mode)
+    assert info.mode == mode
+    assert info.bytes_per_frame == codec2.api.freedv_get_bits_per_modem_frame(freedv) // 8
+    assert info.payload_per_frame == info.bytes_per_frame - 2
+    assert info.n_tx_modem_samples == codec2.api.freedv_get_n_tx_modem_samples(freedv)
+    assert info.n_tx_preamble_modem_samples == codec2.api.freedv_get_n_tx_preamble_modem_samples(freedv)
+    assert info.n_tx_postamble_modem_samples == codec2.api.freedv_get_n_tx_postamble_modem_samples(freedv)
+    assert info.nin == codec2.api.freedv_nin(freedv)
+    assert info.modem_sample_rate == codec2.api.FREEDV_FS_8000
+    assert 0 < info.frame_duration < info.burst_duration
+    codec2.api.freedv_close(freedv)
+
+    # further lookups are served from the cache
+    assert codec2.get_mode_info(mode) is info
+
+
+def test_silence():
+    silence = codec2.get_silence(4800)
+    assert len(silence) == 4800
+    assert not silence.any()
+    assert codec2.get_silence(4800) is silence
+    # shared by all callers, so it must not be changed
+    with pytest.raises(ValueError):
+        silence[0] = 1
+
+
+@pytest.mark.benchmark
+def test_mode_info_benchmark():
+    """Compare a cached lookup with opening a codec2 instance"""
+    mode = codec2.FREEDV_MODE.datac3.value
+    codec2.get_mode_info(mode)
+    runs = 1000
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        codec2.get_mode_info(mode).bytes_per_frame
+    time_cached = (time.perf_counter() - start) / runs
+
+    runs_open = 10
+    start = time.perf_counter()
+    for _ in range(runs_open):
+        freedv = codec2.open_instance(mode)
+        codec2.api.freedv_get_bits_per_modem_frame(freedv)
+        codec2.api.freedv_close(freedv)
+    time_open = (time.perf_counter() - start) / runs_open
+
+    print(f"cached lookup: {time_cached * 1e6:.2f} us open instance: {time_open * 1e6:.0f} us")
+    assert time_cached < time_open
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests building the tx burst in one preallocated buffer
+
+# pylint: disable=invalid-name
+
+import ctypes
+import sys
+import time
+
+import codec2
+import numpy as np
+import pytest
+import replay
+
+DATAC13 = codec2.FREEDV_MODE.datac13.value
+
+
+def frames_of(mode, nframes):
+    payload = codec2.get_mode_info(mode).payload_per_frame
+    return [bytearray([250, i]) + bytearray(range(payload - 2)) for i in range(nframes)]
+
+
+def modulate_concat(freedv, mode, frames, repeats, repeat_delay, tx_delay):
+    """The former RF.transmit: bytes concatenation of every modulated segment"""
+    info = codec2.get_mode_info(mode)
+    mod_out = ctypes.create_string_buffer(info.n_tx_modem_samples * 2)
+    mod_out_preamble = ctypes.create_string_buffer(info.n_tx_preamble_modem_samples * 2)
+    mod_out_postamble = ctypes.create_string_buffer(info.n_tx_postamble_modem_samples * 2)
+    txbuffer = bytes(ctypes.create_string_buffer(tx_delay * 2))
+    for _ in range(repeats):
+        for frame in frames:
+            if mode not in codec2.MODES_WITHOUT_PREAMBLE:
+                codec2.api.freedv_rawdatapreambletx(freedv, mod_out_preamble)
+                txbuffer += bytes(mod_out_preamble)
+            buffer = bytearray(info.payload_per_frame)
+            buffer[: len(frame)] = frame
+            crc = ctypes.c_ushort(codec2.api.freedv_gen_crc16(bytes(buffer), info.payload_per_frame))
+            buffer += crc.value.to_bytes(2, byteorder="big")
+            data = (ctypes.c_ubyte * info.bytes_per_frame).from_buffer_copy(buffer)
+            codec2.api.freedv_rawdatatx(freedv, mod_out, data)
+            txbuffer += bytes(mod_out)
+            if mode not in codec2.MODES_WITHOUT_PREAMBLE:
+                codec2.api.freedv_rawdatapostambletx(freedv, mod_out_postamble)
+                txbuffer += bytes(mod_out_postamble)
+        txbuffer += bytes(ctypes.create_string_buffer(repeat_delay * 2))
+    x = np.frombuffer(txbuffer, dtype=np.int16)
+    # the former set_audio_volume
+    return (x * (90 / 100.0)).astype(np.int16)
+
+
+@pytest.mark.parametrize(
+    "mode", [DATAC13, codec2.FREEDV_MODE.datac4.value, codec2.FREEDV_MODE.fsk_ldpc_0.value]
+)
+def test_modulate(mode):
+    """Same samples as modulating every segment into its own buffer"""
+    frames = frames_of(mode, 2)
+    freedv = codec2.open_instance(mode)
+    expected = modulate_concat(freedv, mode, frames, 2, 400, 800)
+    codec2.api.freedv_close(freedv)
+
+    freedv = codec2.open_instance(mode)
+    x = codec2.modulate(freedv, mode, frames, 2, 400, 800)
+    codec2.api.freedv_close(freedv)
+
+    assert len(x) == codec2.get_burst_length(mode, 2, 2, 400, 800)
+    assert not x[:800].any()
+    np.testing.assert_array_equal((x * (90 / 100.0)).astype(np.int16), expected)
+
+
+def test_modulate_into():
+    """Every frame is ready for streaming as soon as it is modulated"""
+    mode = codec2.FREEDV_MODE.datac4.value
+    frames = frames_of(mode, 3)
+    freedv = codec2.open_instance(mode)
+    expected = codec2.modulate(freedv, mode, frames, 2, 400, 800)
+    codec2.api.freedv_close(freedv)
+
+    freedv = codec2.open_instance(mode)
+    x = np.zeros(len(expected), dtype=np.int16)
+    ready = list(codec2.modulate_into(x, freedv, mode, frames, 2, 400, 800))
+    codec2.api.freedv_close(freedv)
+
+    info = codec2.get_mode_info(mode)
+    burst = info.n_tx_preamble_modem_samples + info.n_tx_modem_samples + info.n_tx_postamble_modem_samples
+    # tx delay with the first frame, the repeat delay with the next frame or at the end
+    assert ready == [800 + burst, 800 + 2 * burst, 800 + 3 * burst,
+                     1200 + 4 * burst, 1200 + 5 * burst, 1200 + 6 * burst, len(x)]
+    np.testing.assert_array_equal(x, expected)
+
+
+def test_modulate_back_to_back():
+    """Repeats without delay in between are decoded"""
+    freedv = codec2.open_instance(DATAC13)
+    x = codec2.modulate(freedv, DATAC13, frames_of(DATAC13, 1), repeats=3, tx_delay=4000)
+    codec2.api.freedv_close(freedv)
+
+    x = np.concatenate((x, np.zeros(16000, dtype=np.int16)))
+    frames, _ = replay.decode_recording(x, 8000, ["datac13"])
+    assert len(frames) == 3
+
+
+def test_set_audio_volume():
+    # modem opens the audio devices on import, skip without PortAudio
+    modem = pytest.importorskip("modem", exc_type=(ImportError, OSError))
+    x = np.array([0, 1000, -1000, 30000, -30000, 32767], dtype=np.int16)
+
+    scaled = modem.set_audio_volume(x, 150)
+    assert scaled is x
+    np.testing.assert_array_equal(x, [0, 1500, -1500, 32767, -32768, 32767])
+
+    # bytes are copied
+    scaled = modem.set_audio_volume(np.array([1000, -1000], dtype=np.int16).tobytes(), 50)
+    np.testing.assert_array_equal(scaled, [500, -500])
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    "mode,nframes,repeats",
+    [
+        # ACK / NACK
+        (DATAC13, 1, 1),
+        # long data burst
+        (codec2.FREEDV_MODE.datac3.value, 8, 3),
+    ],
+)
+def test_modulate_benchmark(mode, nframes, repeats):
+    """Build a burst by bytes concatenation or in one preallocated buffer"""
+    frames = frames_of(mode, nframes)
+    freedv = codec2.open_instance(mode)
+    runs = 3
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        modulate_concat(freedv, mode, frames, repeats, 0, 400)
+    time_concat = (time.perf_counter() - start) / runs
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        x = codec2.modulate(freedv, mode, frames, repeats, 0, 400)
+        np.multiply(x, 0.9, out=x, casting="unsafe")
+    time_preallocated = (time.perf_counter() - start) / runs
+    codec2.api.freedv_close(freedv)
+
+    print(
+        f"{codec2.FREEDV_MODE(mode).name} frames: {nframes} repeats: {repeats} "
+        f"concatenation: {time_concat * 1000:.1f} ms preallocated: {time_preallocated * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the per slot channel occupancy of the busy detection
+
+# pylint: disable=invalid-name
+
+import sys
+import threading
+import time
+
+import codec2
+import numpy as np
+import occupancy
+import pytest
+import spectrum
+
+FS = 8000
+INTERVAL = spectrum.UPDATE_INTERVAL
+USED_SLOTS = codec2.FREEDV_MODE_USED_SLOTS
+
+
+def signal_spectrum(*frequencies, seconds=0.5):
+    """Spectrum of tones at `frequencies` in noise, like calculate_fft gets it"""
+    t = np.arange(int(seconds * FS)) / FS
+    audio = np.random.default_rng(0).normal(0, 300, len(t))
+    for frequency in frequencies:
+        audio += 8000 * np.sin(2 * np.pi * frequency * t)
+    engine = spectrum.SpectrumEngine()
+    engine.push(audio.astype(np.int16))
+    return engine.update()
+
+
+QUIET = signal_spectrum()
+SLOT3 = signal_spectrum(1500)
+SLOT4 = signal_spectrum(2000)
+
+
+def test_slot_edges():
+    """Slots derived from center frequency and bandwidth are the former hard-coded bin ranges"""
+    edges = occupancy.slot_edges(spectrum.SPECTRUM_BINS, spectrum.BIN_WIDTH)
+    assert edges[0] == 0 and edges[-1] == spectrum.SPECTRUM_BINS
+    assert np.all(np.abs(edges - [0, 65, 120, 176, 231, 315]) <= 3)
+    # the narrowband modes sit in the middle slot
+    assert edges[2] * spectrum.BIN_WIDTH < 1500 - 250 and edges[3] * spectrum.BIN_WIDTH > 1500 + 250
+
+
+def test_detection():
+    channel = occupancy.ChannelOccupancy()
+    assert channel.update(QUIET, INTERVAL).tolist() == [False] * 5
+    assert channel.update(SLOT3, INTERVAL).tolist() == [False, False, True, False, False]
+    assert channel.update(signal_spectrum(800, 2600), INTERVAL).tolist() == [False, True, True, False, True]
+    # our own transmission doesn't count
+    channel.reset()
+    assert channel.update(SLOT3, INTERVAL, detect=False).tolist() == [False] * 5
+
+
+def test_independent_hysteresis():
+    """Every slot is released after its own hold time"""
+    channel = occupancy.ChannelOccupancy()
+    # a second of signal in slot 3 holds it for HOLD_MAX seconds
+    for _ in range(10):
+        channel.update(SLOT3, INTERVAL)
+    assert channel.hold[2] == pytest.approx(occupancy.HOLD_MAX)
+    # a short signal in slot 4 is only held briefly
+    busy = channel.update(SLOT4, INTERVAL)
+    assert busy[2] and busy[3]
+
+    released = {}
+    for step in range(1, 40):
+        busy = channel.update(QUIET, INTERVAL)
+        for slot in (2, 3):
+            if not busy[slot] and slot not in released:
+                released[slot] = step * INTERVAL
+    assert released[3] == pytest.approx(occupancy.HOLD_RISE * INTERVAL, abs=INTERVAL)
+    assert released[2] == pytest.approx(occupancy.HOLD_MAX, abs=INTERVAL)
+    assert not channel.channel_busy
+
+
+def former_busy_slots(dfft):
+    """Busy slots of the former per slot loop of calculate_fft, without hysteresis"""
+    busy_slots = [False] * 5
+    marked = dfft.copy()
+    avg = np.mean(marked)
+    marked[marked > avg + 15] = 100
+    for slot, (range_start, range_end) in enumerate([[0, 65], [65, 120], [120, 176], [176, 231], [231, 315]]):
+        slotdfft = marked[range_start:range_end]
+        busy_slots[slot] = np.sum(slotdfft[slotdfft > avg + 15]) >= 200
+    return busy_slots
+
+
+@pytest.mark.parametrize("frequencies", [(), (1500,), (2000,), (800, 2600)])
+def test_former_detection(frequencies):
+    """Without hysteresis, the slots are busy like with the former loop"""
+    dfft = signal_spectrum(*frequencies)
+    channel = occupancy.ChannelOccupancy()
+    assert channel.update(dfft, INTERVAL).tolist() == former_busy_slots(dfft)
+
+
+def test_mode_masks():
+    """Modes fit into the free slots with a single check of their mask"""
+    channel = occupancy.ChannelOccupancy()
+    channel.update(SLOT4, INTERVAL)
+    assert channel.busy_bits == 1 << 3
+    assert channel.is_free(USED_SLOTS.datac13.value)
+    assert channel.mode_is_free("datac13")
+    assert not channel.is_free(USED_SLOTS.datac1.value)
+    assert not channel.mode_is_free("datac1")
+    assert channel.is_free(occupancy.slot_bits(USED_SLOTS.datac3.value))
+    # the former check only caught busy slots exactly like the ones of the mode
+    assert USED_SLOTS.datac1.value not in [channel.busy.tolist()]
+
+    assert occupancy.MODE_SLOT_BITS["datac1"] == 0b01110
+    assert occupancy.MODE_SLOT_BITS["sig1"] == 0b00100
+
+
+def test_wait_free():
+    """Waiting senders are woken by the spectrum which releases their slots"""
+    channel = occupancy.ChannelOccupancy()
+    channel.update(SLOT3, INTERVAL)
+    assert not channel.wait_free(USED_SLOTS.datac13.value, 0.05)
+    assert channel.wait_free(0b01000, 0)
+
+    def release():
+        time.sleep(0.1)
+        for _ in range(20):
+            channel.update(QUIET, INTERVAL)
+
+    thread = threading.Thread(target=release, daemon=True)
+    start = time.time()
+    thread.start()
+    assert channel.wait_free(USED_SLOTS.datac13.value, 5)
+    assert time.time() - start < 2
+    thread.join()
+
+
+def test_history():
+    channel = occupancy.ChannelOccupancy(history_size=16)
+    for _ in range(10):
+        channel.update(SLOT4, INTERVAL)
+    channel.reset()
+    for _ in range(10):
+        channel.update(QUIET, INTERVAL)
+
+    history = channel.last(100)
+    assert len(history) == 16
+    assert np.all(np.diff(history["time"]) >= 0)
+    assert history["detected"][:, 3].tolist() == [True] * 6 + [False] * 10
+    assert channel.occupancy(60) == [0.0, 0.0, 0.0, 0.375, 0.0]
+    assert channel.occupancy(0) == [0.0] * 5
+
+
+@pytest.mark.benchmark
+def test_occupancy_benchmark():
+    """Micro-benchmark of the vectorized slots and the mask check against the former loop"""
+    dfft = SLOT3.copy()
+    nruns = 1000
+
+    start = time.perf_counter()
+    for _ in range(nruns):
+        busy_slots = former_busy_slots(dfft)
+    time_loop = time.perf_counter() - start
+
+    channel = occupancy.ChannelOccupancy()
+    start = time.perf_counter()
+    for _ in range(nruns):
+        channel.update(dfft, INTERVAL)
+    time_update = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(nruns):
+        channel.mode_is_free("datac1")
+    time_check = time.perf_counter() - start
+
+    print(
+        f"former loop: {time_loop / nruns * 1e6:.1f} us "
+        f"update: {time_update / nruns * 1e6:.1f} us "
+        f"mode check: {time_check / nruns * 1e6:.2f} us"
+    )
+    assert channel.busy.tolist() == busy_slots
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test that pre-rendered ARQ acknowledges are used although the SNR of the
+last frame of a burst differs from the one they were pre-rendered with.
+
+Can be invoked from CMake, pytest, coverage or directly.
+
+Uses no other files.
+"""
+
+import multiprocessing
+import sys
+
+import pytest
+
+# pylint: disable=wrong-import-position
+sys.path.insert(0, "..")
+sys.path.insert(0, "../tnc")
+import data_handler
+import helpers
+import modem
+from codec2 import FREEDV_MODE
+from static import ARQ
+
+
+def t_prerender_hit(final: bool):
+    """
+    Pre-render the acknowledge of a burst and compare it to the one sent after its last frame.
+
+    :param final: the burst completes the data frame
+    :type final: bool
+    """
+    prerendered = []
+    modem.prerender_transmission = lambda *request: prerendered.append(modem.RF.get_prerender_key(*request))
+
+    tnc = data_handler.DATA()
+    tnc.arq_cleanup()
+    tnc.session_id = b"\x2a"
+    ARQ.rx_frame_buffer = b""
+    burst_payload = 500
+
+    # SNR of the frame before the last one
+    tnc.arq_prerender_acknowledges(5.23, burst_payload, final=final)
+    assert prerendered
+
+    # the last frame arrives with a slightly different SNR
+    ARQ.rx_frame_buffer = bytes(burst_payload)
+    if final:
+        sent = [
+            modem.RF.get_prerender_key(FREEDV_MODE.sig1.value, 3, 0, [tnc.build_data_ack_frame(snr)])
+            for snr in (5.41, 4.6)
+        ]
+    else:
+        sent = [
+            modem.RF.get_prerender_key(
+                FREEDV_MODE.sig1.value,
+                1,
+                0,
+                [tnc.build_burst_ack_frame(snr, tnc.arq_predict_speed_level(), len(ARQ.rx_frame_buffer))],
+            )
+            for snr in (5.41, 4.6)
+        ]
+    assert all(key in prerendered for key in sent)
+
+    # only the key is quantized, the frame keeps the exact SNR
+    assert helpers.snr_from_bytes(tnc.build_data_ack_frame(5.41)[2:3]) == 5.4
+
+    # a real change of the SNR is modulated again
+    changed = tnc.build_data_ack_frame(8.0)
+    assert helpers.snr_from_bytes(changed[2:3]) == 8.0
+    assert modem.RF.get_prerender_key(FREEDV_MODE.sig1.value, 3, 0, [changed]) not in prerendered
+
+
+# Pushed into separate processes like test_tnc_states.py, as DATA changes the static state.
+@pytest.mark.parametrize("final", [False, True])
+def test_prerender_hit(final: bool):
+    proc = multiprocessing.Process(target=t_prerender_hit, args=(final,))
+    proc.start()
+    proc.join(30)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+
+    assert proc.exitcode == 0
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the offline decoder with generated recordings
+
+# pylint: disable=invalid-name
+
+import ctypes
+import sys
+import wave
+
+import codec2
+import numpy as np
+import pytest
+import replay
+import structlog
+
+MODE = codec2.FREEDV_MODE.datac13.value
+SILENCE = 4000  # samples at 8 kHz before and after every burst
+BURSTS = 3
+
+
+def modulate_burst(freedv, payload: bytes) -> bytes:
+    """Preamble, one frame with CRC and postamble of `payload` as 8 kHz int16 audio"""
+    mode_info = codec2.get_mode_info(MODE)
+    buffer = bytearray(mode_info.payload_per_frame)
+    buffer[: len(payload)] = payload
+    crc = ctypes.c_ushort(codec2.api.freedv_gen_crc16(bytes(buffer), mode_info.payload_per_frame))
+    buffer += crc.value.to_bytes(2, byteorder="big")
+
+    mod_out_preamble = ctypes.create_string_buffer(mode_info.n_tx_preamble_modem_samples * 2)
+    mod_out = ctypes.create_string_buffer(mode_info.n_tx_modem_samples * 2)
+    mod_out_postamble = ctypes.create_string_buffer(mode_info.n_tx_postamble_modem_samples * 2)
+    codec2.api.freedv_rawdatapreambletx(freedv, mod_out_preamble)
+    codec2.api.freedv_rawdatatx(freedv, mod_out, (ctypes.c_ubyte * len(buffer)).from_buffer_copy(buffer))
+    codec2.api.freedv_rawdatapostambletx(freedv, mod_out_postamble)
+    return bytes(mod_out_preamble) + bytes(mod_out) + bytes(mod_out_postamble)
+
+
+def generate_recording():
+    """8 kHz audio of BURSTS datac13 bursts, separated by silence"""
+    freedv = codec2.open_instance(MODE)
+    silence = bytes(2 * SILENCE)
+    audio = silence
+    for burst in range(BURSTS):
+        audio += modulate_burst(freedv, bytes([255, burst]) + b"REPLAY") + silence
+    codec2.api.freedv_close(freedv)
+    return np.frombuffer(audio, dtype=np.int16)
+
+
+def test_replay_wav_8k(tmp_path):
+    samples = generate_recording()
+    path = tmp_path / "recording.wav"
+    # same format as AudioParam.audio_record
+    with wave.open(str(path), "w") as recording:
+        recording.setnchannels(1)
+        recording.setsampwidth(2)
+        recording.setframerate(8000)
+        recording.writeframes(samples.tobytes())
+
+    recorded, sample_rate = replay.load_recording(str(path))
+    assert sample_rate == 8000
+    assert np.array_equal(recorded, samples)
+
+    frames, stats = replay.decode_recording(recorded, sample_rate)
+    datac13 = [frame for frame in frames if frame["mode"] == "datac13"]
+    assert [bytes.fromhex(frame["data"])[:2] for frame in datac13] == [
+        bytes([255, burst]) for burst in range(BURSTS)
+    ]
+    # frames are in order and within the recording
+    timestamps = [frame["timestamp"] for frame in datac13]
+    assert timestamps == sorted(timestamps)
+    assert 0 < timestamps[0] < timestamps[-1] <= len(samples) / 8000
+    assert all(frame["snr"] > 0 for frame in datac13)
+
+    assert stats["duration"] == pytest.approx(len(samples) / 8000, abs=0.1)
+    assert stats["datac13"]["frames"] == BURSTS
+    assert stats["datac13"]["telemetry"]["decoded"] == BURSTS
+    assert stats["datac13"]["telemetry"]["snr_avg"] > 0
+    for mode in replay.DEFAULT_MODES:
+        assert stats[mode]["demod_calls"] > 0
+    print(stats)
+    # much faster than real time
+    assert stats["realtime_factor"] > 1
+
+
+def test_replay_raw_48k(tmp_path, capsys):
+    resampler = codec2.resampler()
+    samples = resampler.resample8_to_48(generate_recording())
+    path = tmp_path / "recording.raw"
+    samples.tofile(path)
+
+    try:
+        assert replay.main([str(path), "--samplerate", "48000", "--modes", "datac13"]) == 0
+    finally:
+        # main() logs to the captured stderr, which is closed after this test
+        structlog.reset_defaults()
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert len(lines) == BURSTS + 1
+    assert '"mode":"datac13"' in lines[0]
+    assert '"stats"' in lines[-1]
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -17,6 +17,7 @@
 
 import os
 import sys
+import time
 
 import codec2
 import numpy as np
@@ -111,6 +112,60 @@ def test_resampler():
     assert ratio_dB < threshdB
 
 
+def test_resampler_streaming():
+    """
+    Resampling in small blocks, with and without out=, must give the same
+    result as resampling everything at once, so the filter memory is kept
+    """
+    rng = np.random.default_rng(0)
+    in8k = rng.normal(0, 4000, N8 * FRAMES).astype(np.int16)
+
+    out48k = codec2.resampler().resample8_to_48(in8k)
+    out8k = codec2.resampler().resample48_to_8(out48k)
+
+    resampler = codec2.resampler(N48)
+    block48 = np.zeros(N48, dtype=np.int16)
+    block8 = np.zeros(N8, dtype=np.int16)
+    for frame in range(FRAMES):
+        result48 = resampler.resample8_to_48(in8k[frame * N8 : (frame + 1) * N8], out=block48)
+        assert result48 is block48
+        assert np.array_equal(block48, out48k[frame * N48 : (frame + 1) * N48])
+
+        result8 = resampler.resample48_to_8(block48, out=block8)
+        assert result8 is block8
+        assert np.array_equal(block8, out8k[frame * N8 : (frame + 1) * N8])
+
+    # blocks larger than the configured blocksize grow the scratch buffers
+    assert len(resampler.resample8_to_48(in8k)) == len(out48k)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("blocksize", [48, 4800])
+def test_resampler_benchmark(blocksize):
+    """Throughput of 48 kHz -> 8 kHz, allocating the result or writing it into out="""
+    seconds = 60
+    in48k = np.zeros(blocksize, dtype=np.int16)
+    out8k = np.zeros(blocksize // FDMDV_OS_48, dtype=np.int16)
+    blocks = seconds * FS48 // blocksize
+    resampler = codec2.resampler(blocksize)
+
+    start = time.perf_counter()
+    for _ in range(blocks):
+        resampler.resample48_to_8(in48k)
+    allocating = seconds / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(blocks):
+        resampler.resample48_to_8(in48k, out=out8k)
+    preallocated = seconds / (time.perf_counter() - start)
+
+    print(
+        f"blocksize: {blocksize} real-time factor "
+        f"allocating: {allocating:.0f} out=: {preallocated:.0f}"
+    )
+    assert preallocated > 1
+
+
 if __name__ == "__main__":
     # Run pytest with the current script as the filename.
     ecode = pytest.main(["-v", sys.argv[0]])
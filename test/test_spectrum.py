@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the event driven spectrum engine of the waterfall and the busy detection
+
+# pylint: disable=invalid-name
+
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+import spectrum
+
+FS = 8000
+
+
+def tone(frequency, seconds, amplitude=8000):
+    t = np.arange(int(seconds * FS)) / FS
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.int16)
+
+
+def noise(seconds, rms=300, seed=0):
+    return np.random.default_rng(seed).normal(0, rms, int(seconds * FS)).astype(np.int16)
+
+
+def reference_spectrum(block):
+    """The former calculate_fft, float64 rfft of a whole block without window"""
+    fftarray = np.fft.rfft(block)
+    fftarray[fftarray == 0] = 1
+    return 10.0 * np.log10(abs(fftarray))
+
+
+def test_fixed_bins():
+    """A tone shows up in the bin of its frequency, on the same scale as before"""
+    engine = spectrum.SpectrumEngine()
+    engine.push(tone(1500, 0.5) + noise(0.5))
+    bins = engine.update()
+    assert bins.dtype == np.float32
+    assert len(bins) == spectrum.SPECTRUM_BINS
+    assert abs(int(np.argmax(bins)) - 150) <= 1
+
+    # the noise floor is where the waterfall and the busy detection thresholds expect it
+    reference = reference_spectrum(noise(0.1, seed=1))[: spectrum.SPECTRUM_BINS]
+    floor = spectrum.SpectrumEngine().compute(noise(0.2, seed=2)[: spectrum.FFT_SIZE])
+    assert abs(np.median(floor[10:]) - np.median(reference[10:])) < 1.5
+
+
+def test_event_driven():
+    """A spectrum is computed once enough new audio has arrived, no polling of stale samples"""
+    engine = spectrum.SpectrumEngine()
+    assert engine.update() is None
+    assert not engine.wait(0.01)
+
+    block = noise(0.05)
+    engine.push(block)
+    assert engine.update() is None
+    for _ in range(int(spectrum.FFT_SIZE / len(block)) + 2):
+        engine.push(block)
+    assert engine.wait(0)
+    assert engine.update() is not None
+    # nothing new, nothing to do
+    assert engine.update() is None
+    assert engine.spectra == 1
+
+    engine.reduced = True
+    for _ in range(int(spectrum.UPDATE_INTERVAL * FS / len(block))):
+        engine.push(block)
+    assert engine.update() is None
+    for _ in range(int((spectrum.REDUCED_INTERVAL - spectrum.UPDATE_INTERVAL) * FS / len(block))):
+        engine.push(block)
+    assert engine.update() is not None
+    assert engine.elapsed == pytest.approx(spectrum.REDUCED_INTERVAL)
+
+
+def test_peak():
+    engine = spectrum.SpectrumEngine()
+    audio = noise(1)
+    audio[-100] = -32768
+    engine.push(audio)
+    engine.update()
+    assert engine.peak == 32768
+
+
+def test_welch():
+    """Averaging over overlapping segments reduces the variance of the noise floor"""
+    audio = noise(2)
+    single = spectrum.SpectrumEngine()
+    welch = spectrum.SpectrumEngine(segments=7)
+    assert welch.length == spectrum.FFT_SIZE * 4
+    single.push(audio)
+    welch.push(audio)
+    assert np.std(welch.update()[10:]) < np.std(single.update()[10:]) / 2
+
+
+def test_threads():
+    """Audio threads push, the FFT thread is woken by them"""
+    engine = spectrum.SpectrumEngine()
+    spectra = []
+
+    def consumer():
+        while len(spectra) < 5:
+            if engine.wait(1.0):
+                bins = engine.update()
+                if bins is not None:
+                    spectra.append(bins)
+
+    thread = threading.Thread(target=consumer, daemon=True)
+    thread.start()
+    block = tone(1000, 0.05)
+    for _ in range(200):
+        engine.push(block)
+        if not thread.is_alive():
+            break
+        time.sleep(0.002)
+    thread.join(2)
+    assert len(spectra) == 5
+    assert all(abs(int(np.argmax(bins)) - 100) <= 1 for bins in spectra)
+
+
+def test_update_rate():
+    """Spectra are computed every UPDATE_INTERVAL of audio, or REDUCED_INTERVAL without clients"""
+    audio = noise(10) + tone(1500, 10)
+    block = FS // 10
+    engine = spectrum.SpectrumEngine()
+    reduced = spectrum.SpectrumEngine()
+    reduced.reduced = True
+    for position in range(0, len(audio), block):
+        for current in (engine, reduced):
+            current.push(audio[position : position + block])
+            current.update()
+
+    assert engine.spectra == pytest.approx(10 / spectrum.UPDATE_INTERVAL, abs=2)
+    assert reduced.spectra == pytest.approx(10 / spectrum.REDUCED_INTERVAL, abs=2)
+    assert engine.audio_time == pytest.approx(10, abs=2 * spectrum.UPDATE_INTERVAL)
+    stats = engine.stats()
+    assert stats["spectra"] == engine.spectra
+    assert stats["cpu_load"] == round(engine.cpu_load, 5)
+
+
+@pytest.mark.benchmark
+def test_spectrum_benchmark():
+    """CPU cost per second of audio of the spectrum engine against the former 10 ms polling loop"""
+    audio = noise(10) + tone(1500, 10)
+    block = FS // 10  # 800 samples at 8 kHz, a 4800 samples block of the 48 kHz audio device
+
+    start = time.thread_time()
+    for position in range(0, len(audio), block):
+        # the former loop analysed the latest block every 10 ms
+        for _ in range(10):
+            dfft = reference_spectrum(audio[position : position + block])
+            dfft.astype(int).tolist()
+    time_polling = time.thread_time() - start
+
+    engine = spectrum.SpectrumEngine()
+    start = time.thread_time()
+    for position in range(0, len(audio), block):
+        engine.push(audio[position : position + block])
+        if engine.wait(0):
+            bins = engine.update()
+            if bins is not None:
+                bins.astype(int).tolist()
+    time_engine = time.thread_time() - start
+
+    reduced = spectrum.SpectrumEngine()
+    reduced.reduced = True
+    for position in range(0, len(audio), block):
+        reduced.push(audio[position : position + block])
+        reduced.update()
+
+    print(
+        f"polling: {time_polling * 100:.2f} ms/s "
+        f"engine: {time_engine * 100:.2f} ms/s "
+        f"spectra: {engine.spectra} "
+        f"engine cpu load: {engine.cpu_load * 1000:.3f} ms/s "
+        f"reduced cpu load: {reduced.cpu_load * 1000:.3f} ms/s"
+    )
+    assert engine.spectra == pytest.approx(10 / spectrum.UPDATE_INTERVAL, abs=2)
+    assert reduced.spectra == pytest.approx(10 / spectrum.REDUCED_INTERVAL, abs=2)
+    assert engine.stats()["cpu_load"] == round(engine.cpu_load, 5)
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the per decoder modem telemetry
+
+# pylint: disable=invalid-name
+
+import ctypes
+import sys
+import time
+
+import codec2
+import demodulator
+import numpy as np
+import pytest
+import telemetry
+from test_codec2_bindings import DATAC13, generate_audio
+
+SYNC = codec2.api.FREEDV_RX_SYNC
+DECODED = codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BITS
+FAILED = codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BIT_ERRORS
+
+
+def sample(rx_status, snr=-5.0, foff=0.0):
+    return (time.monotonic(), rx_status, bool(rx_status & SYNC), snr, foff, 0.0, 0.0)
+
+
+def test_ring():
+    """The ring keeps the latest samples, pending() hands out every sample once"""
+    decoder = telemetry.DecoderTelemetry(size=8)
+    for index in range(5):
+        decoder.append(sample(SYNC, foff=index))
+    assert list(decoder.pending()["foff"]) == [0, 1, 2, 3, 4]
+    assert len(decoder.pending()) == 0
+
+    for index in range(5, 20):
+        decoder.append(sample(SYNC, foff=index))
+    assert list(decoder.window()["foff"]) == list(range(12, 20))
+    # only the latest `size` samples are left of what hasn't been sent yet
+    assert list(decoder.pending()["foff"]) == list(range(12, 20))
+
+    other = telemetry.DecoderTelemetry(size=8)
+    other.extend(decoder.window())
+    assert np.array_equal(other.window(), decoder.window())
+
+
+def test_aggregates():
+    decoder = telemetry.DecoderTelemetry()
+    assert decoder.aggregates() == {"samples": 0}
+    assert decoder.average_snr(3.0) == 3.0
+
+    for status, snr in [(0, -5), (SYNC, -5), (DECODED, 10), (0, -5), (SYNC, -5), (FAILED, 0), (DECODED, 2)]:
+        decoder.append(sample(status, snr=snr, foff=1.5))
+
+    aggregates = decoder.aggregates()
+    assert aggregates["samples"] == 7
+    assert aggregates["sync_ratio"] == round(5 / 7, 3)
+    assert aggregates["decoded"] == 2
+    assert aggregates["failed"] == 1
+    assert aggregates["decode_rate"] == round(2 / 3, 3)
+    assert aggregates["snr"] == 2
+    # the SNR codec2 reports without a decoded frame doesn't count
+    assert aggregates["snr_avg"] == 10 + telemetry.SNR_AVG_WEIGHT * (2 - 10)
+    assert decoder.average_snr(3.0) == aggregates["snr_avg"]
+    assert aggregates["foff"] == 1.5
+
+
+def test_demodulator_telemetry():
+    """A demodulator records every freedv_rawdatarx call"""
+    sent, audio = generate_audio(2)
+    store = codec2.shared_audio_buffer(len(audio))
+    demod = demodulator.Demodulator("sig0-datac13", DATAC13, store.reader(), [])
+    demod.audiobuffer.active = True
+    store.push(audio)
+
+    freedv = demod.acquire()
+    snr = []
+    result = codec2.demodulate(
+        freedv,
+        demod.audiobuffer.buffer[: demod.audiobuffer.nbuffer],
+        demod.nin,
+        demod.bytes_out,
+        lambda frame, _: snr.append((demod.telemetry.snr, demodulator.get_snr(freedv))),
+        demod.record_telemetry,
+    )
+    demod.release()
+
+    assert len(result.frames) == len(sent)
+    assert demod.telemetry.count == len(result.rx_status)
+    assert list(demod.telemetry.window()["rx_status"]) == result.rx_status[-telemetry.TELEMETRY_SIZE:]
+    # the telemetry of a frame is recorded before on_frame is called
+    assert [telemetry_snr for telemetry_snr, _ in snr] == [codec2_snr for _, codec2_snr in snr]
+
+    aggregates = demod.stats()["telemetry"]
+    assert aggregates["decoded"] == len(sent)
+    assert aggregates["failed"] == 0
+    assert aggregates["decode_rate"] == 1.0
+    assert 0 < aggregates["sync_ratio"] < 1
+    assert aggregates["snr_avg"] > 0
+
+
+@pytest.mark.benchmark
+def test_telemetry_benchmark():
+    """Micro-benchmark of the telemetry overhead per freedv_rawdatarx call"""
+    info = codec2.get_mode_info(DATAC13)
+    bytes_out = ctypes.create_string_buffer(info.bytes_per_frame)
+    audio = np.zeros(8000 * 10, dtype=np.int16)
+
+    freedv = codec2.open_instance(DATAC13)
+    start = time.perf_counter()
+    result = codec2.demodulate(freedv, audio, info.nin, bytes_out)
+    time_plain = time.perf_counter() - start
+    codec2.api.freedv_close(freedv)
+
+    demod = demodulator.Demodulator("sig0-datac13", DATAC13, None, [])
+    demod.freedv = freedv = codec2.open_instance(DATAC13)
+    start = time.perf_counter()
+    codec2.demodulate(freedv, audio, info.nin, bytes_out, on_rx=demod.record_telemetry)
+    time_telemetry = time.perf_counter() - start
+    codec2.api.freedv_close(freedv)
+
+    calls = len(result.rx_status)
+    print(
+        f"calls: {calls} "
+        f"without telemetry: {time_plain * 1000:.1f} ms "
+        f"with telemetry: {time_telemetry * 1000:.1f} ms "
+        f"per call: {(time_telemetry - time_plain) / calls * 1e6:.1f} us"
+    )
+    assert demod.telemetry.count == calls
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# tests the priority and deadline aware transmit queue
+
+# pylint: disable=invalid-name
+
+import queue
+import sys
+import threading
+import time
+
+import pytest
+from static import FRAME_TYPE
+import transmit_scheduler
+from transmit_scheduler import TX_PRIORITY, TransmitScheduler, get_priority
+
+SIG0 = 19
+
+
+def request(frametype, mode=SIG0):
+    return [mode, 1, 0, [bytearray([frametype.value, 0, 0])]]
+
+
+@pytest.mark.parametrize(
+    "frametype,priority",
+    [
+        (FRAME_TYPE.BURST_ACK, TX_PRIORITY.ACK_NACK),
+        (FRAME_TYPE.BURST_NACK, TX_PRIORITY.ACK_NACK),
+        (FRAME_TYPE.FR_REPEAT, TX_PRIORITY.ACK_NACK),
+        (FRAME_TYPE.BURST_01, TX_PRIORITY.ARQ_DATA),
+        (FRAME_TYPE.BURST_51, TX_PRIORITY.ARQ_DATA),
+        (FRAME_TYPE.ARQ_SESSION_OPEN, TX_PRIORITY.SESSION),
+        (FRAME_TYPE.PING, TX_PRIORITY.SESSION),
+        (FRAME_TYPE.FEC, TX_PRIORITY.FEC),
+        (FRAME_TYPE.MESH_BROADCAST, TX_PRIORITY.MESH),
+        (FRAME_TYPE.BEACON, TX_PRIORITY.BEACON),
+    ],
+)
+def test_get_priority(frametype, priority):
+    assert get_priority(SIG0, request(frametype)[3]) == priority
+
+
+def test_priority_order():
+    """ACK before data before beacon, FIFO within a class"""
+    scheduler = TransmitScheduler()
+    beacon = request(FRAME_TYPE.BEACON)
+    data = [request(FRAME_TYPE.BURST_01), request(FRAME_TYPE.BURST_02)]
+    ack = request(FRAME_TYPE.BURST_ACK)
+    for item in [beacon, data[0], data[1], ack]:
+        scheduler.put(item)
+    assert scheduler.qsize() == 4
+
+    assert [scheduler.get() for _ in range(4)] == [ack, data[0], data[1], beacon]
+    assert scheduler.empty()
+    with pytest.raises(queue.Empty):
+        scheduler.get(block=False)
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.01)
+
+
+def test_drop_stale():
+    """Requests past their deadline are handed to on_drop instead of returned"""
+    dropped = []
+    scheduler = TransmitScheduler(on_drop=dropped.append)
+    stale = request(FRAME_TYPE.BURST_ACK)
+    fresh = request(FRAME_TYPE.BEACON)
+    scheduler.put(stale, timeout=0.0)
+    scheduler.put(fresh)
+    time.sleep(0.01)
+
+    assert scheduler.get() is fresh
+    assert dropped == [stale]
+
+    statistics = scheduler.get_statistics()
+    assert statistics["ACK_NACK"]["dropped"] == 1
+    assert statistics["ACK_NACK"]["sent"] == 0
+    assert statistics["BEACON"]["sent"] == 1
+    assert statistics["BEACON"]["wait_max"] >= statistics["BEACON"]["wait_avg"] > 0
+
+
+def test_coalesce():
+    """Pending signalling requests of the same mode share a burst, data is sent on its own"""
+    scheduler = TransmitScheduler()
+    ack = request(FRAME_TYPE.BURST_ACK)
+    ident = request(FRAME_TYPE.IDENT)
+    other_mode = request(FRAME_TYPE.PING, mode=SIG0 + 1)
+    data = request(FRAME_TYPE.BURST_01)
+    repeated = [SIG0, 3, 0, request(FRAME_TYPE.PING)[3]]
+    for item in [data, other_mode, ident, repeated, ack]:
+        scheduler.put(item)
+
+    assert scheduler.get_burst() == [ack, ident]
+    assert scheduler.get_burst() == [data]
+    assert scheduler.get_burst() == [other_mode]
+    assert scheduler.get_burst() == [repeated]
+    assert scheduler.empty()
+
+    statistics = scheduler.get_statistics()
+    assert statistics["SESSION"]["coalesced"] == 1
+    assert statistics["SESSION"]["sent"] == 3
+
+
+def test_coalesce_max_frames():
+    scheduler = TransmitScheduler()
+    pings = [request(FRAME_TYPE.PING) for _ in range(transmit_scheduler.COALESCE_MAX_FRAMES + 1)]
+    for item in pings:
+        scheduler.put(item)
+
+    assert scheduler.get_burst() == pings[:-1]
+    assert scheduler.get_burst() == pings[-1:]
+
+
+def test_coalesce_hold_time():
+    """Mesh requests wait up to their hold time for more requests"""
+    scheduler = TransmitScheduler()
+    first = request(FRAME_TYPE.MESH_SIGNALLING_PING)
+    second = request(FRAME_TYPE.MESH_SIGNALLING_PING_ACK)
+    scheduler.put(first)
+    timer = threading.Timer(0.05, scheduler.put, args=(second,))
+    timer.start()
+
+    start = time.time()
+    assert scheduler.get_burst() == [first, second]
+    assert time.time() - start < transmit_scheduler.COALESCE_HOLD_TIMES[TX_PRIORITY.MESH] + 0.5
+    timer.join()
+
+
+def test_ack_ends_hold():
+    """An ACK queued while a mesh request is held ends the hold and leads the burst"""
+    scheduler = TransmitScheduler()
+    mesh = request(FRAME_TYPE.MESH_BROADCAST)
+    ack = request(FRAME_TYPE.BURST_ACK)
+    scheduler.put(mesh)
+    timer = threading.Timer(0.05, scheduler.put, args=(ack,))
+    timer.start()
+
+    start = time.time()
+    # the held request may follow the ACK, but never goes before it
+    assert scheduler.get_burst() == [ack, mesh]
+    assert time.time() - start < transmit_scheduler.COALESCE_HOLD_TIMES[TX_PRIORITY.MESH]
+    assert scheduler.empty()
+    timer.join()
+
+    statistics = scheduler.get_statistics()
+    assert statistics["ACK_NACK"]["sent"] == 1
+    assert statistics["MESH"]["sent"] == 1
+    assert statistics["MESH"]["coalesced"] == 1
+
+
+def test_coalesce_priority():
+    """Requests of a higher priority than the next one are not coalesced behind it"""
+    scheduler = TransmitScheduler()
+    mesh = request(FRAME_TYPE.MESH_BROADCAST)
+    ident = request(FRAME_TYPE.IDENT)
+    ack = request(FRAME_TYPE.BURST_ACK)
+    scheduler.put(mesh)
+    entry = scheduler._get(True, None)
+    scheduler.put(ident)
+    scheduler.put(ack)
+    # the higher priority requests came in between, the held one is put back
+    assert scheduler._hold_burst(entry) == []
+    assert scheduler.get_burst() == [ack, ident, mesh]
+
+
+def test_wakeup():
+    """A blocking get returns as soon as a request is put"""
+    scheduler = TransmitScheduler()
+    item = request(FRAME_TYPE.BURST_ACK)
+    timer = threading.Timer(0.05, scheduler.put, args=(item,))
+    timer.start()
+    assert scheduler.get(timeout=5) is item
+    timer.join()
+
+
+if __name__ == "__main__":
+    # Run pytest with the current script as the filename.
+    ecode = pytest.main(["-v", sys.argv[0]])
+    if ecode == 0:
+        print("errors: 0")
+    else:
+        print(ecode)
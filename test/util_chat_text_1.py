@@ -131,7 +131,7 @@ def t_highsnr_arq_short_station1(
         # original function captured before this one was put in place.
         orig_tx_func(self, mode, repeats, repeat_delay, frames)  # type: ignore
 
-    def t_process_data(self, bytes_out, freedv, bytes_per_frame: int):
+    def t_process_data(self, bytes_out, mode_name, bytes_per_frame: int, snr=None, telemetry=None):
         """'Wrap' DATA.process_data function to extract the arguments."""
         nonlocal orig_rx_func, parent_pipe
 
@@ -147,7 +147,7 @@ def t_highsnr_arq_short_station1(
 
         # Apologies for the Python "magic." "orig_func" is a pointer to the
         # original function captured before this one was put in place.
-        orig_rx_func(self, bytes_out, freedv, bytes_per_frame)  # type: ignore
+        orig_rx_func(self, bytes_out, mode_name, bytes_per_frame, snr, telemetry)  # type: ignore
 
     tnc, orig_rx_func, orig_tx_func = t_setup(
         mycall, dxcall, lowbwmode, t_transmit, t_process_data, tmp_path
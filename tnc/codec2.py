@@ -7,11 +7,16 @@ Python interface to the C-language codec2 library.
 # pylint: disable=import-outside-toplevel, attribute-defined-outside-init
 
 import ctypes
+import ctypes.util
 import glob
+import importlib
+import multiprocessing
 import os
 import sys
+import threading
+import time
+from dataclasses import dataclass
 from enum import Enum
-from threading import Lock
 
 import numpy as np
 import structlog
@@ -84,92 +89,277 @@ def freedv_get_mode_name_by_value(mode: int) -> str:
 #else:
 sys.path.append(os.path.abspath("."))
 
-log.info("[C2 ] Searching for libcodec2...")
-if sys.platform == "linux":
-    files = glob.glob(r"**/*libcodec2*", recursive=True)
-    files.append("libcodec2.so")
-elif sys.platform == "darwin":
-    if hasattr(sys, "_MEIPASS"):
-        files = glob.glob(getattr(sys, "_MEIPASS") + '/**/*libcodec2*', recursive=True)
-    else:
-        files = glob.glob(r"**/*libcodec2*.dylib", recursive=True)
+# libcodec2 is looked up on first use of `api`, in this order:
+# set_library_path(), e.g. from the config, the FREEDATA_LIBCODEC2 environment
+# variable, the path found by the last search, the pyinstaller bundle, the
+# standard loader paths and finally a recursive search in the working directory.
+LIBRARY_PATH_ENV = "FREEDATA_LIBCODEC2"
+
+if sys.platform == "darwin":
+    LIBRARY_PATTERN = "*libcodec2*.dylib"
+    LIBRARY_NAMES = ["libcodec2.dylib", "libcodec2.1.2.dylib", "libcodec2.1.1.dylib"]
 elif sys.platform in ["win32", "win64"]:
-    files = glob.glob(r"**\*libcodec2*.dll", recursive=True)
+    LIBRARY_PATTERN = "*libcodec2*.dll"
+    LIBRARY_NAMES = ["libcodec2.dll"]
 else:
-    files = []
+    LIBRARY_PATTERN = "*libcodec2*"
+    LIBRARY_NAMES = ["libcodec2.so", "libcodec2.so.1.2", "libcodec2.so.1.1"]
 
-api = None
-for file in files:
-    try:
-        api = ctypes.CDLL(file)
-        log.info("[C2 ] Libcodec2 loaded", path=file)
-        break
-    except OSError as err:
-        log.warning("[C2 ] Libcodec2 found but not loaded", path=file, e=err)
 
-# Quit module if codec2 cant be loaded
-if api is None or "api" not in locals():
-    log.critical("[C2 ] Libcodec2 not loaded - Exiting")
-    sys.exit(1)
+# The modem backend behind `api` is libcodec2 or a module implementing the functions
+# of PROTOTYPES with the same arguments, selected with set_backend() or the
+# FREEDATA_MODEM_BACKEND environment variable. "numpy" is a stand-in for running
+# the TNC, its tests and benchmarks without libcodec2, see codec2_numpy.py.
+BACKEND_ENV = "FREEDATA_MODEM_BACKEND"
+BACKENDS = {"libcodec2": None, "numpy": "codec2_numpy"}
+
+
+class LibraryNotFound(OSError):
+    """Raised on first use of the codec2 api if libcodec2 can't be loaded"""
+
+
+_library = None
+_library_path = None
+_library_lock = threading.Lock()
+# seconds spent searching and loading libcodec2
+library_load_time = 0.0
+
+
+def set_library_path(path: str) -> None:
+    """
+    Use libcodec2 from `path`, has to be called before the api is used
+
+    Args:
+        path: path of the shared library
+    """
+    global _library_path
+    _library_path = path
+
+
+def set_backend(name: str) -> None:
+    """
+    Use the modem backend `name`, has to be called before the api is used
+
+    The backend is exported with BACKEND_ENV, so our child processes use it as well.
+
+    Args:
+        name: one of BACKENDS
+
+    Raises:
+        ValueError: unknown backend
+        RuntimeError: another backend is already loaded
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"unknown modem backend {name}, use one of {', '.join(BACKENDS)}")
+    if _library is not None and name != get_backend():
+        raise RuntimeError(f"modem backend {get_backend()} is already loaded")
+    os.environ[BACKEND_ENV] = name
 
-# ctypes function init
 
-# api.freedv_set_tuning_range.restype = ctypes.c_int
-# api.freedv_set_tuning_range.argype = [ctypes.c_void_p, ctypes.c_float, ctypes.c_float]
+def get_backend() -> str:
+    """Return the name of the modem backend, libcodec2 if not set"""
+    return os.getenv(BACKEND_ENV) or "libcodec2"
 
-api.freedv_open.argype = [ctypes.c_int]  # type: ignore
-api.freedv_open.restype = ctypes.c_void_p
 
-api.freedv_set_sync.argype = [ctypes.c_void_p, ctypes.c_int]  # type: ignore
-api.freedv_set_sync.restype = ctypes.c_void_p
+def get_library_cache_file() -> str:
+    """Return the file which remembers the libcodec2 found by the recursive search"""
+    if sys.platform in ["win32", "win64"]:
+        cache = os.getenv("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        cache = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        cache = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache, "FreeDATA", "libcodec2_path")
+
+
+def library_candidates():
+    """
+    Yield (source, path) of the libraries to try, cheapest first
+
+    The recursive search is only done if all others failed.
+    """
+    if _library_path:
+        yield "config", _library_path
+    if os.getenv(LIBRARY_PATH_ENV):
+        yield "environment", os.getenv(LIBRARY_PATH_ENV)
+    try:
+        with open(get_library_cache_file(), encoding="utf-8") as cache:
+            cached = cache.read().strip()
+    except OSError:
+        cached = ""
+    if cached:
+        yield "cache", cached
+    if hasattr(sys, "_MEIPASS"):
+        for file in glob.glob(os.path.join(getattr(sys, "_MEIPASS"), "**", LIBRARY_PATTERN), recursive=True):
+            yield "bundle", file
+    for name in LIBRARY_NAMES:
+        yield "loader", name
+    name = ctypes.util.find_library("codec2")
+    if name:
+        yield "loader", name
+    log.info("[C2 ] Searching for libcodec2...", path=os.path.abspath("."))
+    for file in glob.glob(os.path.join("**", LIBRARY_PATTERN), recursive=True):
+        yield "search", file
+
+
+def remember_library_path(path: str) -> None:
+    """Save the path found by the recursive search for the next start"""
+    cache_file = get_library_cache_file()
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w", encoding="utf-8") as cache:
+            cache.write(path)
+    except OSError as err:
+        log.warning("[C2 ] Can't remember libcodec2 path", file=cache_file, e=err)
+
+
+def load_library() -> ctypes.CDLL:
+    """
+    Find and load libcodec2 and set the prototypes of its functions
 
-api.freedv_open_advanced.argtype = [ctypes.c_int, ctypes.c_void_p]  # type: ignore
-api.freedv_open_advanced.restype = ctypes.c_void_p
+    Done once, on first use of `api`. The path is exported with LIBRARY_PATH_ENV,
+    so our child processes don't have to search it again.
 
-api.freedv_get_bits_per_modem_frame.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_bits_per_modem_frame.restype = ctypes.c_int
+    Returns:
+        ctypes.CDLL
 
-api.freedv_get_modem_extended_stats.argtype = [ctypes.c_void_p, ctypes.c_void_p]
-api.freedv_get_modem_extended_stats.restype = ctypes.c_int
+    Raises:
+        LibraryNotFound: no usable libcodec2
+    """
+    global _library, library_load_time
+    with _library_lock:
+        if _library is not None:
+            return _library
+
+        start = time.perf_counter()
+        for source, path in library_candidates():
+            try:
+                library = ctypes.CDLL(path)
+                set_prototypes(library)
+            except (OSError, AttributeError) as err:
+                # the standard names are only a guess, don't bother with a warning
+                if source != "loader":
+                    log.warning("[C2 ] Libcodec2 found but not loaded", path=path, e=err)
+                continue
+
+            library_load_time = time.perf_counter() - start
+            log.info(
+                "[C2 ] Libcodec2 loaded", path=path, source=source,
+                load_time=round(library_load_time * 1000, 2),
+            )
+            if os.path.dirname(path):
+                # keep the bare names of the loader, they aren't relative to our directory
+                path = os.path.abspath(path)
+            os.environ[LIBRARY_PATH_ENV] = path
+            if source == "search":
+                remember_library_path(path)
+            _library = library
+            return library
+
+        log.critical("[C2 ] Libcodec2 not loaded")
+        raise LibraryNotFound("libcodec2 not found, set its path with " + LIBRARY_PATH_ENV)
+
+
+def load_backend():
+    """
+    Load the modem backend, see set_backend()
 
-api.freedv_nin.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_nin.restype = ctypes.c_int
+    Done once, on first use of `api`.
 
-api.freedv_rawdatarx.argtype = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]  # type: ignore
-api.freedv_rawdatarx.restype = ctypes.c_int
+    Returns:
+        ctypes.CDLL of libcodec2 or the module of the backend
 
-api.freedv_rawdatatx.argtype = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]  # type: ignore
-api.freedv_rawdatatx.restype = ctypes.c_int
+    Raises:
+        LibraryNotFound: unknown backend or no usable libcodec2
+    """
+    global _library, library_load_time
+    backend = get_backend()
+    if backend == "libcodec2":
+        return load_library()
+    if backend not in BACKENDS:
+        raise LibraryNotFound(f"unknown modem backend {backend}, set with {BACKEND_ENV}")
+
+    with _library_lock:
+        if _library is None:
+            start = time.perf_counter()
+            _library = importlib.import_module(BACKENDS[backend])
+            library_load_time = time.perf_counter() - start
+            log.info(
+                "[C2 ] Modem backend loaded", backend=backend,
+                load_time=round(library_load_time * 1000, 2),
+            )
+        return _library
+
+
+class codec2_api:
+    """
+    libcodec2 or another modem backend, loaded on first access of one of its functions
 
-api.freedv_rawdatapostambletx.argtype = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]  # type: ignore
-api.freedv_rawdatapostambletx.restype = ctypes.c_int
+    Functions are cached as attributes after the first lookup. Constants
+    like FDMDV_OS_48 are plain attributes and don't load the library.
+    """
 
-api.freedv_rawdatapreambletx.argtype = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]  # type: ignore
-api.freedv_rawdatapreambletx.restype = ctypes.c_int
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        function = getattr(load_backend(), name)
+        setattr(self, name, function)
+        return function
 
-api.freedv_get_n_max_modem_samples.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_n_max_modem_samples.restype = ctypes.c_int
 
-api.freedv_set_frames_per_burst.argtype = [ctypes.c_void_p, ctypes.c_int]  # type: ignore
-api.freedv_set_frames_per_burst.restype = ctypes.c_void_p
+api = codec2_api()
 
-api.freedv_get_rx_status.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_rx_status.restype = ctypes.c_int
+# ctypes function init
 
-api.freedv_get_modem_stats.argtype = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]  # type: ignore
-api.freedv_get_modem_stats.restype = ctypes.c_int
+# Prototypes of the codec2 functions we are using, as name: (restype, argtypes).
+# Buffers are passed as c_void_p, which takes numpy .ctypes, .ctypes.data addresses,
+# ctypes arrays, bytes and byref() without copying them.
+PROTOTYPES = {
+    "freedv_open": (ctypes.c_void_p, [ctypes.c_int]),
+    "freedv_open_advanced": (ctypes.c_void_p, [ctypes.c_int, ctypes.c_void_p]),
+    "freedv_close": (None, [ctypes.c_void_p]),
+    "freedv_set_sync": (None, [ctypes.c_void_p, ctypes.c_int]),
+    "freedv_set_frames_per_burst": (None, [ctypes.c_void_p, ctypes.c_int]),
+    "freedv_set_tuning_range": (None, [ctypes.c_void_p, ctypes.c_float, ctypes.c_float]),
+    "freedv_get_bits_per_modem_frame": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_modem_stats": (None, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_get_modem_extended_stats": (None, [ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_get_rx_status": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_nin": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_rawdatarx": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_rawdatatx": (None, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_rawdatapreambletx": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_rawdatapostambletx": (ctypes.c_int, [ctypes.c_void_p, ctypes.c_void_p]),
+    "freedv_gen_crc16": (ctypes.c_ushort, [ctypes.c_void_p, ctypes.c_int]),
+    "freedv_get_n_max_modem_samples": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_n_nom_modem_samples": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_n_tx_modem_samples": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_n_tx_preamble_modem_samples": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_n_tx_postamble_modem_samples": (ctypes.c_int, [ctypes.c_void_p]),
+    "freedv_get_modem_sample_rate": (ctypes.c_int, [ctypes.c_void_p]),
+    "fdmdv_8_to_48_short": (None, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]),
+    "fdmdv_48_to_8_short": (None, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]),
+}
+
+
+def set_prototypes(library: ctypes.CDLL) -> None:
+    """
+    Set restype and argtypes of the functions in PROTOTYPES
 
-api.freedv_get_n_tx_postamble_modem_samples.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_n_tx_postamble_modem_samples.restype = ctypes.c_int
+    ctypes caches the function pointers as attributes of the library,
+    so the lookup is done only once.
 
-api.freedv_get_n_tx_preamble_modem_samples.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_n_tx_preamble_modem_samples.restype = ctypes.c_int
+    Args:
+        library: loaded libcodec2
 
-api.freedv_get_n_tx_modem_samples.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_n_tx_modem_samples.restype = ctypes.c_int
+    Raises:
+        AttributeError: a function is missing in the library
+    """
+    for name, (restype, argtypes) in PROTOTYPES.items():
+        function = getattr(library, name)
+        function.restype = restype
+        function.argtypes = argtypes
 
-api.freedv_get_n_max_modem_samples.argtype = [ctypes.c_void_p]  # type: ignore
-api.freedv_get_n_max_modem_samples.restype = ctypes.c_int
 
 api.FREEDV_FS_8000 = 8000  # type: ignore
 
@@ -232,9 +422,324 @@ api.FREEDV_MODE_FSK_LDPC_1_ADV.first_tone = 1150  # 1250 4fsk, 1500 2fsk
 api.FREEDV_MODE_FSK_LDPC_1_ADV.tone_spacing = 200
 api.FREEDV_MODE_FSK_LDPC_1_ADV.codename = "H_4096_8192_3d".encode("utf-8")  # code word
 
+def open_instance(mode: int) -> ctypes.c_void_p:
+    """
+    Return a codec2 instance of the type `mode`
+
+    :param mode: Type of codec2 instance to return
+    :type mode: int
+    :return: C-function of the requested codec2 instance
+    :rtype: ctypes.c_void_p
+    """
+    if mode in [FREEDV_MODE.fsk_ldpc_0.value]:
+        return ctypes.cast(
+            api.freedv_open_advanced(
+                FREEDV_MODE.fsk_ldpc.value,
+                ctypes.byref(api.FREEDV_MODE_FSK_LDPC_0_ADV),
+            ),
+            ctypes.c_void_p,
+        )
+
+    if mode in [FREEDV_MODE.fsk_ldpc_1.value]:
+        return ctypes.cast(
+            api.freedv_open_advanced(
+                FREEDV_MODE.fsk_ldpc.value,
+                ctypes.byref(api.FREEDV_MODE_FSK_LDPC_1_ADV),
+            ),
+            ctypes.c_void_p,
+        )
+
+    return ctypes.cast(api.freedv_open(mode), ctypes.c_void_p)
+
+
+@dataclass(frozen=True)
+class mode_info:
+    """Static parameters of a codec2 mode"""
+
+    mode: int
+    bytes_per_frame: int
+    payload_per_frame: int  # bytes per frame without crc16
+    n_tx_modem_samples: int
+    n_tx_preamble_modem_samples: int
+    n_tx_postamble_modem_samples: int
+    n_nom_modem_samples: int
+    n_max_modem_samples: int
+    nin: int  # initial number of samples the demodulator is expecting
+    modem_sample_rate: int
+    frame_duration: float  # seconds of a single frame without preamble and postamble
+    burst_duration: float  # seconds of a single frame with preamble and postamble
+
+
+_mode_info_cache = {}
+_mode_info_lock = threading.Lock()
+
+
+def get_mode_info(mode: int) -> mode_info:
+    """
+    Return the parameters of a codec2 mode
+
+    The parameters are read once from a temporary codec2 instance and cached,
+    so further lookups don't need to open a codec2 instance.
+
+    :param mode: codec2 mode
+    :type mode: int
+    :return: parameters of the mode
+    :rtype: mode_info
+    """
+    info = _mode_info_cache.get(mode)
+    if info is not None:
+        return info
+
+    with _mode_info_lock:
+        if mode in _mode_info_cache:
+            return _mode_info_cache[mode]
+
+        freedv = open_instance(mode)
+        try:
+            bytes_per_frame = int(api.freedv_get_bits_per_modem_frame(freedv) / 8)
+            n_tx_modem_samples = api.freedv_get_n_tx_modem_samples(freedv)
+            n_tx_preamble_modem_samples = api.freedv_get_n_tx_preamble_modem_samples(freedv)
+            n_tx_postamble_modem_samples = api.freedv_get_n_tx_postamble_modem_samples(freedv)
+            modem_sample_rate = api.freedv_get_modem_sample_rate(freedv)
+            info = mode_info(
+                mode=mode,
+                bytes_per_frame=bytes_per_frame,
+                payload_per_frame=bytes_per_frame - 2,
+                n_tx_modem_samples=n_tx_modem_samples,
+                n_tx_preamble_modem_samples=n_tx_preamble_modem_samples,
+                n_tx_postamble_modem_samples=n_tx_postamble_modem_samples,
+                n_nom_modem_samples=api.freedv_get_n_nom_modem_samples(freedv),
+                n_max_modem_samples=api.freedv_get_n_max_modem_samples(freedv),
+                nin=api.freedv_nin(freedv),
+                modem_sample_rate=modem_sample_rate,
+                frame_duration=n_tx_modem_samples / modem_sample_rate,
+                burst_duration=(
+                    n_tx_preamble_modem_samples + n_tx_modem_samples + n_tx_postamble_modem_samples
+                ) / modem_sample_rate,
+            )
+        finally:
+            api.freedv_close(freedv)
+
+        _mode_info_cache[mode] = info
+        return info
+
+
+# codec2 fsk preamble and postamble may be broken - at least it sounds
+# like that, so we are disabling them for testing
+MODES_WITHOUT_PREAMBLE = [FREEDV_MODE.fsk_ldpc_0.value, FREEDV_MODE.fsk_ldpc_1.value]
+
+
+def get_burst_length(
+    mode: int, nframes: int, repeats: int = 1, repeat_delay: int = 0, tx_delay: int = 0
+) -> int:
+    """
+    Return the number of 8 kHz samples of a burst as built by `modulate`
+
+    :param mode: codec2 mode
+    :type mode: int
+    :param nframes: frames per repeat
+    :type nframes: int
+    :param repeats: number of repeats
+    :type repeats: int
+    :param repeat_delay: samples of silence after every repeat
+    :type repeat_delay: int
+    :param tx_delay: samples of silence before the first frame
+    :type tx_delay: int
+    :return: number of samples
+    :rtype: int
+    """
+    info = get_mode_info(mode)
+    frame_length = info.n_tx_modem_samples
+    if mode not in MODES_WITHOUT_PREAMBLE:
+        frame_length += info.n_tx_preamble_modem_samples + info.n_tx_postamble_modem_samples
+    return tx_delay + repeats * (nframes * frame_length + repeat_delay)
+
+
+def modulate(
+    freedv, mode: int, frames: list, repeats: int = 1, repeat_delay: int = 0, tx_delay: int = 0
+) -> np.ndarray:
+    """
+    Modulate `frames` with preamble, CRC16 and postamble, `repeats` times
+
+    The modulator writes straight into one array of the exact burst length.
+
+    :param freedv: codec2 instance of `mode`
+    :type freedv: ctypes.c_void_p
+    :param mode: codec2 mode
+    :type mode: int
+    :param frames: payloads, zero padded or cut to the payload size of the mode
+    :type frames: list
+    :param repeats: number of repeats
+    :type repeats: int
+    :param repeat_delay: samples of silence after every repeat
+    :type repeat_delay: int
+    :param tx_delay: samples of silence before the first frame
+    :type tx_delay: int
+    :return: modulated burst at 8 kHz
+    :rtype: np.ndarray
+    """
+    txbuffer = np.zeros(
+        get_burst_length(mode, len(frames), repeats, repeat_delay, tx_delay), dtype=np.int16
+    )
+    for _ in modulate_into(txbuffer, freedv, mode, frames, repeats, repeat_delay, tx_delay):
+        pass
+    return txbuffer
+
+
+def modulate_into(
+    txbuffer: np.ndarray,
+    freedv,
+    mode: int,
+    frames: list,
+    repeats: int = 1,
+    repeat_delay: int = 0,
+    tx_delay: int = 0,
+):
+    """
+    Modulate a burst frame by frame into `txbuffer`, for streaming it while it is modulated
+
+    Preamble, frames and postamble are modulated in order by the same
+    instance, as the codec2 tx filter runs across them. Silence is not
+    written, `txbuffer` has to be zeroed and `get_burst_length` samples long.
+
+    :param txbuffer: np.int16 zeros to modulate into
+    :type txbuffer: np.ndarray
+    :param freedv: codec2 instance of `mode`
+    :type freedv: ctypes.c_void_p
+    :param mode: codec2 mode
+    :type mode: int
+    :param frames: payloads, zero padded or cut to the payload size of the mode
+    :type frames: list
+    :param repeats: number of repeats
+    :type repeats: int
+    :param repeat_delay: samples of silence after every repeat
+    :type repeat_delay: int
+    :param tx_delay: samples of silence before the first frame
+    :type tx_delay: int
+    :return: generator yielding the number of samples of `txbuffer` which are ready,
+        after every frame and finally len(txbuffer)
+    """
+    info = get_mode_info(mode)
+    payload_per_frame = info.payload_per_frame
+    with_preamble = mode not in MODES_WITHOUT_PREAMBLE
+
+    position = tx_delay
+    ready = -1
+    for _ in range(repeats):
+        for frame in frames:
+            if with_preamble:
+                api.freedv_rawdatapreambletx(freedv, txbuffer[position:].ctypes)
+                position += info.n_tx_preamble_modem_samples
+
+            buffer = bytes(frame[:payload_per_frame]).ljust(payload_per_frame, b"\x00")
+            # Use the crc function shipped with codec2 to avoid CRC algorithm incompatibilities
+            crc = ctypes.c_ushort(api.freedv_gen_crc16(buffer, payload_per_frame))
+            data = (ctypes.c_ubyte * info.bytes_per_frame).from_buffer_copy(
+                buffer + crc.value.to_bytes(2, byteorder="big")
+            )
+            api.freedv_rawdatatx(freedv, txbuffer[position:].ctypes, data)
+            position += info.n_tx_modem_samples
+
+            if with_preamble:
+                api.freedv_rawdatapostambletx(freedv, txbuffer[position:].ctypes)
+                position += info.n_tx_postamble_modem_samples
+
+            ready = position
+            yield ready
+
+        # silence is already in place
+        position += repeat_delay
+
+    # trailing repeat delay
+    if position != ready:
+        yield position
+
+
+_silence_cache = {}
+
+
+def get_silence(nsamples: int) -> np.ndarray:
+    """
+    Return `nsamples` of silence, cached by length
+
+    :param nsamples: number of samples
+    :type nsamples: int
+    :return: read-only np.int16 zeros
+    :rtype: np.ndarray
+    """
+    silence = _silence_cache.get(nsamples)
+    if silence is None:
+        silence = np.zeros(nsamples, dtype=np.int16)
+        silence.flags.writeable = False
+        _silence_cache[nsamples] = silence
+    return silence
+
+
+@dataclass
+class demodulate_result:
+    """Result of demodulate()"""
+
+    frames: list  # decoded frames as bytes
+    rx_status: list  # rx status after every freedv_rawdatarx call
+    nsamples: int  # number of samples demodulated, to be popped by the caller
+    nin: int  # number of samples the demodulator expects next
+
+
+def demodulate(
+        freedv, samples: np.ndarray, nin: int, bytes_out, on_frame=None, on_rx=None
+) -> demodulate_result:
+    """
+    Demodulate all complete chunks of `samples` in one call
+
+    Loops freedv_rawdatarx and freedv_nin until less than `nin` samples are
+    left. The samples are passed to codec2 by address, without copying them.
+
+    :param freedv: codec2 instance
+    :type freedv: ctypes.c_void_p
+    :param samples: contiguous np.int16 audio at 8 kHz, e.g. audio_buffer_reader.buffer[:nbuffer]
+    :type samples: np.ndarray
+    :param nin: number of samples the demodulator expects first
+    :type nin: int
+    :param bytes_out: buffer of bytes_per_frame bytes for the decoded frame
+    :type bytes_out: ctypes.Array
+    :param on_frame: called with every decoded frame and the number of samples demodulated
+        up to its end, while the modem stats of the codec2 instance still belong to the frame
+    :type on_frame: callable
+    :param on_rx: called with the rx status after every freedv_rawdatarx call, before on_frame
+    :type on_rx: callable
+    :return: decoded frames, rx states, consumed samples and next nin
+    :rtype: demodulate_result
+    """
+    assert samples.dtype == np.int16 and samples.flags.c_contiguous
+    rawdatarx = api.freedv_rawdatarx
+    get_rx_status = api.freedv_get_rx_status
+    freedv_nin = api.freedv_nin
+    bytes_per_frame = len(bytes_out)
+
+    address = samples.ctypes.data
+    available = len(samples)
+    frames = []
+    rx_status = []
+    position = 0
+    while available - position >= nin:
+        nbytes = rawdatarx(freedv, bytes_out, address + 2 * position)
+        status = get_rx_status(freedv)
+        rx_status.append(status)
+        if on_rx is not None:
+            on_rx(status)
+        position += nin
+        nin = freedv_nin(freedv)
+        if nbytes == bytes_per_frame:
+            frame = bytes(bytes_out)
+            frames.append(frame)
+            if on_frame is not None:
+                on_frame(frame, position)
+    return demodulate_result(frames, rx_status, position, nin)
+
+
 # ------- MODEM STATS STRUCTURES
-MODEM_STATS_NC_MAX = 50 + 1 * 2
-MODEM_STATS_NR_MAX = 320 * 2
+MODEM_STATS_NC_MAX = 50
+MODEM_STATS_NR_MAX = 320
 MODEM_STATS_ET_MAX = 8
 MODEM_STATS_EYE_IND_MAX = 160
 MODEM_STATS_NSPEC = 512
@@ -243,12 +748,13 @@ MODEM_STATS_MAX_F_EST = 4
 
 
 class MODEMSTATS(ctypes.Structure):
-    """Modem statistics structure"""
+    """Modem statistics structure, struct MODEM_STATS of modem_stats.h"""
 
     _fields_ = [
         ("Nc", ctypes.c_int),
         ("snr_est", ctypes.c_float),
-        ("rx_symbols", (ctypes.c_float * MODEM_STATS_NR_MAX) * MODEM_STATS_NC_MAX),
+        # COMP rx_symbols[MODEM_STATS_NR_MAX][MODEM_STATS_NC_MAX + 1]
+        ("rx_symbols", ((ctypes.c_float * 2) * (MODEM_STATS_NC_MAX + 1)) * MODEM_STATS_NR_MAX),
         ("nr", ctypes.c_int),
         ("sync", ctypes.c_int),
         ("foff", ctypes.c_float),
@@ -258,7 +764,7 @@ class MODEMSTATS(ctypes.Structure):
         ("pre", ctypes.c_int),
         ("post", ctypes.c_int),
         ("uw_fails", ctypes.c_int),
-        ("rx_eye", (ctypes.c_float * MODEM_STATS_ET_MAX) * MODEM_STATS_EYE_IND_MAX),
+        ("rx_eye", (ctypes.c_float * MODEM_STATS_EYE_IND_MAX) * MODEM_STATS_ET_MAX),
         ("neyetr", ctypes.c_int),  # How many eye traces are plotted
         ("neyesamp", ctypes.c_int),  # How many samples in the eye diagram
         ("f_est", (ctypes.c_float * MODEM_STATS_MAX_F_EST)),
@@ -267,6 +773,71 @@ class MODEMSTATS(ctypes.Structure):
     ]
 
 
+# scatter plots with less points are sent completely, others only every SCATTER_DECIMATION point
+SCATTER_MAX_POINTS = 150
+SCATTER_DECIMATION = 10
+
+
+class modem_stats:
+    """
+    Extended modem stats of a codec2 instance, reused for every query
+
+    The arrays of the MODEMSTATS structure are exposed as numpy views,
+    so reading them doesn't copy or convert anything.
+    """
+
+    def __init__(self):
+        self.stats = MODEMSTATS()
+        self._stats_ref = ctypes.byref(self.stats)
+        # complex symbols as [row, carrier, (real, imag)]
+        self.rx_symbols = np.ctypeslib.as_array(self.stats.rx_symbols)
+        # eye diagram traces as [trace, sample]
+        self.rx_eye = np.ctypeslib.as_array(self.stats.rx_eye)
+        self.f_est = np.ctypeslib.as_array(self.stats.f_est)
+
+    def update(self, freedv) -> "modem_stats":
+        """
+        Read the current stats of `freedv`
+
+        :param freedv: codec2 instance
+        :type freedv: ctypes.c_void_p
+        :return: self
+        :rtype: modem_stats
+        """
+        api.freedv_get_modem_extended_stats(freedv, self._stats_ref)
+        return self
+
+    @property
+    def foff(self) -> float:
+        """Frequency offset of the received signal in Hz"""
+        return self.stats.foff
+
+    def scatter(self) -> np.ndarray:
+        """
+        Received symbols for the scatter plot, decimated
+
+        Symbols are scaled down by 1000, symbols on an axis are skipped.
+
+        :return: np.int16 array of [x, y] points
+        :rtype: np.ndarray
+        """
+        points = self.rx_symbols.reshape(-1, 2)
+        points = points[np.isfinite(points).all(axis=1)] // 1000
+        points = points[(points != 0).all(axis=1)]
+        if len(points) >= SCATTER_MAX_POINTS:
+            points = points[::SCATTER_DECIMATION]
+        return np.clip(points, -32768, 32767).astype(np.int16)
+
+    def eye(self) -> np.ndarray:
+        """
+        Eye diagram traces of the last demodulation
+
+        :return: np.float32 view of [trace, sample]
+        :rtype: np.ndarray
+        """
+        return self.rx_eye[: self.stats.neyetr, : self.stats.neyesamp]
+
+
 # Return code flags for freedv_get_rx_status() function
 api.FREEDV_RX_TRIAL_SYNC = 0x1  # type: ignore # demodulator has trial sync
 api.FREEDV_RX_SYNC = 0x2  # type: ignore # demodulator has sync
@@ -295,19 +866,35 @@ api.rx_sync_flags_to_text = [  # type: ignore
 # Audio buffer ---------------------------------------------------------
 class audio_buffer:
     """
-    Thread-safe audio buffer, which fits the needs of codec2
+    Lock-free single producer / single consumer audio buffer, which fits the needs of codec2
+
+    Samples are stored in a ring of `size` samples followed by a mirror of the
+    ring, so the unread samples are always available as one contiguous view
+    starting at the read position. `pop` only moves the read position, there is
+    no memmove of the remaining samples.
 
     made by David Rowe, VK5DGR
     """
 
-    # A buffer of int16 samples, using a fixed length numpy array self.buffer for storage
-    # self.nbuffer is the current number of samples in the buffer
+    # A ring of int16 samples with a mirrored copy appended, self._storage[size:] == self._storage[:size]
+    # self._rd and self._wr are absolute sample counters, only the consumer moves _rd
+    # and only the producer moves _wr, so we don't need a lock between both sides.
     def __init__(self, size):
         log.debug("[C2 ] Creating audio buffer", size=size)
         self.size = size
-        self.buffer = np.zeros(size, dtype=np.int16)
-        self.nbuffer = 0
-        self.mutex = Lock()
+        self._storage = np.zeros(2 * size, dtype=np.int16)
+        # ring and mirror as two rows, so one assignment writes both copies
+        self._rows = self._storage.reshape(2, size)
+        self._rd = 0
+        self._wr = 0
+        # contiguous view of the buffer, starting at the oldest sample.
+        # The first `nbuffer` samples are valid, it only changes on pop()
+        self.buffer = self._storage[:size]
+
+    @property
+    def nbuffer(self) -> int:
+        """Current number of samples in the buffer"""
+        return self._wr - self._rd
 
     def push(self, samples):
         """
@@ -319,12 +906,18 @@ class audio_buffer:
         Returns:
             Nothing
         """
-        self.mutex.acquire()
+        nsamples = len(samples)
+        size = self.size
         # Add samples at the end of the buffer
-        assert self.nbuffer + len(samples) <= self.size
-        self.buffer[self.nbuffer : self.nbuffer + len(samples)] = samples
-        self.nbuffer += len(samples)
-        self.mutex.release()
+        assert self._wr - self._rd + nsamples <= size
+        start = self._wr % size
+        first = min(nsamples, size - start)
+        # write to the ring and to its mirror, wrapping around at the end of the ring
+        self._rows[:, start : start + first] = samples[:first]
+        if first < nsamples:
+            self._rows[:, : nsamples - first] = samples[first:]
+        # publish the samples only after they have been written
+        self._wr += nsamples
 
     def pop(self, size):
         """
@@ -335,12 +928,227 @@ class audio_buffer:
         Returns:
             Nothing
         """
-        self.mutex.acquire()
         # Remove samples from the start of the buffer
-        self.nbuffer -= size
-        self.buffer[: self.nbuffer] = self.buffer[size : size + self.nbuffer]
-        assert self.nbuffer >= 0
-        self.mutex.release()
+        assert size <= self._wr - self._rd
+        self._rd += size
+        start = self._rd % self.size
+        self.buffer = self._storage[start : start + self.size]
+
+
+class shared_audio_buffer:
+    """
+    Audio buffer written once by a single producer and read by several decoders
+
+    Every decoder gets its own audio_buffer_reader cursor with the audio_buffer
+    interface (nbuffer, buffer, pop), so a block of samples is stored only once
+    instead of being copied into one audio_buffer per decoder.
+    """
+
+    # Same mirrored ring layout as audio_buffer. The ring is twice the reader size,
+    # so the producer can write a whole block without touching samples a reader
+    # with a full buffer is still demodulating.
+    def __init__(self, size):
+        log.debug("[C2 ] Creating shared audio buffer", size=size)
+        self.size = size
+        self.ring_size = 2 * size
+        self._storage = np.zeros(2 * self.ring_size, dtype=np.int16)
+        self._rows = self._storage.reshape(2, self.ring_size)
+        self._wr = 0
+        self.readers = []
+
+    def reader(self, history=0):
+        """
+        Create a new read cursor
+
+        Args:
+            history: number of already received samples a reader starts with
+                     when it gets activated
+
+        Returns:
+            audio_buffer_reader
+        """
+        reader = audio_buffer_reader(self, history)
+        self.readers.append(reader)
+        return reader
+
+    def push(self, samples):
+        """
+        Push new data to buffer, once for all readers
+
+        Args:
+            samples:
+
+        Returns:
+            Nothing
+        """
+        nsamples = len(samples)
+        assert nsamples <= self.size
+        for reader in self.readers:
+            if not reader.active:
+                continue
+            if not reader._activated:
+                # remember where a newly enabled reader starts, it may only get activated
+                # by its decoder after some more blocks
+                if reader._start is None:
+                    reader._start = max(reader._rd, self._wr - reader.history)
+            elif self._wr + nsamples - reader._rd > reader.size:
+                # count an overflow for every active reader which can't keep up with the producer
+                reader.overflows += 1
+
+        start = self._wr % self.ring_size
+        first = min(nsamples, self.ring_size - start)
+        # write to the ring and to its mirror, wrapping around at the end of the ring
+        self._rows[:, start : start + first] = samples[:first]
+        if first < nsamples:
+            self._rows[:, : nsamples - first] = samples[first:]
+        # publish the samples only after they have been written
+        self._wr += nsamples
+
+
+class process_shared_audio_buffer(shared_audio_buffer):
+    """
+    shared_audio_buffer in shared memory, for decoders running in other processes
+
+    Samples and the write position are stored in multiprocessing.RawArrays.
+    The buffer can be passed as argument to a multiprocessing.Process, where
+    readers are created as usual.
+    """
+
+    def __init__(self, size, samples=None, position=None):
+        log.debug("[C2 ] Creating process shared audio buffer", size=size)
+        self.size = size
+        self.ring_size = 2 * size
+        if samples is None:
+            samples = multiprocessing.RawArray(ctypes.c_int16, 2 * self.ring_size)
+            position = multiprocessing.RawArray(ctypes.c_int64, 1)
+        self.samples = samples
+        self.position = position
+        self._storage = np.frombuffer(samples, dtype=np.int16)
+        self._rows = self._storage.reshape(2, self.ring_size)
+        self.readers = []
+
+    def __reduce__(self):
+        # readers are local to a process, only pass the shared memory
+        return self.__class__, (self.size, self.samples, self.position)
+
+    @property
+    def _wr(self) -> int:
+        return self.position[0]
+
+    @_wr.setter
+    def _wr(self, value) -> None:
+        self.position[0] = value
+
+
+class audio_buffer_reader:
+    """
+    Read cursor of a decoder into a shared_audio_buffer
+
+    Only the decoder moves its cursor. While the reader is not active its
+    nbuffer is 0. After activation it starts with the last `history` samples,
+    and if it falls behind more than `size` samples, the oldest samples are dropped.
+    """
+
+    def __init__(self, store, history=0):
+        self.store = store
+        self.size = store.size
+        self.history = min(history, self.size)
+        # set by the producer, we don't deliver samples while False
+        self.active = False
+        self.overflows = 0
+        self._rd = store._wr
+        self._activated = False
+        # start position of the next activation, set by the producer
+        self._start = None
+        self.buffer = store._storage[: self.size]
+
+    def _seek(self, position):
+        """Move the cursor to an absolute sample position"""
+        self._rd = position
+        start = position % self.store.ring_size
+        self.buffer = self.store._storage[start : start + self.size]
+
+    def _position(self, wr) -> int:
+        """Position the reader continues from, also if it hasn't been activated yet"""
+        if self._activated:
+            return self._rd
+        start = self._start
+        if start is None:
+            # start from a recent history window instead of outdated samples
+            start = wr - self.history
+        return max(self._rd, start)
+
+    @property
+    def position(self) -> int:
+        """Absolute sample position of the cursor"""
+        return self._rd
+
+    @property
+    def overrun(self) -> bool:
+        """True if the producer has overwritten samples we haven't read yet"""
+        return self.active and self._activated and self.store._wr - self._rd > self.size
+
+    def activate_at(self, position) -> None:
+        """
+        Continue at the absolute sample `position` instead of the history window
+
+        Only applies while the reader hasn't been activated yet, e.g. for a decoder
+        in another process which knows where the producer expects it to continue.
+
+        Args:
+          position: sample position, at most the write position of the producer
+        """
+        if not self._activated:
+            self._seek(position)
+            self._start = position
+
+    @property
+    def nbuffer(self) -> int:
+        """Current number of samples available for this reader"""
+        if not self.active:
+            self._activated = False
+            self._start = None
+            return 0
+
+        wr = self.store._wr
+        if not self._activated:
+            self._seek(self._position(wr))
+            self._activated = True
+        if wr - self._rd > self.size:
+            # we have been overrun by the producer, continue with the newest samples
+            self._seek(wr - self.size)
+        return wr - self._rd
+
+    def ready(self, size) -> bool:
+        """
+        Check from the producer side if `size` samples are waiting, without moving the cursor
+
+        Args:
+          size:
+
+        Returns:
+            bool
+        """
+        return self.active and self.store._wr - self._position(self.store._wr) >= size
+
+    def backlog(self) -> int:
+        """Number of samples waiting for this reader, without moving the cursor"""
+        if not self.active:
+            return 0
+        wr = self.store._wr
+        return min(wr - self._position(wr), self.size)
+
+    def pop(self, size):
+        """
+        get data from buffer in size of NIN
+        Args:
+          size:
+
+        Returns:
+            Nothing
+        """
+        assert size <= self.store._wr - self._rd
+        self._seek(self._rd + size)
 
 
 # Resampler ---------------------------------------------------------
@@ -351,30 +1159,82 @@ api.FDMDV_OS_48 = 6  # type: ignore
 api.FDMDV_OS_TAPS_48K = 48  # type: ignore
 # Number of oversampling filter taps at 8kHz
 api.FDMDV_OS_TAPS_48_8K = api.FDMDV_OS_TAPS_48K // api.FDMDV_OS_48  # type: ignore
-api.fdmdv_8_to_48_short.argtype = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]  # type: ignore
-api.fdmdv_48_to_8_short.argtype = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]  # type: ignore
 
 
 class resampler:
     """
     Re-sampler class
+
+    The filter memories are kept in front of preallocated scratch buffers, so
+    streaming audio through the resampler doesn't allocate new buffers for
+    every block. Pass `out` for writing the result into an existing array.
     """
 
     # Re-sample an array of variable length, we just store the filter memories here
     MEM8 = api.FDMDV_OS_TAPS_48_8K
     MEM48 = api.FDMDV_OS_TAPS_48K
 
-    def __init__(self):
-        log.debug("[C2 ] Create 48<->8 kHz resampler")
-        self.filter_mem8 = np.zeros(self.MEM8, dtype=np.int16)
-        self.filter_mem48 = np.zeros(self.MEM48)
+    def __init__(self, blocksize: int = 0):
+        """
+        Args:
+            blocksize: expected number of 48 kHz samples per block,
+                       scratch buffers grow if a block is larger
+        """
+        log.debug("[C2 ] Create 48<->8 kHz resampler", blocksize=blocksize)
+        # filter memory followed by the input samples
+        self.in48_mem = np.zeros(self.MEM48, dtype=np.int16)
+        self.in8_mem = np.zeros(self.MEM8, dtype=np.int16)
+        self.reserve(blocksize)
+
+    def reserve(self, n48: int) -> None:
+        """
+        Make sure the scratch buffers of both directions can hold a block of `n48` samples at 48 kHz
+
+        Args:
+            n48: number of samples at 48 kHz
+        """
+        self.reserve48(n48)
+        self.reserve8(n48 // api.FDMDV_OS_48)  # type: ignore
+
+    def reserve48(self, n48: int) -> None:
+        """
+        Make sure the scratch buffer of resample48_to_8 can hold `n48` samples
+
+        Only this buffer is replaced, a resample8_to_48 running at the same time keeps its buffer.
+
+        Args:
+            n48: number of samples at 48 kHz
+        """
+        if self.MEM48 + n48 > len(self.in48_mem):
+            in48_mem = np.zeros(self.MEM48 + n48, dtype=np.int16)
+            in48_mem[: self.MEM48] = self.in48_mem[: self.MEM48]
+            self.in48_mem = in48_mem
+        # In C: pin48=&in48_mem[MEM48]
+        self.pin48 = ctypes.c_void_p(self.in48_mem.ctypes.data + 2 * self.MEM48)
+
+    def reserve8(self, n8: int) -> None:
+        """
+        Make sure the scratch buffer of resample8_to_48 can hold `n8` samples
+
+        Only this buffer is replaced, a resample48_to_8 running at the same time keeps its buffer.
+
+        Args:
+            n8: number of samples at 8 kHz
+        """
+        if self.MEM8 + n8 > len(self.in8_mem):
+            in8_mem = np.zeros(self.MEM8 + n8, dtype=np.int16)
+            in8_mem[: self.MEM8] = self.in8_mem[: self.MEM8]
+            self.in8_mem = in8_mem
+        # In C: pin8=&in8_mem[MEM8]
+        self.pin8 = ctypes.c_void_p(self.in8_mem.ctypes.data + 2 * self.MEM8)
 
-    def resample48_to_8(self, in48):
+    def resample48_to_8(self, in48, out=None):
         """
         Audio resampler integration from codec2
         Downsample audio from 48000Hz to 8000Hz
         Args:
             in48: input data as np.int16
+            out: optional np.int16 array of len(in48) / 6 samples for the result
 
         Returns:
             Downsampled 8000Hz data as np.int16
@@ -383,45 +1243,49 @@ class resampler:
         # Length of input vector must be an integer multiple of api.FDMDV_OS_48
         assert len(in48) % api.FDMDV_OS_48 == 0  # type: ignore
 
-        # Concatenate filter memory and input samples
-        in48_mem = np.zeros(self.MEM48 + len(in48), dtype=np.int16)
-        in48_mem[: self.MEM48] = self.filter_mem48
-        in48_mem[self.MEM48 :] = in48
+        n48 = len(in48)
+        n8 = n48 // api.FDMDV_OS_48  # type: ignore
+        if out is None:
+            out = np.empty(n8, dtype=np.int16)
+        assert out.dtype == np.int16 and len(out) == n8 and out.flags.c_contiguous
 
-        # In C: pin48=&in48_mem[MEM48]
-        pin48 = ctypes.byref(np.ctypeslib.as_ctypes(in48_mem), 2 * self.MEM48)
-        n8 = int(len(in48) / api.FDMDV_OS_48)  # type: ignore
-        out8 = np.zeros(n8, dtype=np.int16)
-        api.fdmdv_48_to_8_short(out8.ctypes, pin48, n8)  # type: ignore
+        # Append input samples to the filter memory
+        if self.MEM48 + n48 > len(self.in48_mem):
+            self.reserve48(n48)
+        self.in48_mem[self.MEM48 : self.MEM48 + n48] = in48
 
-        # Store memory for next time
-        self.filter_mem48 = in48_mem[: self.MEM48]
+        api.fdmdv_48_to_8_short(ctypes.c_void_p(out.ctypes.data), self.pin48, n8)  # type: ignore
 
-        return out8
+        # codec2 moved the last input samples to the filter memory for next time
 
-    def resample8_to_48(self, in8):
+        return out
+
+    def resample8_to_48(self, in8, out=None):
         """
         Audio resampler integration from codec2
         Re-sample audio from 8000Hz to 48000Hz
         Args:
             in8: input data as np.int16
+            out: optional np.int16 array of len(in8) * 6 samples for the result
 
         Returns:
             48000Hz audio as np.int16
         """
         assert in8.dtype == np.int16
 
-        # Concatenate filter memory and input samples
-        in8_mem = np.zeros(self.MEM8 + len(in8), dtype=np.int16)
-        in8_mem[: self.MEM8] = self.filter_mem8
-        in8_mem[self.MEM8 :] = in8
+        n8 = len(in8)
+        n48 = api.FDMDV_OS_48 * n8  # type: ignore
+        if out is None:
+            out = np.empty(n48, dtype=np.int16)
+        assert out.dtype == np.int16 and len(out) == n48 and out.flags.c_contiguous
 
-        # In C: pin8=&in8_mem[MEM8]
-        pin8 = ctypes.byref(np.ctypeslib.as_ctypes(in8_mem), 2 * self.MEM8)
-        out48 = np.zeros(api.FDMDV_OS_48 * len(in8), dtype=np.int16)  # type: ignore
-        api.fdmdv_8_to_48_short(out48.ctypes, pin8, len(in8))  # type: ignore
+        # Append input samples to the filter memory
+        if self.MEM8 + n8 > len(self.in8_mem):
+            self.reserve8(n8)
+        self.in8_mem[self.MEM8 : self.MEM8 + n8] = in8
+
+        api.fdmdv_8_to_48_short(ctypes.c_void_p(out.ctypes.data), self.pin8, n8)  # type: ignore
 
-        # Store memory for next time
-        self.filter_mem8 = in8_mem[: self.MEM8]
+        # codec2 moved the last input samples to the filter memory for next time
 
-        return out48
+        return out
@@ -0,0 +1,462 @@
+"""
+Pure numpy stand-in for libcodec2.
+
+Implements the functions of codec2.PROTOTYPES with the same arguments, so the TNC,
+its tests and benchmarks run on machines without libcodec2, see codec2.set_backend().
+
+Every mode has the frame size, nin and number of samples of its codec2 counterpart,
+but uses a simple deterministic OFDM like waveform: differential BPSK on NC carriers,
+every frame starting with a sync word. It is meant for exercising the protocol logic
+over the audio path of the TNC, not for the air. Frames can be dropped on purpose,
+see set_frame_loss().
+"""
+# pylint: disable=invalid-name
+
+import ctypes
+import math
+import os
+import threading
+from dataclasses import dataclass
+
+import codec2
+import numpy as np
+
+FS = 8000
+NFFT = 64
+CP = 16
+SYMBOL = NFFT + CP  # samples per OFDM symbol
+CARRIERS = np.arange(4, 24)  # rfft bins, 500 Hz to 2875 Hz
+NC = len(CARRIERS)
+SYNC_SYMBOLS = 2
+SYNC_LENGTH = SYNC_SYMBOLS * SYMBOL
+# normalized correlation of the received audio with the sync word for detecting a frame
+SYNC_THRESHOLD = 0.6
+# scales the waveform to an rms of about 5000
+AMPLITUDE = 50000
+# scale of the received symbols in the extended modem stats, for the scatter plot
+SCATTER_SCALE = 10000
+SNR_MAX = 30.0
+
+FRAME_LOSS_ENV = "FREEDATA_NUMPY_FRAME_LOSS"
+FRAME_LOSS_SEED_ENV = "FREEDATA_NUMPY_FRAME_LOSS_SEED"
+
+
+@dataclass(frozen=True)
+class mode_params:
+    """Sizes of a codec2 mode, as reported by libcodec2"""
+
+    bytes_per_frame: int
+    n_tx_modem_samples: int
+    n_tx_preamble_modem_samples: int
+    n_tx_postamble_modem_samples: int
+    n_nom_modem_samples: int
+    n_max_modem_samples: int
+    nin: int
+
+
+MODES = {
+    codec2.FREEDV_MODE.datac13.value: mode_params(16, 15840, 880, 880, 880, 3520, 880),
+    codec2.FREEDV_MODE.datac0.value: mode_params(16, 3520, 880, 880, 880, 3520, 880),
+    codec2.FREEDV_MODE.datac1.value: mode_params(512, 33440, 880, 880, 880, 3520, 880),
+    codec2.FREEDV_MODE.datac3.value: mode_params(128, 25520, 880, 880, 880, 3520, 880),
+    codec2.FREEDV_MODE.datac4.value: mode_params(56, 41360, 880, 880, 880, 3520, 880),
+    codec2.FREEDV_MODE.fsk_ldpc_0.value: mode_params(16, 2304, 1600, 0, 2304, 816, 800),
+    codec2.FREEDV_MODE.fsk_ldpc_1.value: mode_params(512, 32896, 800, 0, 32896, 408, 400),
+}
+# codec2 opens both fsk modes as fsk_ldpc with advanced settings, we tell them apart by their code
+FSK_CODES = {
+    b"H_128_256_5": codec2.FREEDV_MODE.fsk_ldpc_0.value,
+    b"H_4096_8192_3d": codec2.FREEDV_MODE.fsk_ldpc_1.value,
+}
+
+
+def _ofdm(rows: np.ndarray) -> np.ndarray:
+    """Time signal of OFDM symbols with cyclic prefix, `rows` are the NC carrier values of each symbol"""
+    spectrum = np.zeros((len(rows), NFFT // 2 + 1), dtype=np.complex128)
+    spectrum[:, CARRIERS] = rows
+    symbols = np.fft.irfft(spectrum, NFFT, axis=1) * AMPLITUDE
+    return np.concatenate([symbols[:, -CP:], symbols], axis=1).ravel()
+
+
+def _random_rows(seed: int, nrows: int) -> np.ndarray:
+    return np.random.default_rng(seed).choice([-1.0, 1.0], size=(nrows, NC))
+
+
+SYNC = _ofdm(_random_rows(1, SYNC_SYMBOLS))
+SYNC_NORM = float(np.sqrt(np.sum(SYNC**2)))
+# preambles and postambles carry other pseudo random symbols, they must not look like a sync word
+AMBLE = _ofdm(_random_rows(2, 1 + max(params.n_tx_preamble_modem_samples for params in MODES.values()) // SYMBOL))
+
+
+def _to_int16(signal: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(signal), -32768, 32767).astype(np.int16)
+
+
+# ------- CRC16, CRC-16/CCITT-FALSE like freedv_gen_crc16
+
+
+def _crc16_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes) -> int:
+    """CRC16 of `data`"""
+    crc = 0xFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+# ------- frame loss
+
+_frame_loss = float(os.getenv(FRAME_LOSS_ENV) or 0)
+_frame_loss_rng = np.random.default_rng(int(os.getenv(FRAME_LOSS_SEED_ENV) or 0))
+
+
+def set_frame_loss(probability: float, seed: int = 0) -> None:
+    """
+    Drop received frames with `probability`, as if they had bit errors
+
+    The frames are drawn from a random generator seeded with `seed`, so a test
+    loses the same frames every time. Exported with FRAME_LOSS_ENV and
+    FRAME_LOSS_SEED_ENV, so demodulator processes lose frames as well.
+
+    Args:
+        probability: 0 receives all frames, 1 none
+        seed: seed of the random generator
+    """
+    global _frame_loss, _frame_loss_rng
+    _frame_loss = probability
+    _frame_loss_rng = np.random.default_rng(seed)
+    os.environ[FRAME_LOSS_ENV] = str(probability)
+    os.environ[FRAME_LOSS_SEED_ENV] = str(seed)
+
+
+# ------- pointers, passed like to the c_void_p arguments of libcodec2
+
+
+def _address(pointer) -> int:
+    """Address of a pointer argument, an int, numpy .ctypes, ctypes array, byref() or bytes"""
+    return ctypes.cast(pointer, ctypes.c_void_p).value
+
+
+def _array(pointer, ctype, length: int) -> np.ndarray:
+    """numpy view of `length` ctype values at `pointer`"""
+    return np.ctypeslib.as_array((ctype * length).from_address(_address(pointer)))
+
+
+# ------- modem instances
+
+
+class freedv:
+    """State of an opened stand-in modem, the freedv struct of libcodec2"""
+
+    def __init__(self, mode: int) -> None:
+        self.mode = mode
+        self.params = MODES[mode]
+        self.nbits = 8 * self.params.bytes_per_frame
+        self.nsymbols = math.ceil(self.nbits / NC)
+        # sync word, reference symbol and data symbols
+        self.frame_length = SYNC_LENGTH + (1 + self.nsymbols) * SYMBOL
+        assert self.frame_length <= self.params.n_tx_modem_samples
+        self.frames_per_burst = 1
+        self.tuning_range = (-50.0, 50.0)
+
+        # received audio, from the oldest sample we haven't searched for a sync word yet
+        self.buffer = np.zeros(self.params.n_tx_modem_samples + 2 * self.params.nin + SYNC_LENGTH, dtype=np.float32)
+        self.nbuffer = 0
+        self.sync_position = None  # start of the frame we are receiving
+        self.rx_status = 0
+        self.snr = 0.0
+        self.symbols = np.zeros((0, NC), dtype=np.complex64)
+
+    def modulate(self, data: bytes) -> np.ndarray:
+        """Waveform of a frame, without the silence up to n_tx_modem_samples"""
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+        bits = np.concatenate([bits, np.zeros(self.nsymbols * NC - len(bits), dtype=np.uint8)])
+        # differential BPSK, every symbol relative to the previous one, starting with all ones
+        rows = np.cumprod(np.vstack([np.ones(NC), 1.0 - 2.0 * bits.reshape(self.nsymbols, NC)]), axis=0)
+        return np.concatenate([SYNC, _ofdm(rows)])
+
+    def push(self, samples: np.ndarray) -> None:
+        """Add received samples, drop the oldest if the buffer is full"""
+        overflow = self.nbuffer + len(samples) - len(self.buffer)
+        if overflow > 0:
+            self.drop(overflow)
+        self.buffer[self.nbuffer : self.nbuffer + len(samples)] = samples
+        self.nbuffer += len(samples)
+
+    def drop(self, nsamples: int) -> None:
+        """Forget the oldest `nsamples` received samples"""
+        nsamples = min(nsamples, self.nbuffer)
+        self.buffer[: self.nbuffer - nsamples] = self.buffer[nsamples : self.nbuffer]
+        self.nbuffer -= nsamples
+        if self.sync_position is not None:
+            self.sync_position -= nsamples
+            if self.sync_position < 0:
+                self.sync_position = None
+
+    def search(self) -> int:
+        """
+        Look for a sync word in the received samples
+
+        Returns:
+            rx status, FREEDV_RX_TRIAL_SYNC if we wait for more samples around a candidate
+        """
+        received = self.buffer[: self.nbuffer].astype(np.float64)
+        if len(received) < SYNC_LENGTH:
+            return 0
+        correlation = np.correlate(received, SYNC, "valid")
+        energy = np.concatenate([[0.0], np.cumsum(received**2)])
+        energy = energy[SYNC_LENGTH:] - energy[: -SYNC_LENGTH]
+        correlation /= np.sqrt(np.maximum(energy, 1.0)) * SYNC_NORM
+
+        candidates = np.flatnonzero(correlation > SYNC_THRESHOLD)
+        if not len(candidates):
+            # keep what might be the beginning of a sync word
+            self.drop(len(correlation))
+            return 0
+        first = candidates[0]
+        if first + SYMBOL > len(correlation):
+            # the correlation peak might still be ahead of us
+            self.drop(first)
+            return codec2.api.FREEDV_RX_TRIAL_SYNC
+        self.sync_position = first + int(np.argmax(correlation[first : first + SYMBOL]))
+        self.drop(self.sync_position)
+        return codec2.api.FREEDV_RX_TRIAL_SYNC | codec2.api.FREEDV_RX_SYNC
+
+    def demodulate(self) -> bytes:
+        """Decode the frame at sync_position, sets the SNR and returns its bytes"""
+        start = self.sync_position + SYNC_LENGTH + CP
+        symbols = self.buffer[start : start + (1 + self.nsymbols) * SYMBOL].reshape(1 + self.nsymbols, SYMBOL)
+        rows = np.fft.rfft(symbols[:, :NFFT], axis=1)[:, CARRIERS]
+        # a timing error within the cyclic prefix turns every carrier by a constant phase, which cancels out
+        differential = rows[1:] * np.conj(rows[:-1]) / np.maximum(np.abs(rows[:-1]) ** 2, 1e-9)
+        self.symbols = differential.astype(np.complex64)
+
+        signal = np.mean(np.abs(differential.real))
+        noise = np.mean((np.abs(differential.real) - signal) ** 2 + differential.imag**2)
+        self.snr = round(float(min(10 * np.log10(signal**2 / max(noise, 1e-12)), SNR_MAX)), 1)
+
+        bits = (differential.real < 0).astype(np.uint8).ravel()[: self.nbits]
+        return np.packbits(bits).tobytes()
+
+    def receive(self, samples: np.ndarray, bytes_out) -> int:
+        """
+        Demodulate nin samples, see freedv_rawdatarx
+
+        A frame is returned as soon as all n_tx_modem_samples of it have been
+        received, like libcodec2 does.
+        """
+        self.push(samples)
+        status = 0
+        if self.sync_position is None:
+            status = self.search()
+        if self.sync_position is None:
+            self.rx_status = status
+            return 0
+
+        if self.nbuffer - self.sync_position < self.params.n_tx_modem_samples:
+            self.rx_status = status or codec2.api.FREEDV_RX_SYNC
+            return 0
+
+        data = self.demodulate()
+        self.drop(self.sync_position + self.frame_length)
+        self.sync_position = None
+
+        payload, crc = data[:-2], int.from_bytes(data[-2:], "big")
+        if crc != crc16(payload) or (_frame_loss and _frame_loss_rng.random() < _frame_loss):
+            self.rx_status = codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BIT_ERRORS
+            return 0
+
+        ctypes.memmove(_address(bytes_out), data, len(data))
+        self.rx_status = codec2.api.FREEDV_RX_SYNC | codec2.api.FREEDV_RX_BITS
+        return len(data)
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+_next_handle = 1
+
+
+def _open(mode: int):
+    global _next_handle
+    if mode not in MODES:
+        return None
+    with _instances_lock:
+        handle = _next_handle
+        _next_handle += 1
+        _instances[handle] = freedv(mode)
+    return handle
+
+
+def _instance(handle) -> freedv:
+    if isinstance(handle, ctypes.c_void_p):
+        handle = handle.value
+    return _instances[handle]
+
+
+# ------- functions of codec2.PROTOTYPES
+
+
+def freedv_open(mode: int):
+    return _open(mode)
+
+
+def freedv_open_advanced(mode: int, adv):
+    if mode != codec2.FREEDV_MODE.fsk_ldpc.value:
+        return None
+    advanced = codec2.ADVANCED.from_address(_address(adv))
+    return _open(FSK_CODES.get(advanced.codename))
+
+
+def freedv_close(handle) -> None:
+    if isinstance(handle, ctypes.c_void_p):
+        handle = handle.value
+    with _instances_lock:
+        _instances.pop(handle, None)
+
+
+def freedv_set_sync(handle, sync: int) -> None:
+    if not sync:
+        instance = _instance(handle)
+        instance.sync_position = None
+
+
+def freedv_set_frames_per_burst(handle, frames_per_burst: int) -> None:
+    _instance(handle).frames_per_burst = frames_per_burst
+
+
+def freedv_set_tuning_range(handle, fmin, fmax) -> None:
+    _instance(handle).tuning_range = (getattr(fmin, "value", fmin), getattr(fmax, "value", fmax))
+
+
+def freedv_get_bits_per_modem_frame(handle) -> int:
+    return _instance(handle).nbits
+
+
+def freedv_get_modem_stats(handle, sync, snr) -> None:
+    instance = _instance(handle)
+    ctypes.c_int.from_address(_address(sync)).value = int(instance.sync_position is not None)
+    ctypes.c_float.from_address(_address(snr)).value = instance.snr
+
+
+def freedv_get_modem_extended_stats(handle, stats) -> None:
+    instance = _instance(handle)
+    modem_stats = codec2.MODEMSTATS.from_address(_address(stats))
+    modem_stats.Nc = NC
+    modem_stats.snr_est = instance.snr
+    modem_stats.sync = int(instance.sync_position is not None)
+    modem_stats.foff = modem_stats.rx_timing = modem_stats.clock_offset = 0.0
+    modem_stats.neyetr = modem_stats.neyesamp = 0
+
+    nr = min(len(instance.symbols), codec2.MODEM_STATS_NR_MAX)
+    rx_symbols = np.ctypeslib.as_array(modem_stats.rx_symbols)
+    rx_symbols[:] = 0.0
+    rx_symbols[:nr, :NC, 0] = instance.symbols[:nr].real * SCATTER_SCALE
+    rx_symbols[:nr, :NC, 1] = instance.symbols[:nr].imag * SCATTER_SCALE
+    modem_stats.nr = nr
+
+
+def freedv_get_rx_status(handle) -> int:
+    return _instance(handle).rx_status
+
+
+def freedv_nin(handle) -> int:
+    return _instance(handle).params.nin
+
+
+def freedv_rawdatarx(handle, bytes_out, demod_in) -> int:
+    instance = _instance(handle)
+    return instance.receive(_array(demod_in, ctypes.c_short, instance.params.nin), bytes_out)
+
+
+def freedv_rawdatatx(handle, mod_out, bytes_in) -> None:
+    instance = _instance(handle)
+    params = instance.params
+    data = ctypes.string_at(_address(bytes_in), params.bytes_per_frame)
+    out = _array(mod_out, ctypes.c_short, params.n_tx_modem_samples)
+    out[:] = 0
+    out[: instance.frame_length] = _to_int16(instance.modulate(data))
+
+
+def freedv_rawdatapreambletx(handle, mod_out) -> int:
+    nsamples = _instance(handle).params.n_tx_preamble_modem_samples
+    _array(mod_out, ctypes.c_short, nsamples)[:] = _to_int16(AMBLE[:nsamples])
+    return nsamples
+
+
+def freedv_rawdatapostambletx(handle, mod_out) -> int:
+    nsamples = _instance(handle).params.n_tx_postamble_modem_samples
+    _array(mod_out, ctypes.c_short, nsamples)[:] = _to_int16(AMBLE[-nsamples:] if nsamples else AMBLE[:0])
+    return nsamples
+
+
+def freedv_gen_crc16(data, length: int) -> int:
+    return crc16(ctypes.string_at(_address(data), length))
+
+
+def freedv_get_n_max_modem_samples(handle) -> int:
+    return _instance(handle).params.n_max_modem_samples
+
+
+def freedv_get_n_nom_modem_samples(handle) -> int:
+    return _instance(handle).params.n_nom_modem_samples
+
+
+def freedv_get_n_tx_modem_samples(handle) -> int:
+    return _instance(handle).params.n_tx_modem_samples
+
+
+def freedv_get_n_tx_preamble_modem_samples(handle) -> int:
+    return _instance(handle).params.n_tx_preamble_modem_samples
+
+
+def freedv_get_n_tx_postamble_modem_samples(handle) -> int:
+    return _instance(handle).params.n_tx_postamble_modem_samples
+
+
+def freedv_get_modem_sample_rate(handle) -> int:
+    return FS
+
+
+# ------- 48 kHz <-> 8 kHz resampling, with the filter memory in front of the input like fdmdv
+
+
+def _lowpass(ntaps: int, cutoff: float, fs: float) -> np.ndarray:
+    taps = np.sinc(2 * cutoff / fs * (np.arange(ntaps) - (ntaps - 1) / 2)) * np.hamming(ntaps)
+    return taps / np.sum(taps)
+
+
+OS = codec2.api.FDMDV_OS_48
+TAPS_48K = codec2.api.FDMDV_OS_TAPS_48K
+TAPS_8K = codec2.api.FDMDV_OS_TAPS_48_8K
+OS_FILTER = _lowpass(TAPS_48K, 3500, 48000)
+
+
+def fdmdv_48_to_8_short(out8k, in48k, n: int) -> None:
+    address = _address(in48k) - 2 * TAPS_48K
+    samples = np.ctypeslib.as_array((ctypes.c_short * (TAPS_48K + n * OS)).from_address(address))
+    filtered = np.convolve(samples.astype(np.float64), OS_FILTER)[TAPS_48K : TAPS_48K + n * OS : OS]
+    _array(out8k, ctypes.c_short, n)[:] = _to_int16(filtered)
+    # keep the last samples as filter memory for the next call
+    samples[:TAPS_48K] = samples[n * OS :].copy()
+
+
+def fdmdv_8_to_48_short(out48k, in8k, n: int) -> None:
+    address = _address(in8k) - 2 * TAPS_8K
+    samples = np.ctypeslib.as_array((ctypes.c_short * (TAPS_8K + n)).from_address(address))
+    upsampled = np.zeros((TAPS_8K + n) * OS)
+    upsampled[::OS] = samples
+    filtered = np.convolve(upsampled, OS_FILTER * OS)[TAPS_48K : TAPS_48K + n * OS]
+    _array(out48k, ctypes.c_short, n * OS)[:] = _to_int16(filtered)
+    samples[:TAPS_8K] = samples[n:].copy()
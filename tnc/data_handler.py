@@ -26,6 +26,7 @@ import structlog
 import stats
 import ujson as json
 from codec2 import FREEDV_MODE, FREEDV_MODE_USED_SLOTS
+from occupancy import CHANNEL_OCCUPANCY
 from queues import DATA_QUEUE_RECEIVED, DATA_QUEUE_TRANSMIT, RX_BUFFER, MESH_RECEIVED_QUEUE
 from static import FRAME_TYPE as FR_TYPE
 import broadcast
@@ -88,6 +89,7 @@ class DATA:
         self.burst_rpt_counter = 0
 
         self.rx_start_of_transmission = 0  # time of transmission start
+        self.rx_last_frame_timestamp = 0.0  # time the latest data frame was handed to us by the modem
 
         # 3 bytes for the BOF Beginning of File indicator in a data frame
         self.data_frame_bof = b"BOF"
@@ -156,6 +158,7 @@ class DATA:
 
         self.speed_level = len(self.mode_list) - 1  # speed level for selecting mode
         ARQ.arq_speed_level = self.speed_level
+        self.speed_level_snr = 0.0  # average SNR of the decoder of the latest data frame
 
         # minimum payload for arq burst
         # import for avoiding byteorder bug and buffer search area
@@ -350,20 +353,24 @@ class DATA:
         while True:
             data = self.data_queue_received.get()
             # [0] bytes
-            # [1] freedv instance
+            # [1] name of the demodulator
             # [2] bytes_per_frame
+            # [3] snr of the frame
+            # [4] telemetry of the decoder
             self.process_data(
-                bytes_out=data[0], freedv=data[1], bytes_per_frame=data[2]
+                bytes_out=data[0], mode_name=data[1], bytes_per_frame=data[2], snr=data[3], telemetry=data[4]
             )
 
-    def process_data(self, bytes_out, freedv, bytes_per_frame: int) -> None:
+    def process_data(self, bytes_out, mode_name: str, bytes_per_frame: int, snr=None, telemetry=None) -> None:
         """
         Process incoming data and decide what to do with the frame.
 
         Args:
           bytes_out:
-          freedv:
+          mode_name: name of the demodulator of the frame, e.g. sig0-datac13
           bytes_per_frame:
+          snr: SNR of the frame, ModemParam.snr if unknown
+          telemetry: telemetry.DecoderTelemetry of the decoder of the frame
 
         Returns:
 
@@ -416,14 +423,13 @@ class DATA:
 
             # Process frametypes requiring a different set of arguments.
             elif FR_TYPE.BURST_51.value >= frametype >= FR_TYPE.BURST_01.value:
-                # get snr of received data
-                # FIXME: find a fix for this - after moving to classes, this no longer works
-                # snr = self.calculate_snr(freedv)
-                snr = ModemParam.snr
+                # snr of received data, ModemParam.snr might belong to a frame of another decoder already
+                if snr is None:
+                    snr = ModemParam.snr
                 self.log.debug("[TNC] RX SNR", snr=snr)
                 # send payload data to arq checker without CRC16
                 self.arq_data_received(
-                    bytes(bytes_out[:-2]), bytes_per_frame, snr, freedv
+                    bytes(bytes_out[:-2]), bytes_per_frame, snr, mode_name, telemetry
                 )
 
                 # if we received the last frame of a burst or the last remaining rpt frame, do a modem unsync
@@ -455,9 +461,9 @@ class DATA:
             c2_mode=FREEDV_MODE.sig0.value,
             copies=1,
             repeat_delay=0,
-    ) -> None:
+    ) -> "modem.Transmission":
         """
-        Send (transmit) supplied frame to TNC
+        Send (transmit) supplied frame to TNC and wait until it has been sent
 
         :param frame_to_tx: Frame data to send
         :type frame_to_tx: list of bytearrays
@@ -467,6 +473,8 @@ class DATA:
         :type copies: int, optional
         :param repeat_delay: Delay time before sending repeat frame, defaults to 0
         :type repeat_delay: int, optional
+        :return: completed transmission with the PTT timestamps, `ok` is False if it wasn't sent
+        :rtype: modem.Transmission
         """
         #print(frame_to_tx[0])
         #print(frame_to_tx)
@@ -474,14 +482,17 @@ class DATA:
         self.log.debug("[TNC] enqueue_frame_for_tx", c2_mode=FREEDV_MODE(c2_mode).name, data=frame_to_tx,
                        type=frame_type)
 
-        # Set the TRANSMITTING flag before adding an object to the transmit queue
-        # TODO: This is not that nice, we could improve this somehow
-        TNC.transmitting = True
-        modem.MODEM_TRANSMIT_QUEUE.put([c2_mode, copies, repeat_delay, frame_to_tx])
+        transmission = modem.enqueue_transmission(c2_mode, copies, repeat_delay, frame_to_tx)
 
         # Wait while transmitting
-        while TNC.transmitting:
-            threading.Event().wait(0.01)
+        transmission.wait()
+        if not transmission.ok:
+            self.log.warning(
+                "[TNC] enqueue_frame_for_tx: frame not transmitted",
+                type=frame_type,
+                dropped=transmission.dropped,
+            )
+        return transmission
 
     def send_data_to_socket_queue(self, **jsondata):
         """
@@ -532,43 +543,112 @@ class DATA:
         else:
             return ident_frame
 
-    def send_burst_ack_frame(self, snr) -> None:
-        """Build and send ACK frame for burst DATA frame"""
-
+    def build_burst_ack_frame(self, snr, speed_level: int, frame_buffer_length: int) -> bytearray:
+        """Build ACK frame for burst DATA frame"""
         ack_frame = bytearray(self.length_sig1_frame)
         ack_frame[:1] = bytes([FR_TYPE.BURST_ACK.value])
         ack_frame[1:2] = self.session_id
         ack_frame[2:3] = helpers.snr_to_bytes(snr)
-        ack_frame[3:4] = bytes([int(self.speed_level)])
-        ack_frame[4:8] = len(ARQ.rx_frame_buffer).to_bytes(4, byteorder="big")
+        ack_frame[3:4] = bytes([int(speed_level)])
+        ack_frame[4:8] = frame_buffer_length.to_bytes(4, byteorder="big")
+        return ack_frame
+
+    def build_data_ack_frame(self, snr) -> bytearray:
+        """Build ACK frame for received DATA frame"""
+        ack_frame = bytearray(self.length_sig1_frame)
+        ack_frame[:1] = bytes([FR_TYPE.FR_ACK.value])
+        ack_frame[1:2] = self.session_id
+        ack_frame[2:3] = helpers.snr_to_bytes(snr)
+        return ack_frame
+
+    def build_burst_nack_frame(self, snr, speed_level: int, frame_buffer_length: int) -> bytearray:
+        """Build NACK frame for received DATA frame"""
+        nack_frame = bytearray(self.length_sig1_frame)
+        nack_frame[:1] = bytes([FR_TYPE.FR_NACK.value])
+        nack_frame[1:2] = self.session_id
+        nack_frame[2:3] = helpers.snr_to_bytes(snr)
+        nack_frame[3:4] = bytes([int(speed_level)])
+        nack_frame[4:8] = frame_buffer_length.to_bytes(4, byteorder="big")
+        return nack_frame
+
+    def arq_predict_speed_level(self) -> int:
+        """Speed level the next call of arq_calculate_speed_level will most likely choose"""
+        if self.frame_received_counter + 1 >= 2:
+            new_speed_level = min(self.speed_level + 1, len(self.mode_list) - 1)
+            if self.speed_level_snr >= self.snr_list[new_speed_level]:
+                return new_speed_level
+        return self.speed_level
+
+    def arq_prerender_acknowledges(self, snr, burst_payload: int, final: bool = False) -> None:
+        """
+        Let the modem modulate the acknowledges of a burst before it has been received
+
+        Everything the acknowledge carries is known in advance except for the SNR
+        of the last frame, we take the SNR of the latest frame instead. The modem matches
+        the SNR in steps of modem.PRERENDER_SNR_STEP, so small changes of the SNR still
+        hit the pre-rendered acknowledge. If the acknowledge we send differs, it is
+        modulated when it is sent.
+
+        Args:
+          snr: SNR of the latest frame
+          burst_payload: bytes the burst is going to add to ARQ.rx_frame_buffer
+          final: the burst completes the data frame, so it is going to be answered
+            with a data ACK or NACK instead of a burst ACK
+        """
+        frame_buffer_length = len(ARQ.rx_frame_buffer) + burst_payload
+        if final:
+            modem.prerender_transmission(
+                FREEDV_MODE.sig1.value, 3, 0, [self.build_data_ack_frame(snr)]
+            )
+            nack_frame = self.build_burst_nack_frame(snr, self.speed_level, frame_buffer_length)
+            modem.prerender_transmission(FREEDV_MODE.sig1.value, 3, 0, [nack_frame])
+        else:
+            ack_frame = self.build_burst_ack_frame(
+                snr, self.arq_predict_speed_level(), frame_buffer_length
+            )
+            modem.prerender_transmission(FREEDV_MODE.sig1.value, 1, 0, [ack_frame])
+
+    def arq_log_acknowledge_latency(self, transmission: "modem.Transmission") -> None:
+        """Measure the time from the last received data frame to keying up for its acknowledge"""
+        if not transmission.ptt_on or not self.rx_last_frame_timestamp:
+            return
+        ARQ.arq_ack_latency = round((transmission.ptt_on - self.rx_last_frame_timestamp) * 1000)
+        self.log.debug(
+            "[TNC] ARQ | RX | acknowledge latency",
+            latency=ARQ.arq_ack_latency,
+            queue_wait=round(transmission.queue_wait * 1000),
+        )
+
+    def send_burst_ack_frame(self, snr) -> None:
+        """Build and send ACK frame for burst DATA frame"""
+
+        ack_frame = self.build_burst_ack_frame(snr, self.speed_level, len(ARQ.rx_frame_buffer))
 
         # wait while timeout not reached and our busy state is busy
-        channel_busy_timeout = time.time() + 5
-        while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-            threading.Event().wait(0.01)
+        self.wait_until_mode_fits_to_busy_slot(5)
 
         # Transmit frame
-        self.enqueue_frame_for_tx([ack_frame], c2_mode=FREEDV_MODE.sig1.value)
+        transmission = self.enqueue_frame_for_tx([ack_frame], c2_mode=FREEDV_MODE.sig1.value)
+        self.arq_log_acknowledge_latency(transmission)
 
     def send_data_ack_frame(self, snr) -> None:
         """Build and send ACK frame for received DATA frame"""
 
-        ack_frame = bytearray(self.length_sig1_frame)
-        ack_frame[:1] = bytes([FR_TYPE.FR_ACK.value])
-        ack_frame[1:2] = self.session_id
-        ack_frame[2:3] = helpers.snr_to_bytes(snr)
+        ack_frame = self.build_data_ack_frame(snr)
 
         # wait while timeout not reached and our busy state is busy
         channel_busy_timeout = time.time() + 5
-        while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-            threading.Event().wait(0.01)
+        self.wait_until_mode_fits_to_busy_slot(5)
 
         # reset burst timeout in case we had to wait too long
         self.burst_last_received = time.time() + channel_busy_timeout + 8
         # Transmit frame
         # TODO: Do we have to send , self.send_ident_frame(False) ?
         # self.enqueue_frame_for_tx([ack_frame, self.send_ident_frame(False)], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0)
-        self.enqueue_frame_for_tx([ack_frame], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0)
+        transmission = self.enqueue_frame_for_tx(
+            [ack_frame], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0
+        )
+        self.arq_log_acknowledge_latency(transmission)
 
     def send_retransmit_request_frame(self) -> None:
         # check where a None is in our burst buffer and do frame+1, because lists start at 0
@@ -592,23 +672,19 @@ class DATA:
     def send_burst_nack_frame(self, snr: bytes) -> None:
         """Build and send NACK frame for received DATA frame"""
 
-        nack_frame = bytearray(self.length_sig1_frame)
-        nack_frame[:1] = bytes([FR_TYPE.FR_NACK.value])
-        nack_frame[1:2] = self.session_id
-        nack_frame[2:3] = helpers.snr_to_bytes(snr)
-        nack_frame[3:4] = bytes([int(self.speed_level)])
-        nack_frame[4:8] = len(ARQ.rx_frame_buffer).to_bytes(4, byteorder="big")
+        nack_frame = self.build_burst_nack_frame(snr, self.speed_level, len(ARQ.rx_frame_buffer))
 
         # TRANSMIT NACK FRAME FOR BURST
         # TODO: Do we have to send ident frame?
         # self.enqueue_frame_for_tx([ack_frame, self.send_ident_frame(False)], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0)
 
         # wait while timeout not reached and our busy state is busy
-        channel_busy_timeout = time.time() + 5
-        while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-            threading.Event().wait(0.01)
+        self.wait_until_mode_fits_to_busy_slot(5)
 
-        self.enqueue_frame_for_tx([nack_frame], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0)
+        transmission = self.enqueue_frame_for_tx(
+            [nack_frame], c2_mode=FREEDV_MODE.sig1.value, copies=3, repeat_delay=0
+        )
+        self.arq_log_acknowledge_latency(transmission)
         # reset burst timeout in case we had to wait too long
         self.burst_last_received = time.time()
 
@@ -634,9 +710,7 @@ class DATA:
 
 
         # wait while timeout not reached and our busy state is busy
-        channel_busy_timeout = time.time() + 5 + 5
-        while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-            threading.Event().wait(0.01)
+        self.wait_until_mode_fits_to_busy_slot(5 + 5)
 
         # TRANSMIT NACK FRAME FOR BURST
         self.enqueue_frame_for_tx([nack_frame], c2_mode=FREEDV_MODE.sig1.value, copies=1, repeat_delay=0)
@@ -657,27 +731,27 @@ class DATA:
         # TODO: Maybe about 500ms - 1500ms to avoid confusion and too much PTT toggles
 
         # wait while timeout not reached and our busy state is busy
-        channel_busy_timeout = time.time() + 5
-        while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-            threading.Event().wait(0.01)
+        self.wait_until_mode_fits_to_busy_slot(5)
 
         self.enqueue_frame_for_tx([disconnection_frame], c2_mode=FREEDV_MODE.sig0.value, copies=3, repeat_delay=0)
 
     def arq_data_received(
-            self, data_in: bytes, bytes_per_frame: int, snr: float, freedv
+            self, data_in: bytes, bytes_per_frame: int, snr: float, mode_name: str, telemetry=None
     ) -> None:
         """
         Args:
           data_in:bytes:
           bytes_per_frame:int:
           snr:float:
-          freedv:
+          mode_name: name of the demodulator of the frame
+          telemetry: telemetry.DecoderTelemetry of the decoder of the frame
 
         Returns:
         """
         # We've arrived here from process_data which already checked that the frame
         # is intended for this station.
         data_in = bytes(data_in)
+        self.rx_last_frame_timestamp = time.time()
 
         # only process data if we are in ARQ and BUSY state else return to quit
         if not ARQ.arq_state and TNC.tnc_state not in ["BUSY"]:
@@ -690,6 +764,9 @@ class DATA:
         TNC.tnc_state = "BUSY"
         ARQ.arq_state = True
 
+        # the speed level follows the average SNR of this mode, not the SNR of a single frame
+        self.speed_level_snr = snr if telemetry is None else telemetry.average_snr(snr)
+
         # Update data_channel timestamp
         self.data_channel_last_received = int(time.time())
         self.burst_last_received = int(time.time())
@@ -709,6 +786,14 @@ class DATA:
         # Append data to rx burst buffer
         ARQ.rx_burst_buffer[self.rx_n_frame_of_burst] = data_in[self.arq_burst_header_size:]  # type: ignore
 
+        # more frames of this burst to come, modulate its acknowledge meanwhile
+        if None in ARQ.rx_burst_buffer:
+            self.arq_prerender_acknowledges(
+                snr,
+                len(data_in[self.arq_burst_header_size:]) * self.rx_n_frames_per_burst,
+                final=data_in.find(self.data_frame_eof) >= 0,
+            )
+
         Station.dxgrid = b'------'
         helpers.add_to_heard_stations(
             Station.dxcallsign,
@@ -809,7 +894,7 @@ class DATA:
                     and not self.rx_frame_eof_received
                     and data_in.find(self.data_frame_eof) < 0
             ):
-                self.arq_calculate_speed_level(snr)
+                self.arq_calculate_speed_level(self.speed_level_snr)
 
                 self.data_channel_last_received = int(time.time()) + 6 + 6
                 self.burst_last_received = int(time.time()) + 6 + 6
@@ -819,6 +904,14 @@ class DATA:
 
                 self.send_burst_ack_frame(snr)
 
+                # the next burst is sent with the mode of our speed level,
+                # modulate its acknowledge while we are waiting for it
+                next_burst_payload = (
+                    codec2.get_mode_info(self.mode_list[self.speed_level]).payload_per_frame
+                    - self.arq_burst_header_size
+                )
+                self.arq_prerender_acknowledges(snr, next_burst_payload * self.rx_n_frames_per_burst)
+
                 # Reset n retries per burst counter
                 self.n_retries_per_burst = 0
 
@@ -978,18 +1071,32 @@ class DATA:
 
         """
         mode_name = FREEDV_MODE(self.mode_list[self.speed_level]).name
-        mode_slots = FREEDV_MODE_USED_SLOTS[mode_name].value
-        if mode_slots in [ModemParam.channel_busy_slot]:
+        if not CHANNEL_OCCUPANCY.mode_is_free(mode_name):
             self.log.warning(
                 "[TNC] busy slot detection",
                 slots=ModemParam.channel_busy_slot,
-                mode_slots=mode_slots,
+                mode_slots=FREEDV_MODE_USED_SLOTS[mode_name].value,
             )
             return False
 
         else:
             return True
 
+    def wait_until_mode_fits_to_busy_slot(self, timeout: float) -> bool:
+        """
+        Wait until the slots of the actual mode are free, woken by the busy detection
+
+        Args:
+            timeout: seconds
+
+        Returns:
+            False if the slots are still busy after `timeout`
+        """
+        mode_name = FREEDV_MODE(self.mode_list[self.speed_level]).name
+        return self.check_if_mode_fits_to_busy_slot() or CHANNEL_OCCUPANCY.wait_free(
+            FREEDV_MODE_USED_SLOTS[mode_name].value, timeout
+        )
+
     def arq_calculate_speed_level(self, snr):
         self.frame_received_counter += 1
         # try increasing speed level only if we had two successful decodes
@@ -999,13 +1106,13 @@ class DATA:
             # make sure new speed level isn't higher than available modes
             new_speed_level = min(self.speed_level + 1, len(self.mode_list) - 1)
             # check if actual snr is higher than minimum snr for next mode
-            if ModemParam.snr >= self.snr_list[new_speed_level]:
+            if snr >= self.snr_list[new_speed_level]:
                 self.speed_level = new_speed_level
 
 
             else:
                 self.log.info("[TNC] ARQ | increasing speed level not possible because of SNR limit",
-                              given_snr=ModemParam.snr,
+                              given_snr=snr,
                               needed_snr=self.snr_list[new_speed_level]
                               )
 
@@ -1698,12 +1805,8 @@ class DATA:
             )
 
             # wait while timeout not reached and our busy state is busy
-            channel_busy_timeout = time.time() + 15
-            while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-                threading.Event().wait(0.01)
-
             # if channel busy timeout reached stop connecting
-            if time.time() > channel_busy_timeout:
+            if not self.wait_until_mode_fits_to_busy_slot(15):
                 self.log.warning("[TNC] Channel busy, try again later...")
                 ARQ.arq_session_state = "failed"
                 self.send_data_to_socket_queue(
@@ -2185,9 +2288,7 @@ class DATA:
                     )
 
                     # wait while timeout not reached and our busy state is busy
-                    channel_busy_timeout = time.time() + 5
-                    while ModemParam.channel_busy and time.time() < channel_busy_timeout and not self.check_if_mode_fits_to_busy_slot():
-                        threading.Event().wait(0.01)
+                    self.wait_until_mode_fits_to_busy_slot(5)
 
                 self.enqueue_frame_for_tx([connection_frame], c2_mode=FREEDV_MODE.sig0.value, copies=1, repeat_delay=0)
 
@@ -2345,7 +2446,7 @@ class DATA:
         # calculate if speed level fits to busy condition
         mode_name = codec2.FREEDV_MODE(self.mode_list[self.speed_level]).name
         mode_slots = codec2.FREEDV_MODE_USED_SLOTS[mode_name].value
-        if mode_slots in [ModemParam.channel_busy_slot]:
+        if not CHANNEL_OCCUPANCY.is_free(mode_slots):
             self.speed_level = 0
             self.log.warning(
                 "[TNC] busy slot detection",
@@ -3163,7 +3264,7 @@ class DATA:
         modem.RECEIVE_FSK_LDPC_1 = False
 
         # reset buffer overflow counter
-        AudioParam.buffer_overflow_counter = [0, 0, 0, 0, 0]
+        AudioParam.buffer_overflow_counter = [0, 0, 0, 0, 0, 0, 0]
 
         self.is_IRS = False
         self.burst_nack = False
@@ -0,0 +1,650 @@
+"""
+Event driven demodulation of received audio.
+
+The audio producer (PortAudio callback, TCI or mkfifo) pushes samples into the
+shared rx audio buffer and notifies the DemodulatorScheduler. Only demodulators
+of enabled modes with at least `nin` samples waiting are woken, so idle modes
+don't cause any wakeups. Codec2 instances are opened when a mode gets enabled
+and closed again if it hasn't been used for the grace period.
+
+Optionally DemodulatorProcesses runs every demodulator in its own worker
+process, reading from a process_shared_audio_buffer.
+"""
+import ctypes
+import multiprocessing
+import queue
+import threading
+import time
+
+import codec2
+import numpy as np
+import structlog
+import telemetry
+from static import ModemParam
+
+
+# weight of a new value for the average latency
+LATENCY_AVG_WEIGHT = 0.1
+
+
+def get_snr(freedv: ctypes.c_void_p) -> float:
+    """
+    Ask codec2 for the signal-to-noise ratio of the received signal
+
+    :param freedv: codec2 instance to query
+    :type freedv: ctypes.c_void_p
+    :return: Signal-to-noise ratio
+    :rtype: float
+    """
+    modem_stats_snr = ctypes.c_float()
+    modem_stats_sync = ctypes.c_int()
+
+    codec2.api.freedv_get_modem_stats(
+        freedv, ctypes.byref(modem_stats_sync), ctypes.byref(modem_stats_snr)
+    )
+    return round(modem_stats_snr.value, 1)
+
+
+def get_scatter(freedv: ctypes.c_void_p, stats: codec2.modem_stats) -> np.ndarray:
+    """
+    Ask codec2 for the received symbols and calculate the scatter plot
+
+    :param freedv: codec2 instance to query
+    :type freedv: ctypes.c_void_p
+    :param stats: reused modem stats of the codec2 instance
+    :type stats: codec2.modem_stats
+    :return: scatter plot data points as np.int16 [x, y] pairs
+    :rtype: np.ndarray
+    """
+    return stats.update(freedv).scatter()
+
+
+def scatter_points(scatter) -> list:
+    """
+    Convert a scatter plot of get_scatter to the points sent to the GUI
+
+    :param scatter: np.int16 [x, y] pairs or an empty list
+    :type scatter: np.ndarray
+    :return: [{"x": "1", "y": "-2"}, ...]
+    :rtype: list
+    """
+    return [{"x": str(x), "y": str(y)} for x, y in np.asarray(scatter).reshape(-1, 2).tolist()]
+
+
+class Demodulator:
+    """
+    Codec2 rx instance of a mode reading from the shared rx audio buffer
+
+    The codec2 instance is opened the first time it is acquired, usually when its
+    mode gets enabled, and closed again by close_if_idle() after it has not been
+    used for `grace_period` seconds.
+    """
+
+    log = structlog.get_logger("Demodulator")
+
+    def __init__(
+            self,
+            name: str,
+            mode: int,
+            audiobuffer: codec2.audio_buffer_reader,
+            state_buffer: list,
+            tuning_range: tuple = None,
+            grace_period: float = 0,
+    ) -> None:
+        """
+        Args:
+            name: name of the demodulator, e.g. sig0-datac13
+            mode: codec2 mode
+            audiobuffer: read cursor into the shared rx audio buffer
+            state_buffer: list for collecting failed decodings
+            tuning_range: (fmin, fmax), defaults to the ModemParam tuning range
+            grace_period: seconds until an unused codec2 instance gets closed, 0 keeps it open
+        """
+        mode_info = codec2.get_mode_info(mode)
+        self.name = name
+        self.mode = mode
+        self.freedv = None
+        self.bytes_per_frame = mode_info.bytes_per_frame
+        self.bytes_out = ctypes.create_string_buffer(self.bytes_per_frame)
+        self.audiobuffer = audiobuffer
+        self.nin = mode_info.nin
+        self.state_buffer = state_buffer
+        self.tuning_range = tuning_range or (ModemParam.tuning_range_fmin, ModemParam.tuning_range_fmax)
+        self.grace_period = grace_period
+        self.frames_per_burst = 1
+        # extended modem stats of the latest freedv_rawdatarx call, allocated on first use
+        self.modem_stats = None
+        self.telemetry = telemetry.DecoderTelemetry()
+
+        # reference counting of the codec2 instance
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.monotonic()
+
+        # set by the scheduler if there is audio to demodulate
+        self.event = threading.Event()
+        self.ready_time = 0.0
+
+        # statistics
+        self.startup_time = 0.0
+        self.wakeups = 0
+        self.idle_wakeups = 0
+        self.demod_calls = 0
+        self.frames = 0
+        self.cpu_time = 0.0
+        self.latency = 0.0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+
+    def open(self) -> None:
+        """Open and configure the codec2 instance"""
+        start = time.perf_counter()
+        self.freedv = codec2.open_instance(self.mode)
+        # set tuning range
+        codec2.api.freedv_set_tuning_range(
+            self.freedv,
+            ctypes.c_float(self.tuning_range[0]),
+            ctypes.c_float(self.tuning_range[1]),
+        )
+        codec2.api.freedv_set_frames_per_burst(self.freedv, self.frames_per_burst)
+        self.nin = codec2.api.freedv_nin(self.freedv)
+        self.startup_time = time.perf_counter() - start
+        self.log.info(
+            "[MDM] opened codec2 instance", mode=self.name, startup_time=round(self.startup_time * 1000, 2)
+        )
+
+    def acquire(self) -> ctypes.c_void_p:
+        """Return the codec2 instance and keep it open until release() is called"""
+        with self.lock:
+            if self.freedv is None:
+                self.open()
+            self.users += 1
+            return self.freedv
+
+    def release(self) -> None:
+        """Release a codec2 instance returned by acquire()"""
+        with self.lock:
+            self.users -= 1
+            self.last_used = time.monotonic()
+
+    def idle(self, now: float) -> bool:
+        """Check if the codec2 instance is open, but hasn't been used for the grace period"""
+        return (
+            self.freedv is not None
+            and self.grace_period > 0
+            and not self.users
+            and not self.audiobuffer.active
+            and now - self.last_used > self.grace_period
+        )
+
+    def close_if_idle(self) -> bool:
+        """Close the codec2 instance if it is idle, returns True if closed"""
+        with self.lock:
+            if not self.idle(time.monotonic()):
+                return False
+            codec2.api.freedv_close(self.freedv)
+            self.freedv = None
+            self.nin = codec2.get_mode_info(self.mode).nin
+        self.log.info("[MDM] closed idle codec2 instance", mode=self.name)
+        return True
+
+    def command(self, command: str, value: int) -> None:
+        """
+        Apply a command to the codec2 instance, if it is open
+
+        Args:
+            command: "frames_per_burst" or "sync"
+            value: value of the command
+        """
+        with self.lock:
+            if command == "frames_per_burst":
+                self.frames_per_burst = value
+                if self.freedv is not None:
+                    codec2.api.freedv_set_frames_per_burst(self.freedv, value)
+            elif command == "sync" and self.freedv is not None:
+                codec2.api.freedv_set_sync(self.freedv, value)
+
+    def get_modem_stats(self) -> codec2.modem_stats:
+        """Return the modem stats reused for every query of our codec2 instance"""
+        if self.modem_stats is None:
+            self.modem_stats = codec2.modem_stats()
+        return self.modem_stats
+
+    def record_telemetry(self, rx_status: int) -> None:
+        """Record the modem state after a freedv_rawdatarx call, on_rx of codec2.demodulate"""
+        self.telemetry.record(rx_status, self.get_modem_stats().update(self.freedv))
+
+    def demodulate(self, on_frame, on_rx_status=None) -> int:
+        """
+        Demodulate all audio waiting in our reader with the codec2 instance
+
+        The codec2 instance is opened if we just started listening to this mode,
+        and kept open while demodulating. Decoded frames are placed into `bytes_out`.
+
+        Args:
+            on_frame: called with every decoded frame and the absolute sample
+                      position of its end in the audio of the reader
+            on_rx_status: called with the rx status of every freedv_rawdatarx call
+
+        Returns:
+            number of freedv_rawdatarx calls
+        """
+        audiobuffer = self.audiobuffer
+        nbuffer = audiobuffer.nbuffer
+        if nbuffer < self.nin:
+            return 0
+
+        def on_decoded(frame: bytes, nsamples: int) -> None:
+            on_frame(frame, audiobuffer.position + nsamples)
+
+        demod_calls = 0
+        freedv = self.acquire()
+        try:
+            while nbuffer >= self.nin:
+                # demodulate all audio we have in one go
+                result = codec2.demodulate(
+                    freedv,
+                    audiobuffer.buffer[:nbuffer],
+                    self.nin,
+                    self.bytes_out,
+                    on_decoded,
+                    self.record_telemetry,
+                )
+                demod_calls += len(result.rx_status)
+                if on_rx_status is not None:
+                    for rx_status in result.rx_status:
+                        on_rx_status(rx_status)
+
+                audiobuffer.pop(result.nsamples)
+                self.nin = result.nin
+                nbuffer = audiobuffer.nbuffer
+        finally:
+            self.release()
+        return demod_calls
+
+    def ready(self) -> bool:
+        """Check if we have at least nin samples to demodulate"""
+        return self.audiobuffer.ready(self.nin)
+
+    def backlog(self) -> int:
+        """Number of received samples waiting for this demodulator"""
+        return self.audiobuffer.backlog()
+
+    def update_stats(self, demod_calls: int, cpu_time: float, latency: float) -> None:
+        """Add the results of a demodulation run to our statistics"""
+        self.demod_calls += demod_calls
+        self.cpu_time += cpu_time
+        self.latency = latency
+        self.latency_avg += LATENCY_AVG_WEIGHT * (latency - self.latency_avg)
+        self.latency_max = max(self.latency_max, latency)
+        ModemParam.demodulator_stats[self.name] = self.stats()
+
+    def stats(self) -> dict:
+        """Return statistics of this demodulator"""
+        return {
+            "startup_time": round(self.startup_time * 1000, 2),
+            "wakeups": self.wakeups,
+            "idle_wakeups": self.idle_wakeups,
+            "demod_calls": self.demod_calls,
+            "frames": self.frames,
+            "cpu_time": round(self.cpu_time, 3),
+            "latency": round(self.latency * 1000, 2),
+            "latency_avg": round(self.latency_avg * 1000, 2),
+            "latency_max": round(self.latency_max * 1000, 2),
+            "telemetry": self.telemetry.aggregates(),
+        }
+
+
+class DemodulatorScheduler:
+    """
+    Wake demodulators only if new audio arrived for them
+
+    Every demodulator has its own worker thread, because codec2 releases the GIL
+    while demodulating, so modes can still be demodulated in parallel.
+    The worker is waiting for an event, which is set by notify() from the
+    audio producer as soon as `nin` samples are available.
+    """
+
+    log = structlog.get_logger("DemodulatorScheduler")
+
+    def __init__(self, demodulate) -> None:
+        """
+        Args:
+            demodulate: function called with a Demodulator, which demodulates
+                        all available audio and returns the number of
+                        freedv_rawdatarx calls
+        """
+        self.demodulate = demodulate
+        self.demodulators = []
+
+    def add(self, demodulator: Demodulator) -> None:
+        """Add a demodulator and start its worker thread"""
+        self.demodulators.append(demodulator)
+        worker = threading.Thread(
+            target=self.worker,
+            args=[demodulator],
+            name=f"DEMODULATOR {demodulator.name}",
+            daemon=True,
+        )
+        worker.start()
+
+    def notify(self) -> None:
+        """Called by the audio producer after pushing new samples"""
+        now = time.monotonic()
+        for demodulator in self.demodulators:
+            if demodulator.event.is_set():
+                continue
+            if demodulator.ready():
+                demodulator.ready_time = time.perf_counter()
+                demodulator.event.set()
+            elif demodulator.idle(now):
+                # let the worker close the codec2 instance of a disabled mode
+                demodulator.event.set()
+
+    def command(self, names: list, command: str, value: int) -> None:
+        """
+        Apply a command to the codec2 instances of the demodulators `names`
+
+        Args:
+            names: demodulator names
+            command: "frames_per_burst" or "sync"
+            value: value of the command
+        """
+        for demodulator in self.demodulators:
+            if demodulator.name in names:
+                demodulator.command(command, value)
+
+    def worker(self, demodulator: Demodulator) -> None:
+        """Demodulate audio of a single mode whenever we are notified"""
+        while True:
+            demodulator.event.wait()
+            demodulator.event.clear()
+            if demodulator.close_if_idle():
+                continue
+            demodulator.wakeups += 1
+
+            cpu_start = time.thread_time()
+            try:
+                demod_calls = self.demodulate(demodulator)
+            except Exception as err:
+                self.log.warning("[MDM] [demod_audio] demodulation failed", mode=demodulator.name, e=err)
+                continue
+
+            if not demod_calls:
+                demodulator.idle_wakeups += 1
+                continue
+
+            # latency from the arrival of the audio until we finished demodulating it
+            demodulator.update_stats(
+                demod_calls,
+                time.thread_time() - cpu_start,
+                time.perf_counter() - demodulator.ready_time,
+            )
+
+    def backlog(self) -> int:
+        """Largest number of received samples waiting for a demodulator"""
+        return max((demodulator.backlog() for demodulator in self.demodulators), default=0)
+
+    def stats(self) -> dict:
+        """Return statistics of all demodulators by mode name"""
+        return {demodulator.name: demodulator.stats() for demodulator in self.demodulators}
+
+
+# seconds a demodulator process waits for audio before checking if the TNC process is still alive
+PARENT_CHECK_INTERVAL = 1.0
+
+
+class DemodulatorState(ctypes.Structure):
+    """State of a demodulator process, shared with the TNC process"""
+
+    _fields_ = [
+        ("active", ctypes.c_bool),  # set by the TNC process
+        ("ready_time", ctypes.c_double),  # set by the TNC process
+        ("position", ctypes.c_int64),  # read position of the demodulator
+        ("nin", ctypes.c_int),  # samples the demodulator needs for the next run
+    ]
+
+
+def demodulator_process(
+        name: str,
+        mode: int,
+        store: codec2.process_shared_audio_buffer,
+        history: int,
+        state: DemodulatorState,
+        event,
+        commands,
+        results,
+        parent_pipe,
+        tuning_range: tuple,
+        enable_scatter: bool,
+        grace_period: float,
+) -> None:
+    """
+    Worker process demodulating audio of a single mode
+
+    Decoded frames, changes of the modem state, telemetry and statistics are sent
+    to the TNC process with the `results` queue as (name, type, values...)
+    The TNC process holds the sending end of `parent_pipe`, so the pipe becomes
+    readable (EOF) as soon as the TNC process is gone.
+    """
+    audiobuffer = store.reader(history=history)
+    # samples pushed while we were starting up are still waiting for us
+    audiobuffer.activate_at(state.position)
+    demodulator = Demodulator(name, mode, audiobuffer, [], tuning_range, grace_period)
+    state.nin = demodulator.nin
+    last_rx_status = 0
+
+    def on_frame(frame: bytes, _) -> None:
+        scatter = get_scatter(demodulator.freedv, demodulator.get_modem_stats()) if enable_scatter else []
+        # the TNC process needs the telemetry up to this frame for the ARQ speed level
+        results.put((name, "telemetry", demodulator.telemetry.pending()))
+        results.put((name, "frame", frame, demodulator.telemetry.snr, scatter))
+
+    def on_rx_status(rx_status: int) -> None:
+        nonlocal last_rx_status
+        if rx_status != last_rx_status or rx_status == 10:
+            results.put((name, "status", rx_status))
+            last_rx_status = rx_status
+
+    while True:
+        if not event.wait(PARENT_CHECK_INTERVAL):
+            # exit if the TNC process is gone without terminating us
+            if parent_pipe.poll():
+                return
+            audiobuffer.active = state.active
+            demodulator.close_if_idle()
+            continue
+        event.clear()
+
+        while True:
+            try:
+                command, value = commands.get_nowait()
+            except queue.Empty:
+                break
+            demodulator.command(command, value)
+
+        audiobuffer.active = state.active
+        if audiobuffer.active:
+            # continue where the TNC process expects us to, see DemodulatorProcesses.notify
+            audiobuffer.activate_at(state.position)
+        overflows = int(audiobuffer.overrun)
+
+        cpu_start = time.thread_time()
+        opened = demodulator.freedv is None
+        demod_calls = demodulator.demodulate(on_frame, on_rx_status)
+        if opened and demodulator.freedv is not None:
+            results.put((name, "open", demodulator.startup_time))
+
+        state.nin = demodulator.nin
+        state.position = audiobuffer.position
+        if demod_calls:
+            results.put((name, "telemetry", demodulator.telemetry.pending()))
+        results.put(
+            (
+                name,
+                "stats",
+                demod_calls,
+                time.thread_time() - cpu_start,
+                time.perf_counter() - state.ready_time,
+                overflows,
+            )
+        )
+
+
+class DemodulatorProcesses:
+    """
+    Run every demodulator in its own worker process
+
+    Same interface as DemodulatorScheduler, but the demodulators don't share
+    the GIL with the TNC. Audio is passed with a process_shared_audio_buffer.
+    The worker opens its own codec2 instance of the demodulator mode
+    as soon as there is audio for it. Modem
+    states and decoded frames come back with a queue and are handled in the
+    TNC process by `process_rx_status` and `process_frame`.
+    """
+
+    log = structlog.get_logger("DemodulatorProcesses")
+
+    def __init__(
+            self,
+            store: codec2.process_shared_audio_buffer,
+            history: int,
+            process_rx_status,
+            process_frame,
+    ) -> None:
+        """
+        Args:
+            store: shared audio buffer written by the audio producer
+            history: samples a demodulator starts with when its mode gets enabled
+            process_rx_status: function called with a Demodulator and its rx status
+            process_frame: function called with a Demodulator, the decoded
+                           bytes, snr and scatter data
+        """
+        # spawn new processes instead of forking our threads and audio device
+        self.context = multiprocessing.get_context("spawn")
+        self.store = store
+        self.history = history
+        self.process_rx_status = process_rx_status
+        self.process_frame = process_frame
+        self.results = self.context.Queue()
+        self.demodulators = {}
+        self.workers = []
+        # sending ends of the pipes the workers watch to notice that we are gone
+        self.parent_pipes = []
+
+        results_thread = threading.Thread(
+            target=self.worker_results, name="DEMODULATOR RESULTS", daemon=True
+        )
+        results_thread.start()
+
+    def add(self, demodulator: Demodulator) -> None:
+        """Add a demodulator and start its worker process"""
+        state = multiprocessing.RawValue(DemodulatorState)
+        state.nin = demodulator.nin
+        state.position = self.store._wr
+        event = self.context.Event()
+        commands = self.context.Queue()
+        # we only keep the sending end, the worker sees EOF if we exit
+        parent_pipe, parent_alive = self.context.Pipe(duplex=False)
+
+        process = self.context.Process(
+            target=demodulator_process,
+            args=(
+                demodulator.name,
+                demodulator.mode,
+                self.store,
+                self.history,
+                state,
+                event,
+                commands,
+                self.results,
+                parent_pipe,
+                demodulator.tuning_range,
+                ModemParam.enable_scatter,
+                demodulator.grace_period,
+            ),
+            name=f"DEMODULATOR {demodulator.name}",
+            daemon=True,
+        )
+        process.start()
+        parent_pipe.close()
+        self.log.info("[MDM] started demodulator process", mode=demodulator.name, pid=process.pid)
+
+        demodulator.event = event
+        self.demodulators[demodulator.name] = demodulator
+        self.workers.append((demodulator, state, commands, process))
+        self.parent_pipes.append(parent_alive)
+
+    def notify(self) -> None:
+        """Called by the audio producer after pushing new samples"""
+        wr = self.store._wr
+        for demodulator, state, _, _ in self.workers:
+            active = demodulator.audiobuffer.active
+            if active != state.active:
+                # wake the worker also if its mode gets disabled, so it resets its reader
+                if active:
+                    # the worker starts with the last `history` samples, count them from now on
+                    state.position = max(state.position, wr - self.history)
+                state.active = active
+                demodulator.event.set()
+            elif active and not demodulator.event.is_set() and wr - state.position >= state.nin:
+                state.ready_time = time.perf_counter()
+                demodulator.event.set()
+
+    def command(self, names: list, command: str, value: int) -> None:
+        """
+        Send a command to the codec2 instances of the demodulators `names`
+
+        Args:
+            names: demodulator names
+            command: "frames_per_burst" or "sync"
+            value: value of the command
+        """
+        for demodulator, _, commands, _ in self.workers:
+            if demodulator.name in names:
+                commands.put((command, value))
+                demodulator.event.set()
+
+    def backlog(self) -> int:
+        """Largest number of received samples waiting for a demodulator process"""
+        wr = self.store._wr
+        return max(
+            (min(wr - state.position, self.store.size) for _, state, _, _ in self.workers if state.active),
+            default=0,
+        )
+
+    def stop(self) -> None:
+        """Terminate all demodulator processes"""
+        for _, _, _, process in self.workers:
+            process.terminate()
+            process.join()
+
+    def worker_results(self) -> None:
+        """Process modem states, frames and statistics of the demodulator processes"""
+        while True:
+            name, result, *values = self.results.get()
+            demodulator = self.demodulators[name]
+            try:
+                if result == "status":
+                    self.process_rx_status(demodulator, values[0])
+                elif result == "open":
+                    demodulator.startup_time = values[0]
+                elif result == "telemetry":
+                    demodulator.telemetry.extend(values[0])
+                elif result == "frame":
+                    demodulator.frames += 1
+                    self.process_frame(demodulator, *values)
+                else:
+                    demod_calls, cpu_time, latency, overflows = values
+                    demodulator.wakeups += 1
+                    demodulator.audiobuffer.overflows += overflows
+                    if demod_calls:
+                        demodulator.update_stats(demod_calls, cpu_time, latency)
+                    else:
+                        demodulator.idle_wakeups += 1
+            except Exception as err:
+                self.log.warning("[MDM] [demod_audio] processing demodulator result failed", mode=name, e=err)
+
+    def stats(self) -> dict:
+        """Return statistics of all demodulators by mode name"""
+        return {name: demodulator.stats() for name, demodulator in self.demodulators.items()}
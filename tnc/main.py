@@ -23,6 +23,7 @@ import socketserver
 import sys
 import threading
 import time
+import codec2
 import config
 import data_handler
 import helpers
@@ -165,6 +166,34 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable FSK mode for ping, beacon and CQ",
     )
+    PARSER.add_argument(
+        "--demod-processes",
+        dest="enable_demod_processes",
+        action="store_true",
+        help="Run codec2 demodulators in separate processes for using more CPU cores",
+    )
+    PARSER.add_argument(
+        "--decoder-grace-period",
+        dest="decoder_grace_period",
+        default=60.0,
+        type=float,
+        help="Seconds until the codec2 instance of a mode we stopped listening to gets closed, 0 keeps it open",
+    )
+    PARSER.add_argument(
+        "--libcodec2",
+        dest="libcodec2",
+        default="",
+        type=str,
+        help="Path of libcodec2, searched if not set",
+    )
+    PARSER.add_argument(
+        "--modem-backend",
+        dest="modem_backend",
+        default="",
+        choices=list(codec2.BACKENDS),
+        type=str,
+        help="Modem backend, numpy is a stand-in for libcodec2 for tests and benchmarks",
+    )
     PARSER.add_argument(
         "--qrv",
         dest="enable_respond_to_cq",
@@ -294,6 +323,12 @@ if __name__ == "__main__":
             ModemParam.enable_scatter = ARGS.send_scatter
             AudioParam.enable_fft = ARGS.send_fft
             TNC.enable_fsk = ARGS.enable_fsk
+            ModemParam.enable_demod_processes = ARGS.enable_demod_processes
+            ModemParam.decoder_grace_period = ARGS.decoder_grace_period
+            if ARGS.libcodec2:
+                codec2.set_library_path(ARGS.libcodec2)
+            if ARGS.modem_backend:
+                codec2.set_backend(ARGS.modem_backend)
             TNC.low_bandwidth_mode = ARGS.low_bandwidth_mode
             ModemParam.tuning_range_fmin = ARGS.tuning_range_fmin
             ModemParam.tuning_range_fmax = ARGS.tuning_range_fmax
@@ -345,6 +380,14 @@ if __name__ == "__main__":
             ModemParam.enable_scatter = conf.get('TNC', 'scatter', 'True')
             AudioParam.enable_fft = conf.get('TNC', 'fft', 'True')
             TNC.enable_fsk = conf.get('TNC', 'fsk', 'False')
+            ModemParam.enable_demod_processes = conf.get('TNC', 'demod_processes', 'False')
+            ModemParam.decoder_grace_period = float(conf.get('TNC', 'decoder_grace_period', '60.0'))
+            libcodec2 = conf.get('TNC', 'libcodec2', '')
+            if libcodec2:
+                codec2.set_library_path(libcodec2)
+            modem_backend = conf.get('TNC', 'modem_backend', '')
+            if modem_backend:
+                codec2.set_backend(modem_backend)
             TNC.low_bandwidth_mode = conf.get('TNC', 'narrowband', 'False')
             ModemParam.tuning_range_fmin = float(conf.get('TNC', 'fmin', '-50.0'))
             ModemParam.tuning_range_fmax = float(conf.get('TNC', 'fmax', '50.0'))
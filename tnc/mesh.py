@@ -233,14 +233,14 @@ class MeshRouter():
                         #print(len(_))
                         frame_list.append(mesh_broadcast_frame_header + _)
 
-                    TNC.transmitting = True
                     c2_mode = FREEDV_MODE.datac4.value
                     self.log.info("[MESH] broadcasting routing table", frame_list=frame_list, frames=len(split_result))
-                    modem.MODEM_TRANSMIT_QUEUE.put([c2_mode, 1, 0, frame_list])
+                    transmission = modem.enqueue_transmission(c2_mode, 1, 0, frame_list)
 
                     # Wait while transmitting
-                    while TNC.transmitting:
-                        threading.Event().wait(0.01)
+                    transmission.wait()
+                    if not transmission.ok:
+                        self.log.warning("[MESH] routing table not transmitted", dropped=transmission.dropped)
                 except Exception as e:
                     self.log.warning("[MESH] broadcasting routing table", e=e)
 
@@ -499,9 +499,9 @@ class MeshRouter():
             c2_mode=FREEDV_MODE.sig0.value,
             copies=1,
             repeat_delay=0,
-    ) -> None:
+    ) -> "modem.Transmission":
         """
-        Send (transmit) supplied frame to TNC
+        Send (transmit) supplied frame to TNC and wait until it has been sent
 
         :param frame_to_tx: Frame data to send
         :type frame_to_tx: list of bytearrays
@@ -511,6 +511,8 @@ class MeshRouter():
         :type copies: int, optional
         :param repeat_delay: Delay time before sending repeat frame, defaults to 0
         :type repeat_delay: int, optional
+        :return: completed transmission with the PTT timestamps, `ok` is False if it wasn't sent
+        :rtype: modem.Transmission
         """
         #print(frame_to_tx[0])
         #print(frame_to_tx)
@@ -518,14 +520,17 @@ class MeshRouter():
         self.log.debug("[TNC] enqueue_frame_for_tx", c2_mode=FREEDV_MODE(c2_mode).name, data=frame_to_tx,
                        type=frame_type)
 
-        # Set the TRANSMITTING flag before adding an object to the transmit queue
-        # TODO: This is not that nice, we could improve this somehow
-        TNC.transmitting = True
-        modem.MODEM_TRANSMIT_QUEUE.put([c2_mode, copies, repeat_delay, frame_to_tx])
+        transmission = modem.enqueue_transmission(c2_mode, copies, repeat_delay, frame_to_tx)
 
         # Wait while transmitting
-        while TNC.transmitting:
-            threading.Event().wait(0.01)
+        transmission.wait()
+        if not transmission.ok:
+            self.log.warning(
+                "[TNC] enqueue_frame_for_tx: frame not transmitted",
+                type=frame_type,
+                dropped=transmission.dropped,
+            )
+        return transmission
 
 
     def transmit_mesh_signalling_ping(self, dxcallsign_crc):
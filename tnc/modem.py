@@ -10,32 +10,68 @@ Created on Wed Dec 23 07:04:24 2020
 # pylint: disable=import-outside-toplevel
 
 import atexit
+import collections
 import ctypes
 import os
 import sys
 import threading
 import time
-from collections import deque
 import wave
 import codec2
-import itertools
+import demodulator
 import numpy as np
 import sock
 import sounddevice as sd
+import spectrum
+from occupancy import CHANNEL_OCCUPANCY
 import static
 from static import ARQ, AudioParam, Beacon, Channel, Daemon, HamlibParam, ModemParam, Station, Statistics, TCIParam, TNC
 from static import FRAME_TYPE
 import structlog
 import ujson as json
 import tci
+import transmit_scheduler
 # FIXME: used for def transmit_morse
 # import cw
 from queues import DATA_QUEUE_RECEIVED, MODEM_RECEIVED_QUEUE, MODEM_TRANSMIT_QUEUE, RIGCTLD_COMMAND_QUEUE, \
-    AUDIO_RECEIVED_QUEUE, AUDIO_TRANSMIT_QUEUE, MESH_RECEIVED_QUEUE
+    AUDIO_RECEIVED_QUEUE, AUDIO_TRANSMIT_QUEUE, MESH_RECEIVED_QUEUE, MODEM_PRERENDER_QUEUE
 
 TESTMODE = False
 RXCHANNEL = ""
 TXCHANNEL = ""
+# seconds between throughput logs of the test pipes
+FIFO_STATS_INTERVAL = 5
+
+# samples scaled at once by set_audio_volume
+GAIN_BLOCK_SIZE = 4800
+
+# samples of silence written to the test pipe after a transmission
+FIFO_SILENCE_TAIL = 4800
+
+# seconds of modulated audio the playback buffer holds ahead of the audio device
+PLAYBACK_BUFFER_SECONDS = 10
+
+# playback of a burst starts once the modulated audio covers this many times the
+# estimated time of modulating and resampling the next frame
+MODULATION_TIME_MARGIN = 2.0
+
+# pre-rendered bursts kept until they are transmitted or replaced by newer ones
+PRERENDER_CACHE_SIZE = 8
+
+# dB steps of the SNR of acknowledges in the pre-render key. An acknowledge within a
+# step of the pre-rendered one is sent with the pre-rendered audio, so with its SNR byte.
+PRERENDER_SNR_STEP = 1.0
+
+# frame types with the SNR of the received frame in byte 2, see DATA.build_burst_ack_frame
+SNR_FRAME_TYPES = (
+    FRAME_TYPE.BURST_ACK.value,
+    FRAME_TYPE.BURST_NACK.value,
+    FRAME_TYPE.FR_ACK.value,
+    FRAME_TYPE.FR_NACK.value,
+)
+
+# seconds of the channel occupancy published per slot
+OCCUPANCY_WINDOW = 60
 
 TNC.transmitting = False
 
@@ -58,6 +94,148 @@ DAT0_DATAC4_STATE = []
 FSK_LDPC0_STATE = []
 FSK_LDPC1_STATE = []
 
+# modes we are able to transmit
+TX_MODES = [
+    codec2.FREEDV_MODE.datac0.value,
+    codec2.FREEDV_MODE.datac1.value,
+    codec2.FREEDV_MODE.datac3.value,
+    codec2.FREEDV_MODE.datac4.value,
+    codec2.FREEDV_MODE.datac13.value,
+    codec2.FREEDV_MODE.fsk_ldpc_0.value,
+    codec2.FREEDV_MODE.fsk_ldpc_1.value,
+]
+
+
+class Transmission:
+    """
+    Completion handle of a transmit request, see enqueue_transmission
+
+    `done` is set once the last sample has been played and the PTT has been released,
+    `ptt_on` and `ptt_off` are the timestamps of keying up and down. `done` is also
+    set with `dropped` if the request has waited past its deadline, and with `failed`
+    if the modem couldn't transmit it.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.queued = time.time()
+        self.dequeued = 0.0
+        self.dropped = False
+        self.failed = False
+        self.ptt_on = 0.0
+        self.ptt_off = 0.0
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent in the transmit queue"""
+        if not self.dequeued:
+            return 0.0
+        return self.dequeued - self.queued
+
+    @property
+    def ok(self) -> bool:
+        """True if the frames have been sent"""
+        return self.done.is_set() and not self.dropped and not self.failed
+
+    @property
+    def on_air_time(self) -> float:
+        """Seconds between keying up and down"""
+        if not self.ptt_on or not self.ptt_off:
+            return 0.0
+        return self.ptt_off - self.ptt_on
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Wait until the transmission is complete
+
+        Args:
+          timeout: seconds, wait forever if None
+
+        Returns:
+            True if complete, False on timeout
+        """
+        return self.done.wait(timeout)
+
+
+def enqueue_transmission(
+        mode, repeats: int, repeat_delay: int, frames, priority=None, timeout=None
+) -> Transmission:
+    """
+    Queue frames for the transmit worker
+
+    Args:
+      mode: codec2 mode or "morse"
+      repeats: number of repeats
+      repeat_delay: delay between repeats in ms
+      frames: list of frames
+      priority: TX_PRIORITY, derived from the frame type if None
+      timeout: seconds until the request is dropped, default of the priority class if None
+
+    Returns:
+        Transmission, set when the frames have been sent or dropped
+    """
+    transmission = Transmission()
+    # Set the TRANSMITTING flag before adding an object to the transmit queue
+    TNC.transmitting = True
+    MODEM_TRANSMIT_QUEUE.put(
+        [mode, repeats, repeat_delay, frames, transmission], priority=priority, timeout=timeout
+    )
+    return transmission
+
+
+def drop_transmission(data) -> None:
+    """Release the sender of a transmit request which has passed its deadline"""
+    structlog.get_logger("RF").warning(
+        "[MDM] dropping stale transmission",
+        mode=data[0],
+        priority=transmit_scheduler.get_priority(data[0], data[3]).name,
+    )
+    if len(data) > 4 and data[4] is not None:
+        data[4].dropped = True
+        data[4].done.set()
+    ModemParam.transmit_queue_stats = MODEM_TRANSMIT_QUEUE.get_statistics()
+    # nothing left which would clear the flag
+    if MODEM_TRANSMIT_QUEUE.empty():
+        TNC.transmitting = False
+
+
+MODEM_TRANSMIT_QUEUE.on_drop = drop_transmission
+
+
+def get_prerender_frame_key(frame) -> bytes:
+    """
+    Frame bytes of the pre-render key, with the SNR of acknowledges in PRERENDER_SNR_STEP steps
+
+    Args:
+      frame: frame to transmit
+
+    Returns:
+        frame as bytes
+    """
+    frame = bytes(frame)
+    if len(frame) < 3 or frame[0] not in SNR_FRAME_TYPES:
+        return frame
+    # the SNR byte is in 0.1 dB
+    step = round(PRERENDER_SNR_STEP * 10)
+    snr = round(int.from_bytes(frame[2:3], byteorder="big", signed=True) / step) * step
+    snr = max(-128, min(snr, 127))
+    return frame[:2] + snr.to_bytes(1, byteorder="big", signed=True) + frame[3:]
+
+
+def prerender_transmission(mode, repeats: int, repeat_delay: int, frames) -> None:
+    """
+    Modulate a likely transmit request ahead of time
+
+    If the same request is enqueued later on, its audio is played without modulating it again.
+
+    Args:
+      mode: codec2 mode
+      repeats: number of repeats
+      repeat_delay: delay between repeats in ms
+      frames: list of frames
+    """
+    MODEM_PRERENDER_QUEUE.put([mode, repeats, repeat_delay, frames])
+
 
 class RF:
     """Class to encapsulate interactions between the audio device and codec2"""
@@ -85,100 +263,129 @@ class RF:
         # https://github.com/DJ2LS/FreeDATA/issues/99
         self.mod_out_locked = True
 
+        # the modem backend is loaded on first use, do it now so its load time shows up in our startup
+        codec2.load_backend()
+        ModemParam.codec2_load_time = round(codec2.library_load_time * 1000, 2)
+
         # Make sure our resampler will work
         assert (self.AUDIO_SAMPLE_RATE_RX / self.MODEM_SAMPLE_RATE) == codec2.api.FDMDV_OS_48  # type: ignore
 
-        # init codec2 resampler
-        self.resampler = codec2.resampler()
+        # init codec2 resamplers, one per direction: the DSP thread receives while
+        # transmit() resamples whole frames, the scratch buffers of one must not be
+        # replaced while the other is using them
+        self.rx_resampler = codec2.resampler(self.AUDIO_FRAMES_PER_BUFFER_RX)
+        self.tx_resampler = codec2.resampler()
+        # received 48 kHz audio, written by the PortAudio callback and read by the DSP thread
+        self.capture_buffer = codec2.audio_buffer(4 * self.AUDIO_FRAMES_PER_BUFFER_RX)
+        # played audio decimated to 8 kHz, written by the PortAudio callback and passed to
+        # the spectrum by the DSP thread, as the spectrum is guarded by a lock
+        self.played_buffer = codec2.audio_buffer(
+            4 * self.AUDIO_FRAMES_PER_BUFFER_RX // codec2.api.FDMDV_OS_48  # type: ignore
+        )
+        # set by the PortAudio callback for new audio and by transmit for keying the PTT
+        self.dsp_event = threading.Event()
+        # set by the DSP thread after keying the PTT, the callback plays playback_buffer only then
+        self.playback_enabled = False
+        # received audio at 8 kHz, reused for every audio block
+        self.rx_audio_8k = np.zeros(
+            self.AUDIO_FRAMES_PER_BUFFER_RX // codec2.api.FDMDV_OS_48, dtype=np.int16  # type: ignore
+        )
 
         self.modem_transmit_queue = MODEM_TRANSMIT_QUEUE
         self.modem_received_queue = MODEM_RECEIVED_QUEUE
+        self.modem_prerender_queue = MODEM_PRERENDER_QUEUE
+
+        # modulated 8 kHz bursts of prerender_transmission, by get_prerender_key
+        self.prerendered = collections.OrderedDict()
+        self.prerender_lock = threading.Lock()
+        # codec2 instances of the prerender worker, the tx instances belong to the transmit worker
+        self.prerender_instances = {}
 
         self.audio_received_queue = AUDIO_RECEIVED_QUEUE
         self.audio_transmit_queue = AUDIO_TRANSMIT_QUEUE
 
-        # Init FIFO queue to store modulation out in
-        self.modoutqueue = deque()
-
-        # Define fft_data buffer
-        self.fft_data = bytes()
+        # Modulated audio at the device rate, written by transmit and read by the audio callback
+        self.playback_buffer = codec2.audio_buffer(PLAYBACK_BUFFER_SECONDS * self.AUDIO_SAMPLE_RATE_TX)
+        # position of the end of the current transmission in playback_buffer, None while modulating
+        self.playback_end = None
+        # set by the reader of playback_buffer for every block it played
+        self.playback_event = threading.Event()
+        # set by transmit for new audio in playback_buffer, wakes the TCI and test pipe writers
+        self.playback_ready = threading.Event()
+        # set by the reader of playback_buffer once the transmission has been played
+        self.playback_complete = threading.Event()
+        # seconds spent modulating and resampling per second of audio, by mode, measured by transmit
+        self.modulation_load = {}
+        # modes whose playback underflowed while they were modulated, modulated as a whole since
+        self.modulate_whole_burst = set()
+        # time of keying up and down of the current transmission, 0 until the PTT is switched,
+        # without a PTT (test pipe) keying up is the start of playback
+        self.ptt_on_timestamp = 0.0
+        self.ptt_off_timestamp = 0.0
+
+        # reused by get_frequency_offset
+        self.modem_stats = codec2.modem_stats()
+
+        # spectrum of the received and transmitted audio, computed by the FFT thread
+        self.spectrum = spectrum.SpectrumEngine(self.MODEM_SAMPLE_RATE)
+
+        # Shared buffer for received audio, every codec2 instance reads it with its own cursor
+        # Demodulators are woken by the audio producer as soon as there is audio for them
+        if ModemParam.enable_demod_processes:
+            self.rx_audio_buffer = codec2.process_shared_audio_buffer(2 * self.AUDIO_FRAMES_PER_BUFFER_RX)
+            self.demodulator_scheduler = demodulator.DemodulatorProcesses(
+                self.rx_audio_buffer,
+                self.AUDIO_FRAMES_PER_BUFFER_RX,
+                self.process_rx_status,
+                self.process_demodulated_frame,
+            )
+        else:
+            self.rx_audio_buffer = codec2.shared_audio_buffer(2 * self.AUDIO_FRAMES_PER_BUFFER_RX)
+            self.demodulator_scheduler = demodulator.DemodulatorScheduler(self.demodulate_audio)
 
-        # Open codec2 instances
+        # RX demodulators - codec2 instances are opened when we start listening to their mode
+        # and closed again after not being used for ModemParam.decoder_grace_period seconds
 
         # DATAC13
         # SIGNALLING MODE 0 - Used for Connecting - Payload 14 Bytes
-        self.sig0_datac13_freedv, \
-                self.sig0_datac13_bytes_per_frame, \
-                self.sig0_datac13_bytes_out, \
-                self.sig0_datac13_buffer, \
-                self.sig0_datac13_nin = \
-                self.init_codec2_mode(codec2.FREEDV_MODE.datac13.value, None)
+        self.sig0_datac13 = self.init_demodulator(
+            "sig0-datac13", codec2.FREEDV_MODE.datac13.value, SIG0_DATAC13_STATE
+        )
 
         # DATAC13
         # SIGNALLING MODE 1 - Used for ACK/NACK - Payload 5 Bytes
-        self.sig1_datac13_freedv, \
-                self.sig1_datac13_bytes_per_frame, \
-                self.sig1_datac13_bytes_out, \
-                self.sig1_datac13_buffer, \
-                self.sig1_datac13_nin = \
-                self.init_codec2_mode(codec2.FREEDV_MODE.datac13.value, None)
+        self.sig1_datac13 = self.init_demodulator(
+            "sig1-datac13", codec2.FREEDV_MODE.datac13.value, SIG1_DATAC13_STATE
+        )
 
         # DATAC1
-        self.dat0_datac1_freedv, \
-                self.dat0_datac1_bytes_per_frame, \
-                self.dat0_datac1_bytes_out, \
-                self.dat0_datac1_buffer, \
-                self.dat0_datac1_nin = \
-                self.init_codec2_mode(codec2.FREEDV_MODE.datac1.value, None)
+        self.dat0_datac1 = self.init_demodulator(
+            "dat0-datac1", codec2.FREEDV_MODE.datac1.value, DAT0_DATAC1_STATE
+        )
 
         # DATAC3
-        self.dat0_datac3_freedv, \
-                self.dat0_datac3_bytes_per_frame, \
-                self.dat0_datac3_bytes_out, \
-                self.dat0_datac3_buffer, \
-                self.dat0_datac3_nin = \
-                self.init_codec2_mode(codec2.FREEDV_MODE.datac3.value, None)
+        self.dat0_datac3 = self.init_demodulator(
+            "dat0-datac3", codec2.FREEDV_MODE.datac3.value, DAT0_DATAC3_STATE
+        )
 
         # DATAC4
-        self.dat0_datac4_freedv, \
-                self.dat0_datac4_bytes_per_frame, \
-                self.dat0_datac4_bytes_out, \
-                self.dat0_datac4_buffer, \
-                self.dat0_datac4_nin = \
-                self.init_codec2_mode(codec2.FREEDV_MODE.datac4.value, None)
-
+        self.dat0_datac4 = self.init_demodulator(
+            "dat0-datac4", codec2.FREEDV_MODE.datac4.value, DAT0_DATAC4_STATE
+        )
 
         # FSK LDPC - 0
-        self.fsk_ldpc_freedv_0, \
-                self.fsk_ldpc_bytes_per_frame_0, \
-                self.fsk_ldpc_bytes_out_0, \
-                self.fsk_ldpc_buffer_0, \
-                self.fsk_ldpc_nin_0 = \
-                self.init_codec2_mode(
-                codec2.FREEDV_MODE.fsk_ldpc.value,
-                codec2.api.FREEDV_MODE_FSK_LDPC_0_ADV
-            )
+        self.fsk_ldpc0 = self.init_demodulator(
+            "fsk_ldpc0", codec2.FREEDV_MODE.fsk_ldpc_0.value, FSK_LDPC0_STATE
+        )
 
         # FSK LDPC - 1
-        self.fsk_ldpc_freedv_1, \
-                self.fsk_ldpc_bytes_per_frame_1, \
-                self.fsk_ldpc_bytes_out_1, \
-                self.fsk_ldpc_buffer_1, \
-                self.fsk_ldpc_nin_1 = \
-                self.init_codec2_mode(
-                codec2.FREEDV_MODE.fsk_ldpc.value,
-                codec2.api.FREEDV_MODE_FSK_LDPC_1_ADV
-            )
+        self.fsk_ldpc1 = self.init_demodulator(
+            "fsk_ldpc1", codec2.FREEDV_MODE.fsk_ldpc_1.value, FSK_LDPC1_STATE
+        )
+
+        # TX MODES - opened on first use by get_tx_instance
+        self.tx_instances = {}
 
-        # INIT TX MODES - here we need all modes. 
-        self.freedv_datac0_tx = open_codec2_instance(codec2.FREEDV_MODE.datac0.value)
-        self.freedv_datac1_tx = open_codec2_instance(codec2.FREEDV_MODE.datac1.value)
-        self.freedv_datac3_tx = open_codec2_instance(codec2.FREEDV_MODE.datac3.value)
-        self.freedv_datac4_tx = open_codec2_instance(codec2.FREEDV_MODE.datac4.value)
-        self.freedv_datac13_tx = open_codec2_instance(codec2.FREEDV_MODE.datac13.value)
-        self.freedv_ldpc0_tx = open_codec2_instance(codec2.FREEDV_MODE.fsk_ldpc_0.value)
-        self.freedv_ldpc1_tx = open_codec2_instance(codec2.FREEDV_MODE.fsk_ldpc_1.value)
-        
         # --------------------------------------------CREATE PORTAUDIO INSTANCE
         if not TESTMODE and not HamlibParam.hamlib_radiocontrol in ["tci"]:
             try:
@@ -188,10 +395,15 @@ class RF:
                     callback=self.callback,
                     device=(AudioParam.audio_input_device, AudioParam.audio_output_device),
                     samplerate=self.AUDIO_SAMPLE_RATE_RX,
-                    blocksize=4800,
+                    blocksize=self.AUDIO_FRAMES_PER_BUFFER_RX,
                 )
                 atexit.register(self.stream.stop)
                 self.log.info("[MDM] init: opened audio devices")
+
+                dsp_thread = threading.Thread(
+                    target=self.dsp_worker, name="DSP_THREAD", daemon=True
+                )
+                dsp_thread.start()
             except Exception as err:
                 self.log.error("[MDM] init: can't open audio device. Exit", e=err)
                 sys.exit(1)
@@ -242,6 +454,12 @@ class RF:
 
             self.stream = Object()
 
+            # samples/sec achieved by the test pipes
+            self.fifo_stats = {
+                direction: {"samples": 0, "start": time.monotonic(), "samples_per_second": 0}
+                for direction in ["rx", "tx"]
+            }
+
             # Create mkfifo buffers
             try:
                 os.mkfifo(RXCHANNEL)
@@ -288,41 +506,15 @@ class RF:
             fft_thread.start()
 
         if TNC.enable_fsk:
-            audio_thread_fsk_ldpc0 = threading.Thread(
-                target=self.audio_fsk_ldpc_0, name="AUDIO_THREAD FSK LDPC0", daemon=True
-            )
-            audio_thread_fsk_ldpc0.start()
-
-            audio_thread_fsk_ldpc1 = threading.Thread(
-                target=self.audio_fsk_ldpc_1, name="AUDIO_THREAD FSK LDPC1", daemon=True
-            )
-            audio_thread_fsk_ldpc1.start()
+            self.demodulator_scheduler.add(self.fsk_ldpc0)
+            self.demodulator_scheduler.add(self.fsk_ldpc1)
 
         else:
-            audio_thread_sig0_datac13 = threading.Thread(
-                target=self.audio_sig0_datac13, name="AUDIO_THREAD DATAC13 - 0", daemon=True
-            )
-            audio_thread_sig0_datac13.start()
-
-            audio_thread_sig1_datac13 = threading.Thread(
-                target=self.audio_sig1_datac13, name="AUDIO_THREAD DATAC13 - 1", daemon=True
-            )
-            audio_thread_sig1_datac13.start()
-
-            audio_thread_dat0_datac1 = threading.Thread(
-                target=self.audio_dat0_datac1, name="AUDIO_THREAD DATAC1", daemon=True
-            )
-            audio_thread_dat0_datac1.start()
-
-            audio_thread_dat0_datac3 = threading.Thread(
-                target=self.audio_dat0_datac3, name="AUDIO_THREAD DATAC3", daemon=True
-            )
-            audio_thread_dat0_datac3.start()
-
-            audio_thread_dat0_datac4 = threading.Thread(
-                target=self.audio_dat0_datac4, name="AUDIO_THREAD DATAC4", daemon=True
-            )
-            audio_thread_dat0_datac4.start()
+            self.demodulator_scheduler.add(self.sig0_datac13)
+            self.demodulator_scheduler.add(self.sig1_datac13)
+            self.demodulator_scheduler.add(self.dat0_datac1)
+            self.demodulator_scheduler.add(self.dat0_datac3)
+            self.demodulator_scheduler.add(self.dat0_datac4)
 
         hamlib_thread = threading.Thread(
             target=self.update_rig_data, name="HAMLIB_THREAD", daemon=True
@@ -345,22 +537,39 @@ class RF:
         )
         worker_transmit.start()
 
+        worker_prerender = threading.Thread(
+            target=self.worker_prerender, name="PRERENDER_THREAD", daemon=True
+        )
+        worker_prerender.start()
+
     # --------------------------------------------------------------------------------------------------------
     def tci_tx_callback(self) -> None:
         """
         Callback for TCI TX
         """
+        playback = self.playback_buffer
+        chunk_length = self.AUDIO_FRAMES_PER_BUFFER_TX
         while True:
-            threading.Event().wait(0.01)
+            nsamples = min(playback.nbuffer, chunk_length)
+            # only the end of a transmission is sent as a partial chunk
+            if not nsamples or self.mod_out_locked or (
+                nsamples < chunk_length and self.playback_end is None
+            ):
+                self.playback_ready.wait()
+                self.playback_ready.clear()
+                continue
+
+            HamlibParam.ptt_state = self.radio.set_ptt(True)
+            if not self.ptt_on_timestamp:
+                self.ptt_on_timestamp = time.time()
+            jsondata = {"ptt": "True"}
+            data_out = json.dumps(jsondata)
+            sock.SOCKET_QUEUE.put(data_out)
 
-            if len(self.modoutqueue) > 0 and not self.mod_out_locked:
-                HamlibParam.ptt_state = self.radio.set_ptt(True)
-                jsondata = {"ptt": "True"}
-                data_out = json.dumps(jsondata)
-                sock.SOCKET_QUEUE.put(data_out)
-
-                data_out = self.modoutqueue.popleft()
-                self.tci_module.push_audio(data_out)
+            # Pad the chunk, if needed
+            data_out = playback.buffer[:nsamples].tobytes().ljust(2 * chunk_length, b"\x00")
+            self.playback_pop(nsamples)
+            self.tci_module.push_audio(data_out)
 
     def tci_rx_callback(self) -> None:
         """
@@ -371,148 +580,249 @@ class RF:
         """
 
         while True:
-            threading.Event().wait(0.01)
-
             x = self.audio_received_queue.get()
             x = np.frombuffer(x, dtype=np.int16)
-            # x = self.resampler.resample48_to_8(x)
-
-            self.fft_data = x
-
-            length_x = len(x)
-            for data_buffer, receive in [
-                (self.sig0_datac13_buffer, RECEIVE_SIG0),
-                (self.sig1_datac13_buffer, RECEIVE_SIG1),
-                (self.dat0_datac1_buffer, RECEIVE_DATAC1),
-                (self.dat0_datac3_buffer, RECEIVE_DATAC3),
-                (self.dat0_datac4_buffer, RECEIVE_DATAC4),
-                (self.fsk_ldpc_buffer_0, TNC.enable_fsk),
-                (self.fsk_ldpc_buffer_1, TNC.enable_fsk),
-            ]:
-                if (
-                        not (data_buffer.nbuffer + length_x) > data_buffer.size
-                        and receive
-                ):
-                    data_buffer.push(x)
+            # x = self.rx_resampler.resample48_to_8(x)
+
+            self.spectrum.push(x)
+
+            self.push_rx_audio(x)
 
     def mkfifo_read_callback(self) -> None:
         """
         Support testing by reading the audio data from a pipe and
         depositing the data into the codec data buffers.
+
+        Audio is read in blocks into a preallocated buffer and resampled in
+        multiples of FDMDV_OS_48 samples, as fast as the demodulators keep up.
         """
+        block_bytes = 2 * self.AUDIO_FRAMES_PER_BUFFER_RX
+        frame_bytes = 2 * codec2.api.FDMDV_OS_48  # type: ignore
+        data_in48k = bytearray(block_bytes)
+        view = memoryview(data_in48k)
+        samples_in48k = np.frombuffer(data_in48k, dtype=np.int16)
+
         while True:
-            threading.Event().wait(0.01)
-            # -----read
-            data_in48k = bytes()
-            with open(RXCHANNEL, "rb") as fifo:
-                for line in fifo:
-                    data_in48k += line
-
-                    while len(data_in48k) >= 48:
-                        x = np.frombuffer(data_in48k[:48], dtype=np.int16)
-                        x = self.resampler.resample48_to_8(x)
-                        data_in48k = data_in48k[48:]
-
-                        length_x = len(x)
-                        for data_buffer, receive in [
-                            (self.sig0_datac13_buffer, RECEIVE_SIG0),
-                            (self.sig1_datac13_buffer, RECEIVE_SIG1),
-                            (self.dat0_datac1_buffer, RECEIVE_DATAC1),
-                            (self.dat0_datac3_buffer, RECEIVE_DATAC3),
-                            (self.dat0_datac4_buffer, RECEIVE_DATAC4),
-                            (self.fsk_ldpc_buffer_0, TNC.enable_fsk),
-                            (self.fsk_ldpc_buffer_1, TNC.enable_fsk),
-                        ]:
-                            if (
-                                    not (data_buffer.nbuffer + length_x) > data_buffer.size
-                                    and receive
-                            ):
-                                data_buffer.push(x)
+            # -----read, blocks until the writer opens the pipe
+            nbytes = 0
+            with open(RXCHANNEL, "rb", buffering=0) as fifo:
+                while True:
+                    nread = fifo.readinto(view[nbytes:])
+                    if not nread:
+                        # writer closed the pipe
+                        break
+                    nbytes += nread
+
+                    # resample all complete frames, keep the remainder for the next read
+                    nsamples = (nbytes - nbytes % frame_bytes) // 2
+                    if not nsamples:
+                        continue
+                    x = self.rx_resampler.resample48_to_8(
+                        samples_in48k[:nsamples],
+                        out=self.rx_audio_8k[: nsamples // codec2.api.FDMDV_OS_48],  # type: ignore
+                    )
+                    # don't overrun demodulators which are still busy with the previous blocks
+                    while self.demodulator_scheduler.backlog() + len(x) > self.rx_audio_buffer.size:
+                        threading.Event().wait(0.001)
+                    self.push_rx_audio(x)
+                    self.count_fifo_samples("rx", nsamples)
+
+                    nbytes -= 2 * nsamples
+                    view[:nbytes] = view[2 * nsamples : 2 * nsamples + nbytes]
 
     def mkfifo_write_callback(self) -> None:
         """Support testing by writing the audio data to a pipe."""
+        fifo_write = None
+        silence_tail = codec2.get_silence(FIFO_SILENCE_TAIL)
+        playback = self.playback_buffer
+        tail_pending = False
         while True:
-            threading.Event().wait(0.01)
-
             # -----write
-            if len(self.modoutqueue) > 0 and not self.mod_out_locked:
-                data_out48k = self.modoutqueue.popleft()
-                # print(len(data_out48k))
+            nsamples = min(playback.nbuffer, self.AUDIO_FRAMES_PER_BUFFER_TX)
+            if nsamples and not self.mod_out_locked:
+                tail_pending = True
+            elif not (tail_pending and self.playback_complete.is_set()):
+                self.playback_ready.wait()
+                self.playback_ready.clear()
+                continue
 
-                with open(TXCHANNEL, "wb") as fifo_write:
-                    fifo_write.write(data_out48k)
-                    fifo_write.flush()
-                    fifo_write.flush()
+            try:
+                # keep the pipe open, so the reader gets a continuous stream of blocks
+                if fifo_write is None:
+                    fifo_write = open(TXCHANNEL, "wb", buffering=0)
+                if nsamples and not self.mod_out_locked:
+                    # there is no PTT, playback starts with the first block on the pipe
+                    if not self.ptt_on_timestamp:
+                        self.ptt_on_timestamp = time.time()
+                    fifo_write.write(playback.buffer[:nsamples])
+                    self.playback_pop(nsamples)
+                    self.count_fifo_samples("tx", nsamples)
+                if tail_pending and self.playback_complete.is_set():
+                    # a radio channel doesn't end with our transmission, let the
+                    # demodulators see some silence after the last frame
+                    tail_pending = False
+                    fifo_write.write(silence_tail)
+            except BrokenPipeError:
+                self.log.debug("[MDM] mkfifo: reader closed the pipe")
+                fifo_write.close()
+                fifo_write = None
+
+    def count_fifo_samples(self, direction: str, nsamples: int) -> None:
+        """
+        Count samples passed through the test pipes and log the achieved
+        samples/sec every FIFO_STATS_INTERVAL seconds
+
+        Args:
+            direction: "rx" or "tx"
+            nsamples: number of 48 kHz samples
+        """
+        now = time.monotonic()
+        stats = self.fifo_stats[direction]
+        stats["samples"] += nsamples
+        if now - stats["start"] >= FIFO_STATS_INTERVAL:
+            stats["samples_per_second"] = round(stats["samples"] / (now - stats["start"]))
+            self.log.debug(
+                "[MDM] mkfifo throughput", direction=direction,
+                samples_per_second=stats["samples_per_second"],
+                realtime_factor=round(stats["samples_per_second"] / self.AUDIO_SAMPLE_RATE_RX, 1),
+            )
+            stats["samples"] = 0
+            stats["start"] = now
 
     # --------------------------------------------------------------------
-    def callback(self, data_in48k, outdata, frames, time, status) -> None:
+    def callback(self, data_in48k, outdata, frames, time_info, status) -> None:
         """
-        Receive data into appropriate queue.
+        PortAudio callback, only moves audio between the audio device and our buffers.
+        Received audio is processed by the DSP thread.
 
         Args:
             data_in48k: Incoming data received
             outdata: Container for the data returned
             frames: Number of frames
-            time:
-          status:
+            time_info:
+            status: PortAudio callback flags
 
         """
         # self.log.debug("[MDM] callback")
+        callback_start = time.perf_counter()
+        if status:
+            if status.input_overflow:
+                AudioParam.audio_input_overflows += 1
+            if status.output_underflow:
+                AudioParam.audio_output_underflows += 1
+
         x = np.frombuffer(data_in48k, dtype=np.int16)
-        x = self.resampler.resample48_to_8(x)
-
-        # audio recording for debugging purposes
-        if AudioParam.audio_record:
-            # AudioParam.audio_record_file.write(x)
-            AudioParam.audio_record_file.writeframes(x)
-
-        # Avoid decoding when transmitting to reduce CPU
-        # TODO: Overriding this for testing purposes
-        # if not TNC.transmitting:
-        length_x = len(x)
-        # Avoid buffer overflow by filling only if buffer for
-        # selected datachannel mode is not full
-        for audiobuffer, receive, index in [
-            (self.sig0_datac13_buffer, RECEIVE_SIG0, 0),
-            (self.sig1_datac13_buffer, RECEIVE_SIG1, 1),
-            (self.dat0_datac1_buffer, RECEIVE_DATAC1, 2),
-            (self.dat0_datac3_buffer, RECEIVE_DATAC3, 3),
-            (self.dat0_datac4_buffer, RECEIVE_DATAC4, 4),
-            (self.fsk_ldpc_buffer_0, TNC.enable_fsk, 5),
-            (self.fsk_ldpc_buffer_1, TNC.enable_fsk, 6),
-        ]:
-            if (audiobuffer.nbuffer + length_x) > audiobuffer.size:
-                AudioParam.buffer_overflow_counter[index] += 1
-            elif receive:
-                audiobuffer.push(x)
-        # end of "not TNC.transmitting" if block
-
-        if not self.modoutqueue or self.mod_out_locked:
-            data_out48k = np.zeros(frames, dtype=np.int16)
-            self.fft_data = x
+        if self.capture_buffer.nbuffer + len(x) <= self.capture_buffer.size:
+            self.capture_buffer.push(x)
         else:
-            if not HamlibParam.ptt_state:
+            # DSP thread doesn't keep up, drop the block
+            AudioParam.audio_input_overflows += 1
+        self.dsp_event.set()
+
+        # copy exactly the samples the device asks for, whatever the size of the modulated blocks
+        data_out48k = np.frombuffer(outdata, dtype=np.int16)
+        playback = self.playback_buffer
+        nsamples = 0
+        if not self.mod_out_locked and self.playback_enabled:
+            nsamples = min(len(data_out48k), playback.nbuffer)
+        data_out48k[:nsamples] = playback.buffer[:nsamples]
+        data_out48k[nsamples:] = 0
+        if nsamples:
+            # the modulated audio has nothing above 4 kHz, so taking every 6th sample is enough for the spectrum
+            played = playback.buffer[:nsamples:codec2.api.FDMDV_OS_48]  # type: ignore
+            if self.played_buffer.nbuffer + len(played) <= self.played_buffer.size:
+                self.played_buffer.push(played)
+            self.playback_pop(nsamples)
+
+        callback_duration = (time.perf_counter() - callback_start) * 1000
+        AudioParam.audio_callback_duration = callback_duration
+        AudioParam.audio_callback_duration_max = max(AudioParam.audio_callback_duration_max, callback_duration)
+
+        # return (data_out48k, audio.pyaudio.paContinue)
+
+    def dsp_worker(self) -> None:
+        """
+        Process the audio moved by the PortAudio callback: resample received audio,
+        pass it to the demodulators, the recording and the spectrum, pass played audio
+        to the spectrum and key the PTT before the callback starts playing modulated audio
+        """
+        while True:
+            self.dsp_event.wait()
+            self.dsp_event.clear()
+
+            while self.capture_buffer.nbuffer >= codec2.api.FDMDV_OS_48:  # type: ignore
+                nsamples = min(self.capture_buffer.nbuffer, self.AUDIO_FRAMES_PER_BUFFER_RX)
+                nsamples -= nsamples % codec2.api.FDMDV_OS_48  # type: ignore
+                x = self.rx_resampler.resample48_to_8(
+                    self.capture_buffer.buffer[:nsamples],
+                    out=self.rx_audio_8k[: nsamples // codec2.api.FDMDV_OS_48],  # type: ignore
+                )
+                self.capture_buffer.pop(nsamples)
+
+                # audio recording for debugging purposes
+                if AudioParam.audio_record:
+                    # AudioParam.audio_record_file.write(x)
+                    AudioParam.audio_record_file.writeframes(x)
+
+                if not self.playback_enabled:
+                    self.spectrum.push(x)
+
+                # Avoid decoding when transmitting to reduce CPU
+                # TODO: Overriding this for testing purposes
+                # if not TNC.transmitting:
+                self.push_rx_audio(x)
+                # end of "not TNC.transmitting" if block
+
+            played = self.played_buffer
+            nplayed = played.nbuffer
+            if nplayed:
+                self.spectrum.push(played.buffer[:nplayed])
+                played.pop(nplayed)
+
+            if self.playback_buffer.nbuffer and not self.mod_out_locked and not self.playback_enabled:
                 # TODO: Moved to this place for testing
                 # Maybe we can avoid moments of silence before transmitting
                 HamlibParam.ptt_state = self.radio.set_ptt(True)
+                self.ptt_on_timestamp = time.time()
                 jsondata = {"ptt": "True"}
                 data_out = json.dumps(jsondata)
                 sock.SOCKET_QUEUE.put(data_out)
+                self.playback_enabled = True
 
-            data_out48k = self.modoutqueue.popleft()
-            self.fft_data = data_out48k
+    def push_rx_audio(self, x) -> None:
+        """
+        Write a block of received 8 kHz audio once to the shared rx audio buffer.
+        Only codec2 instances of modes we are listening to are reading from it.
 
-        try:
-            outdata[:] = data_out48k[:frames]
-        except IndexError as err:
-            self.log.debug(f"[MDM] callback: IndexError: {err}")
+        Args:
+            x: audio samples as np.int16
+        """
+        for rx_demodulator, receive in [
+            (self.sig0_datac13, RECEIVE_SIG0),
+            (self.sig1_datac13, RECEIVE_SIG1),
+            (self.dat0_datac1, RECEIVE_DATAC1),
+            (self.dat0_datac3, RECEIVE_DATAC3),
+            (self.dat0_datac4, RECEIVE_DATAC4),
+            (self.fsk_ldpc0, TNC.enable_fsk),
+            (self.fsk_ldpc1, TNC.enable_fsk),
+        ]:
+            rx_demodulator.audiobuffer.active = receive
 
-        # return (data_out48k, audio.pyaudio.paContinue)
+        self.rx_audio_buffer.push(x)
+
+        # move overflows of every reader to our statistics
+        for index, audiobuffer in enumerate(self.rx_audio_buffer.readers):
+            if audiobuffer.overflows:
+                AudioParam.buffer_overflow_counter[index] += audiobuffer.overflows
+                audiobuffer.overflows = 0
+
+        # wake demodulators which have enough audio now
+        self.demodulator_scheduler.notify()
 
     # --------------------------------------------------------------------
     def transmit(
             self, mode, repeats: int, repeat_delay: int, frames: bytearray
-    ) -> None:
+    ) -> bool:
         """
 
         Args:
@@ -521,29 +831,19 @@ class RF:
           repeat_delay:
           frames:
 
+        Returns:
+            False if we can't transmit this mode
         """
         self.reset_data_sync()
 
-        if mode == codec2.FREEDV_MODE.datac0.value:
-            freedv = self.freedv_datac0_tx
-        elif mode == codec2.FREEDV_MODE.datac1.value:
-            freedv = self.freedv_datac1_tx
-        elif mode == codec2.FREEDV_MODE.datac3.value:
-            freedv = self.freedv_datac3_tx
-        elif mode == codec2.FREEDV_MODE.datac4.value:
-            freedv = self.freedv_datac4_tx
-        elif mode == codec2.FREEDV_MODE.datac13.value:
-            freedv = self.freedv_datac13_tx
-        elif mode == codec2.FREEDV_MODE.fsk_ldpc_0.value:
-            freedv = self.freedv_ldpc0_tx
-        elif mode == codec2.FREEDV_MODE.fsk_ldpc_1.value:
-            freedv = self.freedv_ldpc1_tx
-        else:
+        freedv = self.get_tx_instance(mode)
+        if freedv is None:
             return False
 
         TNC.transmitting = True
         # if we're transmitting FreeDATA signals, reset channel busy state
         ModemParam.channel_busy = False
+        CHANNEL_OCCUPANCY.reset()
 
         start_of_transmission = time.time()
         # TODO: Moved ptt toggle some steps before audio is ready for testing
@@ -557,96 +857,18 @@ class RF:
         self.MODE = mode
 
         # Get number of bytes per frame for mode
-        bytes_per_frame = int(codec2.api.freedv_get_bits_per_modem_frame(freedv) / 8)
-        payload_bytes_per_frame = bytes_per_frame - 2
-
-        # Init buffer for data
-        n_tx_modem_samples = codec2.api.freedv_get_n_tx_modem_samples(freedv)
-        mod_out = ctypes.create_string_buffer(n_tx_modem_samples * 2)
-
-        # Init buffer for preample
-        n_tx_preamble_modem_samples = codec2.api.freedv_get_n_tx_preamble_modem_samples(
-            freedv
-        )
-        mod_out_preamble = ctypes.create_string_buffer(n_tx_preamble_modem_samples * 2)
-
-        # Init buffer for postamble
-        n_tx_postamble_modem_samples = (
-            codec2.api.freedv_get_n_tx_postamble_modem_samples(freedv)
-        )
-        mod_out_postamble = ctypes.create_string_buffer(
-            n_tx_postamble_modem_samples * 2
-        )
+        mode_info = codec2.get_mode_info(mode)
+        payload_bytes_per_frame = mode_info.payload_per_frame
 
         # Add empty data to handle ptt toggle time
-        if ModemParam.tx_delay > 0:
-            data_delay = int(self.MODEM_SAMPLE_RATE * (ModemParam.tx_delay / 1000))  # type: ignore
-            mod_out_silence = ctypes.create_string_buffer(data_delay * 2)
-            txbuffer = bytes(mod_out_silence)
-        else:
-            txbuffer = bytes()
+        data_delay = int(self.MODEM_SAMPLE_RATE * (max(ModemParam.tx_delay, 0) / 1000))  # type: ignore
+        # Add delay to end of frames
+        samples_delay = int(self.MODEM_SAMPLE_RATE * (repeat_delay / 1000))  # type: ignore
 
         self.log.debug(
             "[MDM] TRANSMIT", mode=self.MODE, payload=payload_bytes_per_frame, delay=ModemParam.tx_delay
         )
 
-        for _ in range(repeats):
-
-            # Create modulation for all frames in the list
-            for frame in frames:
-                # Write preamble to txbuffer
-                # codec2 fsk preamble may be broken -
-                # at least it sounds like that, so we are disabling it for testing
-                if self.MODE not in [
-                    codec2.FREEDV_MODE.fsk_ldpc_0.value,
-                    codec2.FREEDV_MODE.fsk_ldpc_1.value,
-                ]:
-                    # Write preamble to txbuffer
-                    codec2.api.freedv_rawdatapreambletx(freedv, mod_out_preamble)
-                    txbuffer += bytes(mod_out_preamble)
-
-                # Create buffer for data
-                # Use this if CRC16 checksum is required (DATAc1-3)
-                buffer = bytearray(payload_bytes_per_frame)
-                # Set buffersize to length of data which will be send
-                buffer[: len(frame)] = frame  # type: ignore
-
-                # Create crc for data frame -
-                #   Use the crc function shipped with codec2
-                #   to avoid CRC algorithm incompatibilities
-                # Generate CRC16
-                crc = ctypes.c_ushort(
-                    codec2.api.freedv_gen_crc16(bytes(buffer), payload_bytes_per_frame)
-                )
-                # Convert crc to 2-byte (16-bit) hex string
-                crc = crc.value.to_bytes(2, byteorder="big")
-                # Append CRC to data buffer
-                buffer += crc
-
-                data = (ctypes.c_ubyte * bytes_per_frame).from_buffer_copy(buffer)
-                # modulate DATA and save it into mod_out pointer
-                codec2.api.freedv_rawdatatx(freedv, mod_out, data)
-                txbuffer += bytes(mod_out)
-
-                # codec2 fsk postamble may be broken -
-                # at least it sounds like that, so we are disabling it for testing
-                if self.MODE not in [
-                    codec2.FREEDV_MODE.fsk_ldpc_0.value,
-                    codec2.FREEDV_MODE.fsk_ldpc_1.value,
-                ]:
-                    # Write postamble to txbuffer
-                    codec2.api.freedv_rawdatapostambletx(freedv, mod_out_postamble)
-                    # Append postamble to txbuffer
-                    txbuffer += bytes(mod_out_postamble)
-
-            # Add delay to end of frames
-            samples_delay = int(self.MODEM_SAMPLE_RATE * (repeat_delay / 1000))  # type: ignore
-            mod_out_silence = ctypes.create_string_buffer(samples_delay * 2)
-            txbuffer += bytes(mod_out_silence)
-
-        # Re-sample back up to 48k (resampler works on np.int16)
-        x = np.frombuffer(txbuffer, dtype=np.int16)
-
         # enable / disable AUDIO TUNE Feature / ALC correction
         if AudioParam.audio_auto_tune:
             if HamlibParam.alc == 0.0:
@@ -674,51 +896,100 @@ class RF:
             else:
                 self.log.debug("[MDM] AUDIO TUNE", audio_level=str(AudioParam.tx_audio_level),
                                alc_level=str(HamlibParam.alc))
-        x = set_audio_volume(x, AudioParam.tx_audio_level)
-
-        if not HamlibParam.hamlib_radiocontrol in ["tci"]:
-            txbuffer_out = self.resampler.resample8_to_48(x)
-        else:
-            txbuffer_out = x
 
         # Explicitly lock our usage of mod_out_queue if needed
         # This could avoid audio problems on slower CPU
-        # we will fill our modout list with all data, then start
-        # processing it in audio callback
+        # we will fill the playback buffer until it covers the time of modulating
+        # the next frame, then start playing it while the next frames are modulated
         self.mod_out_locked = True
-
-        # -------------------------------
-        # add modulation to modout_queue
-        self.enqueue_modulation(txbuffer_out)
-
-        # Release our mod_out_lock, so we can use the queue
-        self.mod_out_locked = False
-
-        # we need to wait manually for tci processing
-        if HamlibParam.hamlib_radiocontrol in ["tci"]:
-            duration = len(txbuffer_out) / 8000
-            timestamp_to_sleep = time.time() + duration
-            self.log.debug("[MDM] TCI calculated duration", duration=duration)
-            tci_timeout_reached = False
-            #while time.time() < timestamp_to_sleep:
-            #    threading.Event().wait(0.01)
+        self.playback_end = None
+        self.playback_complete.clear()
+
+        prerender_key = self.get_prerender_key(mode, repeats, repeat_delay, frames)
+        with self.prerender_lock:
+            x = self.prerendered.pop(prerender_key, None)
+        prerendered = x is not None
+        if prerendered:
+            # modulated while we were waiting for the request, queue it at once
+            self.log.debug("[MDM] TRANSMIT pre-rendered", mode=self.MODE)
+            ready_positions = [len(x)]
         else:
-            timestamp_to_sleep = time.time()
-            # set tci timeout reached to True for overriding if not used
-            tci_timeout_reached = True
-
-        while self.modoutqueue or not tci_timeout_reached:
-            if HamlibParam.hamlib_radiocontrol in ["tci"]:
-                if time.time() < timestamp_to_sleep:
-                    tci_timeout_reached = False
-                else:
-                    tci_timeout_reached = True
+            # Create modulation for all frames in the list, in one preallocated buffer.
+            # Every frame is scaled, re-sampled and queued as soon as it is modulated.
+            x = np.zeros(
+                codec2.get_burst_length(mode, len(frames), repeats, samples_delay, data_delay),
+                dtype=np.int16,
+            )
+            ready_positions = codec2.modulate_into(
+                x, freedv, mode, frames, repeats, samples_delay, data_delay
+            )
+        # playback starts before the last frame is modulated, unless this mode underflowed that way before
+        stream = mode not in self.modulate_whole_burst
+        streamed = False
+        underflows = AudioParam.audio_output_underflows
+        queued = 0
+        segment_start = time.perf_counter()
+        for ready in ready_positions:
+            # scaled in place
+            segment = set_audio_volume(x[queued:ready], AudioParam.tx_audio_level)
+            segment_seconds = (ready - queued) / self.MODEM_SAMPLE_RATE
+            queued = ready
+
+            # Re-sample back up to 48k, the resampler keeps its state between segments
+            if not HamlibParam.hamlib_radiocontrol in ["tci"]:
+                segment = self.tx_resampler.resample8_to_48(segment)
+
+            # -------------------------------
+            # add modulation to the playback buffer
+            self.enqueue_modulation(segment, last=queued == len(x))
+
+            if not self.mod_out_locked:
+                # already playing, or the playback buffer was full
+                streamed = streamed or queued < len(x)
+                continue
+
+            if not prerendered:
+                # measured on the frame just queued, frames of a burst take about the same time
+                now = time.perf_counter()
+                load = (now - segment_start) / segment_seconds if segment_seconds else 0.0
+                segment_start = now
+                average = self.modulation_load.get(mode, load)
+                self.modulation_load[mode] = 0.5 * (average + load)
+                load = max(load, average)
+                # playing what is queued has to take longer than modulating the next frame
+                if queued < len(x) and not (
+                    stream
+                    and load < 1.0
+                    and queued / self.MODEM_SAMPLE_RATE >= MODULATION_TIME_MARGIN * load * segment_seconds
+                ):
+                    continue
+                streamed = queued < len(x)
 
-            threading.Event().wait(0.01)
-            # if we're transmitting FreeDATA signals, reset channel busy state
-            ModemParam.channel_busy = False
+            self.log.debug(
+                "[MDM] TRANSMIT playback ready",
+                time=round(time.time() - start_of_transmission, 3),
+                streamed=streamed,
+            )
+            # Release our mod_out_lock, so we can use the queue
+            self.mod_out_locked = False
+            # let the DSP thread key the PTT
+            self.dsp_event.set()
+            self.playback_ready.set()
+
+        self.wait_for_playback(len(x) / 8000)
+
+        if streamed and AudioParam.audio_output_underflows > underflows:
+            # the audio device ran dry while we were still modulating
+            self.modulate_whole_burst.add(mode)
+            self.log.warning(
+                "[MDM] TRANSMIT underflow while streaming, modulating whole bursts from now on",
+                mode=codec2.FREEDV_MODE(mode).name,
+                load=round(self.modulation_load.get(mode, 0.0), 3),
+            )
 
         HamlibParam.ptt_state = self.radio.set_ptt(False)
+        self.ptt_off_timestamp = time.time()
+        self.playback_enabled = False
 
         # Push ptt state to socket stream
         jsondata = {"ptt": "False"}
@@ -730,16 +1001,22 @@ class RF:
 
         self.modem_transmit_queue.task_done()
         TNC.transmitting = False
-        threading.Event().set()
 
         end_of_transmission = time.time()
         transmission_time = end_of_transmission - start_of_transmission
-        self.log.debug("[MDM] ON AIR TIME", time=transmission_time)
+        self.log.debug(
+            "[MDM] ON AIR TIME",
+            time=transmission_time,
+            ptt_on=self.ptt_on_timestamp,
+            ptt_off=self.ptt_off_timestamp,
+        )
+        return True
 
     def transmit_morse(self, repeats, repeat_delay, frames):
         TNC.transmitting = True
         # if we're transmitting FreeDATA signals, reset channel busy state
         ModemParam.channel_busy = False
+        CHANNEL_OCCUPANCY.reset()
         self.log.debug(
             "[MDM] TRANSMIT", mode="MORSE"
         )
@@ -754,42 +1031,24 @@ class RF:
         print(txbuffer_out)
 
         #if not HamlibParam.hamlib_radiocontrol in ["tci"]:
-        #    txbuffer_out = self.resampler.resample8_to_48(x)
+        #    txbuffer_out = self.tx_resampler.resample8_to_48(x)
         #else:
         #    txbuffer_out = x
 
         self.mod_out_locked = True
+        self.playback_end = None
+        self.playback_complete.clear()
         self.enqueue_modulation(txbuffer_out)
         self.mod_out_locked = False
+        # let the DSP thread key the PTT
+        self.dsp_event.set()
+        self.playback_ready.set()
 
-        # we need to wait manually for tci processing
-        if HamlibParam.hamlib_radiocontrol in ["tci"]:
-            duration = len(txbuffer_out) / 8000
-            timestamp_to_sleep = time.time() + duration
-            self.log.debug("[MDM] TCI calculated duration", duration=duration)
-            tci_timeout_reached = False
-            #while time.time() < timestamp_to_sleep:
-            #    threading.Event().wait(0.01)
-        else:
-            timestamp_to_sleep = time.time()
-            # set tci timeout reached to True for overriding if not used
-            tci_timeout_reached = True
-
-        while self.modoutqueue or not tci_timeout_reached:
-            if HamlibParam.hamlib_radiocontrol in ["tci"]:
-                if time.time() < timestamp_to_sleep:
-                    tci_timeout_reached = False
-                else:
-                    tci_timeout_reached = True
-
-            threading.Event().wait(0.01)
-            # if we're transmitting FreeDATA signals, reset channel busy state
-            ModemParam.channel_busy = False
-
-
-
+        self.wait_for_playback(len(txbuffer_out) / 8000)
 
         HamlibParam.ptt_state = self.radio.set_ptt(False)
+        self.ptt_off_timestamp = time.time()
+        self.playback_enabled = False
 
         # Push ptt state to socket stream
         jsondata = {"ptt": "False"}
@@ -801,292 +1060,266 @@ class RF:
 
         self.modem_transmit_queue.task_done()
         TNC.transmitting = False
-        threading.Event().set()
 
         end_of_transmission = time.time()
         transmission_time = end_of_transmission - start_of_transmission
-        self.log.debug("[MDM] ON AIR TIME", time=transmission_time)
-
-    def enqueue_modulation(self, txbuffer_out):
-        chunk_length = self.AUDIO_FRAMES_PER_BUFFER_TX  # 4800
-        chunk = [
-            txbuffer_out[i: i + chunk_length]
-            for i in range(0, len(txbuffer_out), chunk_length)
-        ]
-        for c in chunk:
-            # Pad the chunk, if needed
-            if len(c) < chunk_length:
-                delta = chunk_length - len(c)
-                delta_zeros = np.zeros(delta, dtype=np.int16)
-                c = np.append(c, delta_zeros)
-                # self.log.debug("[MDM] mod out shorter than audio buffer", delta=delta)
-            self.modoutqueue.append(c)
-
-
-    def demodulate_audio(
-            self,
-            audiobuffer: codec2.audio_buffer,
-            nin: int,
-            freedv: ctypes.c_void_p,
-            bytes_out,
-            bytes_per_frame,
-            state_buffer,
-            mode_name,
-    ) -> int:
+        self.log.debug(
+            "[MDM] ON AIR TIME",
+            time=transmission_time,
+            ptt_on=self.ptt_on_timestamp,
+            ptt_off=self.ptt_off_timestamp,
+        )
+
+    def wait_for_playback(self, duration: float) -> None:
         """
-        De-modulate supplied audio stream with supplied codec2 instance.
-        Decoded audio is placed into `bytes_out`.
-
-        :param audiobuffer: Incoming audio
-        :type audiobuffer: codec2.audio_buffer
-        :param nin: Number of frames codec2 is expecting
-        :type nin: int
-        :param freedv: codec2 instance
-        :type freedv: ctypes.c_void_p
-        :param bytes_out: Demodulated audio
-        :type bytes_out: _type_
-        :param bytes_per_frame: Number of bytes per frame
-        :type bytes_per_frame: int
-        :param state_buffer: modem states
-        :type state_buffer: int
-        :param mode_name: mode name
-        :type mode_name: str
-        :return: NIN from freedv instance
-        :rtype: int
+        Wait until the transmission has been played. TCI takes the audio
+        faster than real time, so with TCI we also wait for its duration.
+
+        Args:
+          duration: seconds of modulated audio
         """
-        nbytes = 0
-        try:
-            while self.stream.active:
-                threading.Event().wait(0.01)
-                while audiobuffer.nbuffer >= nin:
-                    # demodulate audio
-                    nbytes = codec2.api.freedv_rawdatarx(
-                        freedv, bytes_out, audiobuffer.buffer.ctypes
-                    )
-                    # get current modem states and write to list
-                    # 1 trial
-                    # 2 sync
-                    # 3 trial sync
-                    # 6 decoded
-                    # 10 error decoding == NACK
-                    rx_status = codec2.api.freedv_get_rx_status(freedv)
-
-                    if rx_status != 0:
-                        # we need to disable this if in testmode as its causing problems with FIFO it seems
-                        if not TESTMODE:
-                            ModemParam.is_codec2_traffic = True
-
-                        self.log.debug(
-                            "[MDM] [demod_audio] modem state", mode=mode_name, rx_status=rx_status,
-                            sync_flag=codec2.api.rx_sync_flags_to_text[rx_status]
-                        )
-                    else:
-                        ModemParam.is_codec2_traffic = False
-
-                    if rx_status == 10:
-                        state_buffer.append(rx_status)
-
-                    audiobuffer.pop(nin)
-                    nin = codec2.api.freedv_nin(freedv)
-                    if nbytes == bytes_per_frame:
-                        print(bytes(bytes_out))
-
-                        # process commands only if TNC.listen = True
-                        if TNC.listen:
-
-
-                            # ignore data channel opener frames for avoiding toggle states
-                            # use case: opener already received, but ack got lost and we are receiving
-                            # an opener again
-                            if mode_name in ["sig1-datac13"] and int.from_bytes(bytes(bytes_out[:1]), "big") in [
-                                FRAME_TYPE.ARQ_SESSION_OPEN.value,
-                                FRAME_TYPE.ARQ_DC_OPEN_W.value,
-                                FRAME_TYPE.ARQ_DC_OPEN_ACK_W.value,
-                                FRAME_TYPE.ARQ_DC_OPEN_N.value,
-                                FRAME_TYPE.ARQ_DC_OPEN_ACK_N.value
-                            ]:
-                                print("dropp")
-                            elif int.from_bytes(bytes(bytes_out[:1]), "big") in [
-                                FRAME_TYPE.MESH_BROADCAST.value,
-                                FRAME_TYPE.MESH_SIGNALLING_PING.value,
-                                FRAME_TYPE.MESH_SIGNALLING_PING_ACK.value,
-                            ]:
-                                self.log.debug(
-                                    "[MDM] [demod_audio] moving data to mesh dispatcher", nbytes=nbytes
-                                )
-                                MESH_RECEIVED_QUEUE.put(bytes(bytes_out))
-
-                            else:
-                                self.log.debug(
-                                    "[MDM] [demod_audio] Pushing received data to received_queue", nbytes=nbytes
-                                )
-
-                                self.modem_received_queue.put([bytes_out, freedv, bytes_per_frame])
-                                self.get_scatter(freedv)
-                                self.calculate_snr(freedv)
-                                state_buffer = []
-                        else:
-                            self.log.warning(
-                                "[MDM] [demod_audio] received frame but ignored processing",
-                                listen=TNC.listen
-                            )
-        except Exception as e:
-            self.log.warning("[MDM] [demod_audio] Stream not active anymore", e=e)
-        return nin
-
-    def init_codec2_mode(self, mode, adv):
+        # if we're transmitting FreeDATA signals, reset channel busy state
+        ModemParam.channel_busy = False
+        CHANNEL_OCCUPANCY.reset()
+
+        end = time.time() + duration
+        self.playback_complete.wait()
+        # we need to wait manually for tci processing
+        if HamlibParam.hamlib_radiocontrol in ["tci"]:
+            self.log.debug("[MDM] TCI calculated duration", duration=duration)
+            remaining = end - time.time()
+            if remaining > 0:
+                threading.Event().wait(remaining)
+
+        # our own signal may have been detected meanwhile
+        ModemParam.channel_busy = False
+        CHANNEL_OCCUPANCY.reset()
+
+    def enqueue_modulation(self, txbuffer_out, last: bool = True):
         """
-        Init codec2 and return some important parameters
+        Write modulated audio to the playback buffer, waiting while it is full
 
         Args:
-          self:
-          mode:
-          adv:
+          txbuffer_out: np.int16 audio at the device rate
+          last: end of the transmission, playback_complete is set once it has been played
+        """
+        playback = self.playback_buffer
+        start = 0
+        while start < len(txbuffer_out):
+            free = playback.size - playback.nbuffer
+            if not free:
+                if self.mod_out_locked:
+                    # the buffer can only drain if we start playing
+                    self.mod_out_locked = False
+                    self.dsp_event.set()
+                    self.playback_ready.set()
+                self.playback_event.clear()
+                if playback.size == playback.nbuffer:
+                    self.playback_event.wait(0.1)
+                continue
+            nsamples = min(free, len(txbuffer_out) - start)
+            playback.push(txbuffer_out[start : start + nsamples])
+            start += nsamples
+            self.playback_ready.set()
+
+        if last:
+            self.playback_end = playback._wr
+            # the reader may have played everything already
+            if playback._rd >= self.playback_end:
+                self.playback_complete.set()
+            self.playback_ready.set()
+
+    def playback_pop(self, nsamples: int) -> None:
+        """
+        Remove `nsamples` played samples from the playback buffer, called by its reader
+        after copying them to the audio device, TCI or the test pipe
 
-        Returns:
-            c2instance, bytes_per_frame, bytes_out, audio_buffer, nin
+        Args:
+          nsamples: number of samples
+        """
+        playback = self.playback_buffer
+        playback.pop(nsamples)
+        self.playback_event.set()
+        playback_end = self.playback_end
+        if playback_end is not None and playback._rd >= playback_end:
+            self.playback_complete.set()
+
+    def demodulate_audio(self, demodulator: demodulator.Demodulator) -> int:
         """
-        if adv:
-            # FSK Long-distance Parity Code 1 - data frames
-            c2instance = ctypes.cast(
-                codec2.api.freedv_open_advanced(
-                    codec2.FREEDV_MODE.fsk_ldpc.value,
-                    ctypes.byref(adv),
-                ),
-                ctypes.c_void_p,
+        De-modulate all available audio of a demodulator with its codec2 instance.
+        Decoded audio is placed into `demodulator.bytes_out`.
+        Called by the demodulator scheduler when there is new audio for this mode.
+
+        :param demodulator: codec2 instance, audio buffer reader and state of the mode
+        :type demodulator: demodulator.Demodulator
+        :return: Number of freedv_rawdatarx calls
+        :rtype: int
+        """
+        def on_frame(frame: bytes, _) -> None:
+            demodulator.frames += 1
+            if self.process_received_frame(demodulator, frame, demodulator.telemetry.snr):
+                self.get_scatter(demodulator.freedv, demodulator.get_modem_stats())
+                self.calculate_snr(demodulator.freedv)
+
+        return demodulator.demodulate(
+            on_frame, lambda rx_status: self.process_rx_status(demodulator, rx_status)
+        )
+
+    def process_rx_status(self, demodulator: demodulator.Demodulator, rx_status: int) -> None:
+        """
+        Update the channel state with the modem state of a demodulator
+
+        :param demodulator: demodulator which reported the state
+        :type demodulator: demodulator.Demodulator
+        :param rx_status: codec2 rx status
+        :type rx_status: int
+        """
+        # get current modem states and write to list
+        # 1 trial
+        # 2 sync
+        # 3 trial sync
+        # 6 decoded
+        # 10 error decoding == NACK
+        if rx_status != 0:
+            # we need to disable this if in testmode as its causing problems with FIFO it seems
+            if not TESTMODE:
+                ModemParam.is_codec2_traffic = True
+
+            self.log.debug(
+                "[MDM] [demod_audio] modem state", mode=demodulator.name, rx_status=rx_status,
+                sync_flag=codec2.api.rx_sync_flags_to_text[rx_status]
             )
         else:
+            ModemParam.is_codec2_traffic = False
+
+        if rx_status == 10:
+            demodulator.state_buffer.append(rx_status)
 
-            # create codec2 instance
-            c2instance = ctypes.cast(
-                codec2.api.freedv_open(mode), ctypes.c_void_p
+    def process_received_frame(self, demodulator: demodulator.Demodulator, bytes_out, snr: float) -> bool:
+        """
+        Dispatch a decoded frame to the mesh or the data handler
+
+        :param demodulator: demodulator which decoded the frame
+        :type demodulator: demodulator.Demodulator
+        :param bytes_out: decoded frame
+        :type bytes_out: bytes
+        :param snr: signal-to-noise ratio of the frame
+        :type snr: float
+        :return: True if the frame has been pushed to the received queue
+        :rtype: bool
+        """
+        print(bytes(bytes_out))
+        nbytes = len(bytes_out)
+
+        # process commands only if TNC.listen = True
+        if not TNC.listen:
+            self.log.warning(
+                "[MDM] [demod_audio] received frame but ignored processing",
+                listen=TNC.listen
             )
+            return False
 
-        # set tuning range
-        codec2.api.freedv_set_tuning_range(
-            c2instance,
-            ctypes.c_float(ModemParam.tuning_range_fmin),
-            ctypes.c_float(ModemParam.tuning_range_fmax),
-        )
+        # ignore data channel opener frames for avoiding toggle states
+        # use case: opener already received, but ack got lost and we are receiving
+        # an opener again
+        if demodulator.name in ["sig1-datac13"] and int.from_bytes(bytes(bytes_out[:1]), "big") in [
+            FRAME_TYPE.ARQ_SESSION_OPEN.value,
+            FRAME_TYPE.ARQ_DC_OPEN_W.value,
+            FRAME_TYPE.ARQ_DC_OPEN_ACK_W.value,
+            FRAME_TYPE.ARQ_DC_OPEN_N.value,
+            FRAME_TYPE.ARQ_DC_OPEN_ACK_N.value
+        ]:
+            print("dropp")
+            return False
 
-        # get bytes per frame
-        bytes_per_frame = int(
-            codec2.api.freedv_get_bits_per_modem_frame(c2instance) / 8
-        )
+        if int.from_bytes(bytes(bytes_out[:1]), "big") in [
+            FRAME_TYPE.MESH_BROADCAST.value,
+            FRAME_TYPE.MESH_SIGNALLING_PING.value,
+            FRAME_TYPE.MESH_SIGNALLING_PING_ACK.value,
+        ]:
+            self.log.debug(
+                "[MDM] [demod_audio] moving data to mesh dispatcher", nbytes=nbytes
+            )
+            MESH_RECEIVED_QUEUE.put(bytes(bytes_out))
+            return False
 
-        # create byte out buffer
-        bytes_out = ctypes.create_string_buffer(bytes_per_frame)
-
-        # set initial frames per burst
-        codec2.api.freedv_set_frames_per_burst(c2instance, 1)
-
-        # init audio buffer
-        audio_buffer = codec2.audio_buffer(2 * self.AUDIO_FRAMES_PER_BUFFER_RX)
-
-        # get initial nin
-        nin = codec2.api.freedv_nin(c2instance)
-
-        # Additional Datac0-specific information - these are not referenced anywhere else.
-        # self.sig0_datac0_payload_per_frame = self.sig0_datac0_bytes_per_frame - 2
-        # self.sig0_datac0_n_nom_modem_samples = codec2.api.freedv_get_n_nom_modem_samples(
-        #     self.sig0_datac0_freedv
-        # )
-        # self.sig0_datac0_n_tx_modem_samples = codec2.api.freedv_get_n_tx_modem_samples(
-        #     self.sig0_datac0_freedv
-        # )
-        # self.sig0_datac0_n_tx_preamble_modem_samples = (
-        #     codec2.api.freedv_get_n_tx_preamble_modem_samples(self.sig0_datac0_freedv)
-        # )
-        # self.sig0_datac0_n_tx_postamble_modem_samples = (
-        #     codec2.api.freedv_get_n_tx_postamble_modem_samples(self.sig0_datac0_freedv)
-        # )
-
-        # return values
-        return c2instance, bytes_per_frame, bytes_out, audio_buffer, nin
-
-    def audio_sig0_datac13(self) -> None:
-        """Receive data encoded with datac13 - 0"""
-        self.sig0_datac13_nin = self.demodulate_audio(
-            self.sig0_datac13_buffer,
-            self.sig0_datac13_nin,
-            self.sig0_datac13_freedv,
-            self.sig0_datac13_bytes_out,
-            self.sig0_datac13_bytes_per_frame,
-            SIG0_DATAC13_STATE,
-            "sig0-datac13"
+        self.log.debug(
+            "[MDM] [demod_audio] Pushing received data to received_queue", nbytes=nbytes
         )
-
-    def audio_sig1_datac13(self) -> None:
-        """Receive data encoded with datac13 - 1"""
-        self.sig1_datac13_nin = self.demodulate_audio(
-            self.sig1_datac13_buffer,
-            self.sig1_datac13_nin,
-            self.sig1_datac13_freedv,
-            self.sig1_datac13_bytes_out,
-            self.sig1_datac13_bytes_per_frame,
-            SIG1_DATAC13_STATE,
-            "sig1-datac13"
+        # bytes_out is overwritten by the next decode, the data handler might not have read it by then
+        self.modem_received_queue.put(
+            [bytes(bytes_out), demodulator.name, demodulator.bytes_per_frame, snr, demodulator.telemetry]
         )
+        return True
 
-    def audio_dat0_datac4(self) -> None:
-        """Receive data encoded with datac4"""
-        self.dat0_datac4_nin = self.demodulate_audio(
-            self.dat0_datac4_buffer,
-            self.dat0_datac4_nin,
-            self.dat0_datac4_freedv,
-            self.dat0_datac4_bytes_out,
-            self.dat0_datac4_bytes_per_frame,
-            DAT0_DATAC4_STATE,
-            "dat0-datac4"
-        )
+    def process_demodulated_frame(
+            self, demodulator: demodulator.Demodulator, bytes_out: bytes, snr: float, scatter
+    ) -> None:
+        """
+        Handle a frame decoded by a demodulator process
+
+        :param demodulator: demodulator which decoded the frame
+        :type demodulator: demodulator.Demodulator
+        :param bytes_out: decoded frame
+        :type bytes_out: bytes
+        :param snr: signal-to-noise ratio of the frame
+        :type snr: float
+        :param scatter: scatter plot of the frame, empty if disabled
+        :type scatter: np.ndarray
+        """
+        if self.process_received_frame(demodulator, bytes_out, snr):
+            if ModemParam.enable_scatter:
+                ModemParam.scatter = scatter
+            self.log.info("[MDM] calculate_snr: ", snr=snr)
+            ModemParam.snr = snr
 
-    def audio_dat0_datac1(self) -> None:
-        """Receive data encoded with datac1"""
-        self.dat0_datac1_nin = self.demodulate_audio(
-            self.dat0_datac1_buffer,
-            self.dat0_datac1_nin,
-            self.dat0_datac1_freedv,
-            self.dat0_datac1_bytes_out,
-            self.dat0_datac1_bytes_per_frame,
-            DAT0_DATAC1_STATE,
-            "dat0-datac1"
-        )
+    def init_demodulator(self, name: str, mode: int, state_buffer: list) -> demodulator.Demodulator:
+        """
+        Create a demodulator of a mode, its codec2 instance is opened when we start listening
 
-    def audio_dat0_datac3(self) -> None:
-        """Receive data encoded with datac3"""
-        self.dat0_datac3_nin = self.demodulate_audio(
-            self.dat0_datac3_buffer,
-            self.dat0_datac3_nin,
-            self.dat0_datac3_freedv,
-            self.dat0_datac3_bytes_out,
-            self.dat0_datac3_bytes_per_frame,
-            DAT0_DATAC3_STATE,
-            "dat0-datac3"
-        )
+        Args:
+          name: name of the demodulator
+          mode: codec2 mode
+          state_buffer: list for collecting failed decodings
 
-    def audio_fsk_ldpc_0(self) -> None:
-        """Receive data encoded with FSK + LDPC0"""
-        self.fsk_ldpc_nin_0 = self.demodulate_audio(
-            self.fsk_ldpc_buffer_0,
-            self.fsk_ldpc_nin_0,
-            self.fsk_ldpc_freedv_0,
-            self.fsk_ldpc_bytes_out_0,
-            self.fsk_ldpc_bytes_per_frame_0,
-            FSK_LDPC0_STATE,
-            "fsk_ldpc0",
+        Returns:
+            demodulator.Demodulator
+        """
+        # init read cursor into our shared audio buffer. If the mode gets enabled while
+        # a transmission is already running, it starts with the last 0.6s of audio
+        audio_buffer = self.rx_audio_buffer.reader(history=self.AUDIO_FRAMES_PER_BUFFER_RX)
+
+        return demodulator.Demodulator(
+            name,
+            mode,
+            audio_buffer,
+            state_buffer,
+            (ModemParam.tuning_range_fmin, ModemParam.tuning_range_fmax),
+            ModemParam.decoder_grace_period,
         )
 
-    def audio_fsk_ldpc_1(self) -> None:
-        """Receive data encoded with FSK + LDPC1"""
-        self.fsk_ldpc_nin_1 = self.demodulate_audio(
-            self.fsk_ldpc_buffer_1,
-            self.fsk_ldpc_nin_1,
-            self.fsk_ldpc_freedv_1,
-            self.fsk_ldpc_bytes_out_1,
-            self.fsk_ldpc_bytes_per_frame_1,
-            FSK_LDPC1_STATE,
-            "fsk_ldpc1",
-        )
+    def get_tx_instance(self, mode: int):
+        """
+        Return the codec2 instance for transmitting `mode`, opened on first use
+
+        Args:
+          mode: codec2 mode
+
+        Returns:
+            codec2 instance or None if we can't transmit this mode
+        """
+        if mode not in TX_MODES:
+            return None
+
+        if mode not in self.tx_instances:
+            start = time.perf_counter()
+            self.tx_instances[mode] = open_codec2_instance(mode)
+            self.log.info(
+                "[MDM] opened codec2 tx instance",
+                mode=codec2.FREEDV_MODE(mode).name,
+                startup_time=round((time.perf_counter() - start) * 1000, 2),
+            )
+        return self.tx_instances[mode]
 
     def worker_transmit(self) -> None:
         """Worker for FIFO queue for processing frames to be transmitted"""
@@ -1096,25 +1329,140 @@ class RF:
             # we could do a cleanup after a transmission so theres no reason sending twice
             queuesize = self.modem_transmit_queue.qsize()
             self.log.debug("[MDM] self.modem_transmit_queue", qsize=queuesize)
-            data = self.modem_transmit_queue.get()
-
-            if data[0] in ["morse"]:
-                self.transmit_morse(repeats=data[1], repeat_delay=data[2], frames=data[3])
-            else:
-                self.transmit(
-                    mode=data[0], repeats=data[1], repeat_delay=data[2], frames=data[3]
+            burst = self.modem_transmit_queue.get_burst()
+            ModemParam.transmit_queue_stats = self.modem_transmit_queue.get_statistics()
+            data = burst[0]
+            if len(burst) > 1:
+                # compatible requests share the PTT cycle of the first one
+                data = data[:3] + [[frame for request in burst for frame in request[3]]]
+                self.log_coalesced_burst(burst)
+
+            # requests of enqueue_transmission carry a completion handle
+            transmissions = [request[4] for request in burst if len(request) > 4 and request[4] is not None]
+            for transmission in transmissions:
+                transmission.dequeued = time.time()
+                self.log.debug(
+                    "[MDM] transmit request",
+                    priority=transmit_scheduler.get_priority(data[0], data[3]).name,
+                    queue_wait=transmission.queue_wait,
                 )
+            # set by keying up and down
+            self.ptt_on_timestamp = 0.0
+            self.ptt_off_timestamp = 0.0
+
+            sent = False
+            try:
+                if data[0] in ["morse"]:
+                    self.transmit_morse(repeats=data[1], repeat_delay=data[2], frames=data[3])
+                    sent = True
+                else:
+                    sent = self.transmit(
+                        mode=data[0], repeats=data[1], repeat_delay=data[2], frames=data[3]
+                    ) is not False
+            finally:
+                # don't leave the caller waiting if we couldn't transmit
+                TNC.transmitting = False
+                for transmission in transmissions:
+                    transmission.ptt_on = self.ptt_on_timestamp
+                    transmission.ptt_off = self.ptt_off_timestamp
+                    transmission.failed = not sent
+                    transmission.done.set()
             # self.modem_transmit_queue.task_done()
 
+    def log_coalesced_burst(self, burst: list) -> None:
+        """
+        Account for the PTT cycles and airtime saved by sending requests in one burst
+
+        Args:
+          burst: transmit requests of get_burst
+        """
+        _, repeats, repeat_delay = burst[0][:3]
+        saved_cycles = len(burst) - 1
+        # every request would have started with the tx delay and ended with its repeat delays
+        saved_airtime = saved_cycles * (max(ModemParam.tx_delay, 0) + repeats * repeat_delay) / 1000
+        ModemParam.tx_coalesced_ptt_cycles += saved_cycles
+        ModemParam.tx_coalesced_airtime += saved_airtime
+        self.log.info(
+            "[MDM] coalesced transmit requests",
+            requests=len(burst),
+            frames=sum(len(request[3]) for request in burst),
+            saved_airtime=round(saved_airtime, 3),
+            saved_ptt_cycles_total=ModemParam.tx_coalesced_ptt_cycles,
+            saved_airtime_total=round(ModemParam.tx_coalesced_airtime, 3),
+        )
+
+    @staticmethod
+    def get_prerender_key(mode, repeats: int, repeat_delay: int, frames) -> tuple:
+        """
+        Identify a transmit request, including everything which changes its audio
+
+        Args:
+          mode: codec2 mode
+          repeats: number of repeats
+          repeat_delay: delay between repeats in ms
+          frames: list of frames
+
+        Returns:
+            key of self.prerendered
+        """
+        return (
+            mode,
+            repeats,
+            repeat_delay,
+            max(ModemParam.tx_delay, 0),
+            tuple(get_prerender_frame_key(frame) for frame in frames),
+        )
+
+    def worker_prerender(self) -> None:
+        """Worker for modulating the requests of prerender_transmission"""
+        while True:
+            data = self.modem_prerender_queue.get()
+            # only the latest prediction is of interest
+            while not self.modem_prerender_queue.empty():
+                data = self.modem_prerender_queue.get()
+
+            mode, repeats, repeat_delay, frames = data
+            if mode not in TX_MODES:
+                continue
+            key = self.get_prerender_key(mode, repeats, repeat_delay, frames)
+            with self.prerender_lock:
+                if key in self.prerendered:
+                    self.prerendered.move_to_end(key)
+                    continue
+
+            if mode not in self.prerender_instances:
+                self.prerender_instances[mode] = open_codec2_instance(mode)
+
+            start = time.perf_counter()
+            x = codec2.modulate(
+                self.prerender_instances[mode],
+                mode,
+                frames,
+                repeats,
+                int(self.MODEM_SAMPLE_RATE * (repeat_delay / 1000)),
+                int(self.MODEM_SAMPLE_RATE * (key[3] / 1000)),
+            )
+            with self.prerender_lock:
+                self.prerendered[key] = x
+                while len(self.prerendered) > PRERENDER_CACHE_SIZE:
+                    self.prerendered.popitem(last=False)
+            self.log.debug(
+                "[MDM] pre-rendered transmission",
+                mode=codec2.FREEDV_MODE(mode).name,
+                duration=round((time.perf_counter() - start) * 1000, 2),
+            )
+
     def worker_received(self) -> None:
         """Worker for FIFO queue for processing received frames"""
         while True:
             data = self.modem_received_queue.get()
             self.log.debug("[MDM] worker_received: received data!")
             # data[0] = bytes_out
-            # data[1] = freedv session
+            # data[1] = name of the demodulator
             # data[2] = bytes_per_frame
-            DATA_QUEUE_RECEIVED.put([data[0], data[1], data[2]])
+            # data[3] = snr of the frame
+            # data[4] = telemetry of the decoder
+            DATA_QUEUE_RECEIVED.put([data[0], data[1], data[2], data[3], data[4]])
             self.modem_received_queue.task_done()
 
     def get_frequency_offset(self, freedv: ctypes.c_void_p) -> float:
@@ -1127,52 +1475,24 @@ class RF:
         :return: Offset of audio frequency in Hz
         :rtype: float
         """
-        modemStats = codec2.MODEMSTATS()
-        codec2.api.freedv_get_modem_extended_stats(freedv, ctypes.byref(modemStats))
-        offset = round(modemStats.foff) * (-1)
+        offset = round(self.modem_stats.update(freedv).foff) * (-1)
         ModemParam.frequency_offset = offset
         return offset
 
-    def get_scatter(self, freedv: ctypes.c_void_p) -> None:
+    def get_scatter(self, freedv: ctypes.c_void_p, stats: codec2.modem_stats) -> None:
         """
         Ask codec2 for data about the received signal and calculate the scatter plot.
         Side-effect: sets ModemParam.scatter
 
         :param freedv: codec2 instance to query
         :type freedv: ctypes.c_void_p
+        :param stats: reused modem stats of the codec2 instance
+        :type stats: codec2.modem_stats
         """
         if not ModemParam.enable_scatter:
             return
 
-        modemStats = codec2.MODEMSTATS()
-        ctypes.cast(
-            codec2.api.freedv_get_modem_extended_stats(freedv, ctypes.byref(modemStats)),
-            ctypes.c_void_p,
-        )
-
-        scatterdata = []
-        # original function before itertool
-        # for i in range(codec2.MODEM_STATS_NC_MAX):
-        #    for j in range(1, codec2.MODEM_STATS_NR_MAX, 2):
-        #        # print(f"{modemStats.rx_symbols[i][j]} - {modemStats.rx_symbols[i][j]}")
-        #        xsymbols = round(modemStats.rx_symbols[i][j - 1] // 1000)
-        #        ysymbols = round(modemStats.rx_symbols[i][j] // 1000)
-        #        if xsymbols != 0.0 and ysymbols != 0.0:
-        #            scatterdata.append({"x": str(xsymbols), "y": str(ysymbols)})
-
-        for i, j in itertools.product(range(codec2.MODEM_STATS_NC_MAX), range(1, codec2.MODEM_STATS_NR_MAX, 2)):
-            # print(f"{modemStats.rx_symbols[i][j]} - {modemStats.rx_symbols[i][j]}")
-            xsymbols = round(modemStats.rx_symbols[i][j - 1] // 1000)
-            ysymbols = round(modemStats.rx_symbols[i][j] // 1000)
-            if xsymbols != 0.0 and ysymbols != 0.0:
-                scatterdata.append({"x": str(xsymbols), "y": str(ysymbols)})
-
-        # Send all the data if we have too-few samples, otherwise send a sampling
-        if 150 > len(scatterdata) > 0:
-            ModemParam.scatter = scatterdata
-        else:
-            # only take every tenth data point
-            ModemParam.scatter = scatterdata[::10]
+        ModemParam.scatter = demodulator.get_scatter(freedv, stats)
 
     def calculate_snr(self, freedv: ctypes.c_void_p) -> float:
         """
@@ -1186,16 +1506,7 @@ class RF:
         :rtype: float
         """
         try:
-            modem_stats_snr = ctypes.c_float()
-            modem_stats_sync = ctypes.c_int()
-
-            codec2.api.freedv_get_modem_stats(
-                freedv, ctypes.byref(modem_stats_sync), ctypes.byref(modem_stats_snr)
-            )
-            modem_stats_snr = modem_stats_snr.value
-            modem_stats_sync = modem_stats_sync.value
-
-            snr = round(modem_stats_snr, 1)
+            snr = demodulator.get_snr(freedv)
             self.log.info("[MDM] calculate_snr: ", snr=snr)
             ModemParam.snr = snr
             # ModemParam.snr = np.clip(
@@ -1257,125 +1568,44 @@ class RF:
                 threading.Event().wait(1)
     def calculate_fft(self) -> None:
         """
-        Calculate an average signal strength of the channel to assess
-        whether the channel is "busy."
+        Calculate the spectrum of new audio for the waterfall and assess
+        which slots of the channel are "busy."
         """
-        # Initialize channel_busy_delay counter
-        channel_busy_delay = 0
-
-        # Initialize dbfs counter
-        rms_counter = 0
-
         while True:
-            # threading.Event().wait(0.01)
-            threading.Event().wait(0.01)
-            # WE NEED TO OPTIMIZE THIS!
-
-            # Start calculating the FFT once enough samples are captured.
-            if len(self.fft_data) >= 128:
-                # https://gist.github.com/ZWMiller/53232427efc5088007cab6feee7c6e4c
-                # Fast Fourier Transform, 10*log10(abs) is to scale it to dB
-                # and make sure it's not imaginary
-                try:
-                    fftarray = np.fft.rfft(self.fft_data)
-
-                    # Set value 0 to 1 to avoid division by zero
-                    fftarray[fftarray == 0] = 1
-                    dfft = 10.0 * np.log10(abs(fftarray))
-
-                    # get average of dfft
-                    avg = np.mean(dfft)
-
-                    # Detect signals which are higher than the
-                    # average + 10 (+10 smoothes the output).
-                    # Data higher than the average must be a signal.
-                    # Therefore we are setting it to 100 so it will be highlighted
-                    # Have to do this when we are not transmitting so our
-                    # own sending data will not affect this too much
-                    if not TNC.transmitting:
-                        dfft[dfft > avg + 15] = 100
-
-                        # Calculate audio dbfs
-                        # https://stackoverflow.com/a/9763652
-                        # calculate dbfs every 50 cycles for reducing CPU load
-                        rms_counter += 1
-                        if rms_counter > 50:
-                            d = np.frombuffer(self.fft_data, np.int16).astype(np.float32)
-                            # calculate RMS and then dBFS
-                            # https://dsp.stackexchange.com/questions/8785/how-to-compute-dbfs
-                            # try except for avoiding runtime errors by division/0
-                            try:
-                                rms = int(np.sqrt(np.max(d ** 2)))
-                                if rms == 0:
-                                    raise ZeroDivisionError
-                                AudioParam.audio_dbfs = 20 * np.log10(rms / 32768)
-                            except Exception as e:
-                                # FIXME: Disabled for cli cleanup
-                                #self.log.warning(
-                                #    "[MDM] fft calculation error - please check your audio setup",
-                                #    e=e,
-                                #)
-                                AudioParam.audio_dbfs = -100
-
-                            rms_counter = 0
+            if not self.spectrum.wait(1.0):
+                continue
+            # the waterfall is only needed if somebody is listening
+            self.spectrum.reduced = not sock.CONNECTED_CLIENTS
+            dfft = self.spectrum.update()
+            if dfft is None:
+                continue
 
+            try:
+                # Detect signals per slot, but not while we are transmitting
+                # so our own sending data will not affect this too much
+                busy = CHANNEL_OCCUPANCY.update(dfft, self.spectrum.elapsed, detect=not TNC.transmitting)
+                ModemParam.channel_busy = bool(busy.any())
+                ModemParam.channel_busy_slot = busy.tolist()
+                ModemParam.channel_occupancy = CHANNEL_OCCUPANCY.occupancy(OCCUPANCY_WINDOW)
+
+                if not TNC.transmitting:
+                    # Highlight signals which are higher than the average + 15
+                    dfft[dfft > np.mean(dfft) + 15] = 100
+
+                    # Calculate audio dbfs from the peak of the new samples
+                    # https://dsp.stackexchange.com/questions/8785/how-to-compute-dbfs
+                    peak = self.spectrum.peak
+                    AudioParam.audio_dbfs = 20 * np.log10(peak / 32768) if peak else -100
+
+                if not self.spectrum.reduced:
                     # Convert data to int to decrease size
-                    dfft = dfft.astype(int)
-
-                    # Create list of dfft for later pushing to AudioParam.fft
-                    dfftlist = dfft.tolist()
-
-                    # Reduce area where the busy detection is enabled
-                    # We want to have this in correlation with mode bandwidth
-                    # TODO: This is not correctly and needs to be checked for correct maths
-                    # dfftlist[0:1] = 10,15Hz
-                    # Bandwidth[Hz] / 10,15
-                    # narrowband = 563Hz = 56
-                    # wideband = 1700Hz = 167
-                    # 1500Hz = 148
-                    # 2700Hz = 266
-                    # 3200Hz = 315
-
-                    # slot
-                    slot = 0
-                    slot1 = [0, 65]
-                    slot2 = [65,120]
-                    slot3 = [120, 176]
-                    slot4 = [176, 231]
-                    slot5 = [231, len(dfftlist)]
-                    for range in [slot1, slot2, slot3, slot4, slot5]:
-
-                        range_start = range[0]
-                        range_end = range[1]
-                        # define the area, we are detecting busy state
-                        #dfft = dfft[120:176] if TNC.low_bandwidth_mode else dfft[65:231]
-                        slotdfft = dfft[range_start:range_end]
-                        # Check for signals higher than average by checking for "100"
-                        # If we have a signal, increment our channel_busy delay counter
-                        # so we have a smoother state toggle
-                        if np.sum(slotdfft[slotdfft > avg + 15]) >= 200 and not TNC.transmitting:
-                            ModemParam.channel_busy = True
-                            ModemParam.channel_busy_slot[slot] = True
-                            # Limit delay counter to a maximum of 200. The higher this value,
-                            # the longer we will wait until releasing state
-                            channel_busy_delay = min(channel_busy_delay + 10, 200)
-                        else:
-                            # Decrement channel busy counter if no signal has been detected.
-                            channel_busy_delay = max(channel_busy_delay - 1, 0)
-                            # When our channel busy counter reaches 0, toggle state to False
-                            if channel_busy_delay == 0:
-                                ModemParam.channel_busy = False
-                                ModemParam.channel_busy_slot[slot] = False
-
-                        # increment slot
-                        slot += 1
-
-                    AudioParam.fft = dfftlist[:315]  # 315 --> bandwidth 3200
-                except Exception as err:
-                    self.log.error(f"[MDM] calculate_fft: Exception: {err}")
-                    self.log.debug("[MDM] Setting fft=0")
-                    # else 0
-                    AudioParam.fft = [0]
+                    AudioParam.fft = dfft.astype(int).tolist()
+                AudioParam.spectrum_stats = self.spectrum.stats()
+            except Exception as err:
+                self.log.error(f"[MDM] calculate_fft: Exception: {err}")
+                self.log.debug("[MDM] Setting fft=0")
+                # else 0
+                AudioParam.fft = [0]
 
     def set_frames_per_burst(self, frames_per_burst: int) -> None:
         """
@@ -1390,10 +1620,9 @@ class RF:
 
         frames_per_burst = 1
 
-        codec2.api.freedv_set_frames_per_burst(self.dat0_datac1_freedv, frames_per_burst)
-        codec2.api.freedv_set_frames_per_burst(self.dat0_datac3_freedv, frames_per_burst)
-        codec2.api.freedv_set_frames_per_burst(self.dat0_datac4_freedv, frames_per_burst)
-        codec2.api.freedv_set_frames_per_burst(self.fsk_ldpc_freedv_0, frames_per_burst)
+        self.demodulator_scheduler.command(
+            ["dat0-datac1", "dat0-datac3", "dat0-datac4", "fsk_ldpc0"], "frames_per_burst", frames_per_burst
+        )
 
     def reset_data_sync(self) -> None:
         """
@@ -1403,10 +1632,9 @@ class RF:
         :type frames_per_burst: int
         """
 
-        codec2.api.freedv_set_sync(self.dat0_datac1_freedv, 0)
-        codec2.api.freedv_set_sync(self.dat0_datac3_freedv, 0)
-        codec2.api.freedv_set_sync(self.dat0_datac4_freedv, 0)
-        codec2.api.freedv_set_sync(self.fsk_ldpc_freedv_0, 0)
+        self.demodulator_scheduler.command(
+            ["dat0-datac1", "dat0-datac3", "dat0-datac4", "fsk_ldpc0"], "sync", 0
+        )
 
 
 def open_codec2_instance(mode: int) -> ctypes.c_void_p:
@@ -1418,25 +1646,7 @@ def open_codec2_instance(mode: int) -> ctypes.c_void_p:
     :return: C-function of the requested codec2 instance
     :rtype: ctypes.c_void_p
     """
-    if mode in [codec2.FREEDV_MODE.fsk_ldpc_0.value]:
-        return ctypes.cast(
-            codec2.api.freedv_open_advanced(
-                codec2.FREEDV_MODE.fsk_ldpc.value,
-                ctypes.byref(codec2.api.FREEDV_MODE_FSK_LDPC_0_ADV),
-            ),
-            ctypes.c_void_p,
-        )
-
-    if mode in [codec2.FREEDV_MODE.fsk_ldpc_1.value]:
-        return ctypes.cast(
-            codec2.api.freedv_open_advanced(
-                codec2.FREEDV_MODE.fsk_ldpc.value,
-                ctypes.byref(codec2.api.FREEDV_MODE_FSK_LDPC_1_ADV),
-            ),
-            ctypes.c_void_p,
-        )
-
-    return ctypes.cast(codec2.api.freedv_open(mode), ctypes.c_void_p)
+    return codec2.open_instance(mode)
 
 
 def get_bytes_per_frame(mode: int) -> int:
@@ -1448,23 +1658,23 @@ def get_bytes_per_frame(mode: int) -> int:
     :return: Bytes per frame of the supplied codec2 data mode
     :rtype: int
     """
-    freedv = open_codec2_instance(mode)
-    # TODO: add close session
-    # get number of bytes per frame for mode
-    return int(codec2.api.freedv_get_bits_per_modem_frame(freedv) / 8)
+    return codec2.get_mode_info(mode).bytes_per_frame
 
 
-def set_audio_volume(datalist, volume: float) -> np.int16:
+def set_audio_volume(datalist, volume: float) -> np.ndarray:
     """
     Scale values for the provided audio samples by volume,
     `volume` is clipped to the range of 0-200
 
+    Writable np.int16 arrays are scaled in place, samples saturate
+    instead of wrapping around.
+
     :param datalist: Audio samples to scale
     :type datalist: NDArray[np.int16]
     :param volume: "Percentage" (0-200) to scale samples
     :type volume: float
     :return: Scaled audio samples
-    :rtype: np.int16
+    :rtype: NDArray[np.int16]
     """
     # make sure we have float as data type to avoid crash
     try:
@@ -1475,9 +1685,24 @@ def set_audio_volume(datalist, volume: float) -> np.int16:
 
     # Clip volume provided to acceptable values
     volume = np.clip(volume, 0, 200)  # limit to max value of 255
-    # Scale samples by the ratio of volume / 100.0
-    data = np.fromstring(datalist, np.int16) * (volume / 100.0)  # type: ignore
-    return data.astype(np.int16)
+
+    if isinstance(datalist, np.ndarray) and datalist.dtype == np.int16 and datalist.flags.writeable:
+        data = datalist
+    else:
+        data = np.frombuffer(bytes(datalist), dtype=np.int16).copy()
+    if volume == 100.0:
+        return data
+
+    # Scale samples by the ratio of volume / 100.0, block by block to keep the float copy small
+    scratch = np.empty(min(len(data), GAIN_BLOCK_SIZE), dtype=np.float32)
+    for start in range(0, len(data), GAIN_BLOCK_SIZE):
+        block = data[start : start + GAIN_BLOCK_SIZE]
+        scaled = scratch[: len(block)]
+        np.multiply(block, volume / 100.0, out=scaled)
+        np.clip(scaled, -32768, 32767, out=scaled)
+        # truncates like astype(np.int16)
+        np.copyto(block, scaled, casting="unsafe")
+    return data
 
 
 def get_modem_error_state():
@@ -0,0 +1,173 @@
+"""
+Occupancy of the channel slots, for the busy detection.
+
+The spectrum of calculate_fft is split into SLOTS slots of SLOT_BANDWIDTH Hz
+around CENTER_FREQUENCY, the slots codec2.FREEDV_MODE_USED_SLOTS refers to.
+Every slot has its own hysteresis, so a signal in one slot doesn't keep the
+others busy. The busy slots are kept as a bit mask, so checking if a mode
+fits into the free slots is a single AND, and senders waiting for free slots
+are woken by the next spectrum instead of polling.
+"""
+import threading
+import time
+from typing import Optional
+
+import codec2
+import numpy as np
+import spectrum
+
+SLOTS = 5
+CENTER_FREQUENCY = 1500.0  # Hz
+SLOT_BANDWIDTH = 560.0  # Hz, about the bandwidth of the narrowband modes
+# a signal has to be this much above the average of the spectrum, in dB of the magnitude
+THRESHOLD = 15.0
+# bins above the threshold for a busy slot
+MIN_BINS = 2
+# seconds a slot stays busy, gained per second of signal, up to HOLD_MAX
+HOLD_RISE = 10.0
+HOLD_MAX = 2.0
+# hold times below are released, for rounding errors of the elapsed times
+HOLD_MIN = 0.001
+# spectra kept in the history, about a minute at the full spectrum rate
+HISTORY_SIZE = 600
+
+_slot_bits = {}
+
+
+def slot_bits(slots) -> int:
+    """Bit mask of a list of used slots like codec2.FREEDV_MODE_USED_SLOTS, slot 1 is bit 0"""
+    key = tuple(slots)
+    bits = _slot_bits.get(key)
+    if bits is None:
+        bits = sum(1 << slot for slot, used in enumerate(key) if used)
+        _slot_bits[key] = bits
+    return bits
+
+
+MODE_SLOT_BITS = {name: slot_bits(mode.value) for name, mode in codec2.FREEDV_MODE_USED_SLOTS.__members__.items()}
+
+
+def slot_edges(
+    nbins: int,
+    bin_width: float,
+    nslots: int = SLOTS,
+    center: float = CENTER_FREQUENCY,
+    bandwidth: float = SLOT_BANDWIDTH,
+) -> np.ndarray:
+    """First bin of every slot followed by the end of the last one, the outer slots reach the edges of the spectrum"""
+    frequencies = center + (np.arange(nslots + 1) - nslots / 2) * bandwidth
+    edges = np.clip(np.round(frequencies / bin_width).astype(np.intp), 0, nbins)
+    edges[0] = 0
+    edges[-1] = nbins
+    return edges
+
+
+class ChannelOccupancy:
+    """
+    Busy state and history of the channel slots
+
+    Updated by the FFT thread, queried by everybody else.
+    """
+
+    def __init__(
+        self,
+        nbins: int = spectrum.SPECTRUM_BINS,
+        bin_width: float = spectrum.BIN_WIDTH,
+        nslots: int = SLOTS,
+        history_size: int = HISTORY_SIZE,
+    ) -> None:
+        self.nslots = nslots
+        self.edges = slot_edges(nbins, bin_width, nslots)
+        self.weights = 1 << np.arange(nslots)
+        self.hold = np.zeros(nslots)
+        self.busy = np.zeros(nslots, dtype=np.bool_)
+        self.busy_bits = 0
+        self.condition = threading.Condition()
+
+        self.history_size = history_size
+        self.history = np.zeros(
+            history_size,
+            dtype=[("time", np.float64), ("busy", np.bool_, (nslots,)), ("detected", np.bool_, (nslots,))],
+        )
+        self.count = 0  # spectra recorded so far
+
+    def update(self, dfft: np.ndarray, elapsed: float, detect: bool = True) -> np.ndarray:
+        """
+        Update the slots with a new spectrum
+
+        Args:
+            dfft: spectrum in dB of the magnitude, see spectrum.SpectrumEngine
+            elapsed: seconds of audio since the previous spectrum
+            detect: False while we are transmitting, slots are only released then
+
+        Returns:
+            busy state of every slot
+        """
+        if detect:
+            above = dfft > np.mean(dfft) + THRESHOLD
+            detected = np.add.reduceat(above, self.edges[:-1], dtype=np.intp) >= MIN_BINS
+        else:
+            detected = np.zeros(self.nslots, dtype=np.bool_)
+        hold = np.where(
+            detected, np.minimum(self.hold + HOLD_RISE * elapsed, HOLD_MAX), np.maximum(self.hold - elapsed, 0.0)
+        )
+        busy = detected | (hold > HOLD_MIN)
+
+        with self.condition:
+            self.hold = hold
+            self.busy = busy
+            self.busy_bits = int(busy @ self.weights)
+            self.history[self.count % self.history_size] = (time.monotonic(), busy, detected)
+            self.count += 1
+            self.condition.notify_all()
+        return busy
+
+    def reset(self) -> None:
+        """Release all slots, while we are transmitting"""
+        with self.condition:
+            self.hold = np.zeros(self.nslots)
+            self.busy = np.zeros(self.nslots, dtype=np.bool_)
+            self.busy_bits = 0
+            self.condition.notify_all()
+
+    @property
+    def channel_busy(self) -> bool:
+        return self.busy_bits != 0
+
+    def is_free(self, slots) -> bool:
+        """True if none of `slots` is busy, a list like codec2.FREEDV_MODE_USED_SLOTS or a bit mask"""
+        bits = slots if isinstance(slots, int) else slot_bits(slots)
+        return not self.busy_bits & bits
+
+    def mode_is_free(self, mode_name: str) -> bool:
+        """True if the slots used by the codec2 mode `mode_name` are free"""
+        return not self.busy_bits & MODE_SLOT_BITS[mode_name]
+
+    def wait_free(self, slots, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until none of `slots` is busy
+
+        Returns:
+            False on timeout
+        """
+        bits = slots if isinstance(slots, int) else slot_bits(slots)
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.busy_bits & bits, timeout)
+
+    def last(self, nspectra: int) -> np.ndarray:
+        """Copy of the history of the latest `nspectra` spectra, oldest first"""
+        count = self.count
+        nspectra = min(nspectra, count, self.history_size)
+        return self.history[np.arange(count - nspectra, count) % self.history_size]
+
+    def occupancy(self, seconds: float) -> list:
+        """Share of the last `seconds` every slot has been busy"""
+        history = self.last(self.history_size)
+        history = history[history["time"] >= time.monotonic() - seconds]
+        if not len(history):
+            return [0.0] * self.nslots
+        return np.round(np.mean(history["busy"], axis=0), 3).tolist()
+
+
+# busy state of the channel, updated by RF.calculate_fft
+CHANNEL_OCCUPANCY = ChannelOccupancy()
@@ -3,6 +3,7 @@ Hold queues used by more than one module to eliminate cyclic imports.
 """
 import queue
 import static
+from transmit_scheduler import TransmitScheduler
 from static import ARQ, AudioParam, Beacon, Channel, Daemon, HamlibParam, ModemParam, Station, TCIParam, TNC
 
 DATA_QUEUE_TRANSMIT = queue.Queue()
@@ -10,7 +11,10 @@ DATA_QUEUE_RECEIVED = queue.Queue()
 
 # Initialize FIFO queue to store received frames
 MODEM_RECEIVED_QUEUE = queue.Queue()
-MODEM_TRANSMIT_QUEUE = queue.Queue()
+# Served by priority and deadline instead of FIFO
+MODEM_TRANSMIT_QUEUE = TransmitScheduler()
+# Likely transmit requests, modulated ahead of time
+MODEM_PRERENDER_QUEUE = queue.Queue()
 
 # Initialize FIFO queue to store received frames
 MESH_RECEIVED_QUEUE = queue.Queue()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decode recorded audio faster than real time.
+
+Feeds a 48 kHz or 8 kHz recording (WAV or raw int16) through codec2
+demodulators as fast as the CPU allows and reports every decoded frame
+and the real-time factor of every mode. Recordings made with
+AudioParam.audio_record can be replayed for regression testing.
+
+    python3 replay.py 1690000000_audio_recording.wav --modes datac13 datac3
+"""
+import argparse
+import sys
+import time
+
+import codec2
+import demodulator
+import numpy as np
+import structlog
+import ujson as json
+
+# decoders of RF, without the duplicate datac13 instance
+DEFAULT_MODES = ["datac13", "datac1", "datac3", "datac4"]
+
+# audio block passed to the demodulators, at 8 kHz
+BLOCK_SIZE = 800
+
+
+def load_recording(path: str, sample_rate: int = 0):
+    """
+    Memory-map a recording of int16 samples
+
+    Args:
+        path: WAV file or raw int16 samples
+        sample_rate: sample rate of a raw file, 8000 if not set. Ignored for WAV files
+
+    Returns:
+        samples as np.int16 array of the first channel, sample rate
+    """
+    with open(path, "rb") as file:
+        header = file.read(12)
+        if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return np.memmap(path, dtype=np.int16, mode="r"), sample_rate or 8000
+
+        channels = 1
+        while True:
+            chunk = file.read(8)
+            if len(chunk) < 8:
+                raise ValueError(f"{path}: no data chunk")
+            chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], "little")
+            if chunk_id == b"fmt ":
+                fmt = file.read(chunk_size)
+                audio_format = int.from_bytes(fmt[0:2], "little")
+                channels = int.from_bytes(fmt[2:4], "little")
+                sample_rate = int.from_bytes(fmt[4:8], "little")
+                bits = int.from_bytes(fmt[14:16], "little")
+                if audio_format != 1 or bits != 16:
+                    raise ValueError(f"{path}: only 16 bit PCM is supported")
+            elif chunk_id == b"data":
+                offset = file.tell()
+                break
+            else:
+                file.seek(chunk_size + chunk_size % 2, 1)
+
+    samples = np.memmap(path, dtype=np.int16, mode="r", offset=offset)
+    # a truncated recording may end with an incomplete frame
+    samples = samples[: min(chunk_size // 2, len(samples)) // channels * channels]
+    return samples.reshape(-1, channels)[:, 0], sample_rate
+
+
+def blocks_8k(samples, sample_rate: int):
+    """
+    Yield the recording in blocks of BLOCK_SIZE samples at 8 kHz
+
+    Args:
+        samples: np.int16 samples
+        sample_rate: 8000 or 48000
+    """
+    if sample_rate == 8000:
+        for start in range(0, len(samples), BLOCK_SIZE):
+            yield samples[start : start + BLOCK_SIZE]
+        return
+
+    if sample_rate != 48000:
+        raise ValueError(f"unsupported sample rate {sample_rate}, use 8000 or 48000")
+
+    block_48k = BLOCK_SIZE * codec2.api.FDMDV_OS_48  # type: ignore
+    resampler = codec2.resampler(block_48k)
+    out = np.zeros(BLOCK_SIZE, dtype=np.int16)
+    # the resampler needs a multiple of FDMDV_OS_48 samples
+    length = len(samples) - len(samples) % codec2.api.FDMDV_OS_48  # type: ignore
+    for start in range(0, length, block_48k):
+        block = np.ascontiguousarray(samples[start : min(start + block_48k, length)])
+        yield resampler.resample48_to_8(block, out=out[: len(block) // codec2.api.FDMDV_OS_48])  # type: ignore
+
+
+def decode_recording(samples, sample_rate: int, modes: list = None):
+    """
+    Demodulate a recording with one codec2 instance per mode, as fast as possible
+
+    Args:
+        samples: np.int16 samples, e.g. from load_recording
+        sample_rate: 8000 or 48000
+        modes: codec2 mode names, DEFAULT_MODES if not set
+
+    Returns:
+        list of decoded frames, as dicts with timestamp in seconds, mode, snr,
+        rx_status and data, and a dict of statistics by mode
+    """
+    modes = modes or DEFAULT_MODES
+    # every demodulator consumes a block before the next one is pushed, but may keep up to nin samples
+    store = codec2.shared_audio_buffer(8 * BLOCK_SIZE)
+    demodulators = []
+    for mode in modes:
+        demod = demodulator.Demodulator(
+            mode, codec2.FREEDV_MODE[mode].value, store.reader(history=store.size), []
+        )
+        demod.audiobuffer.active = True
+        demodulators.append(demod)
+
+    frames = []
+    nsamples = 0
+    start = time.perf_counter()
+    for block in blocks_8k(samples, sample_rate):
+        store.push(block)
+        nsamples += len(block)
+        for demod in demodulators:
+            cpu_start = time.thread_time()
+
+            def on_frame(frame, position, demod=demod):
+                demod.frames += 1
+                frames.append(
+                    {
+                        "timestamp": round(position / 8000, 3),
+                        "mode": demod.name,
+                        "snr": demod.telemetry.snr,
+                        "rx_status": codec2.api.freedv_get_rx_status(demod.freedv),
+                        "data": frame.hex(),
+                    }
+                )
+
+            demod.demod_calls += demod.demodulate(on_frame)
+            demod.cpu_time += time.thread_time() - cpu_start
+
+    duration = nsamples / 8000
+    stats = {
+        "duration": round(duration, 3),
+        "realtime_factor": round(duration / (time.perf_counter() - start), 1),
+    }
+    for demod in demodulators:
+        stats[demod.name] = {
+            "demod_calls": demod.demod_calls,
+            "frames": demod.frames,
+            "cpu_time": round(demod.cpu_time, 3),
+            "realtime_factor": round(duration / demod.cpu_time, 1) if demod.cpu_time else 0,
+            "startup_time": round(demod.startup_time * 1000, 2),
+            "telemetry": demod.telemetry.aggregates(),
+        }
+    return frames, stats
+
+
+def main(argv=None) -> int:
+    """Decode a recording from the command line, print one JSON line per frame and the statistics"""
+    parser = argparse.ArgumentParser(description="FreeDATA offline decoder")
+    parser.add_argument("recording", help="WAV file or raw int16 samples")
+    parser.add_argument(
+        "--samplerate",
+        dest="sample_rate",
+        type=int,
+        default=0,
+        help="Sample rate of a raw recording, 8000 or 48000. Default 8000",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=DEFAULT_MODES,
+        choices=list(codec2.FREEDV_MODE.__members__),
+        help="codec2 modes to decode",
+    )
+    args = parser.parse_args(argv)
+    # keep stdout for the decoded frames
+    structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+
+    samples, sample_rate = load_recording(args.recording, args.sample_rate)
+    frames, stats = decode_recording(samples, sample_rate, args.modes)
+    for frame in frames:
+        print(json.dumps(frame))
+    print(json.dumps({"stats": stats}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -25,6 +25,7 @@ import sys
 import threading
 import time
 import wave
+import demodulator
 import helpers
 import static
 from static import ARQ, AudioParam, Beacon, Channel, Daemon, HamlibParam, ModemParam, Station, Statistics, TCIParam, TNC, MeshParam
@@ -1146,6 +1147,10 @@ def send_tnc_state():
         "arq_session": str(ARQ.arq_session),
         "arq_session_state": str(ARQ.arq_session_state),
         "audio_dbfs": str(AudioParam.audio_dbfs),
+        "audio_input_overflows": str(AudioParam.audio_input_overflows),
+        "audio_output_underflows": str(AudioParam.audio_output_underflows),
+        "audio_callback_duration": str(round(AudioParam.audio_callback_duration, 3)),
+        "audio_callback_duration_max": str(round(AudioParam.audio_callback_duration_max, 3)),
         "snr": str(ModemParam.snr),
         "frequency": str(HamlibParam.hamlib_frequency),
         "rf_level": str(HamlibParam.hamlib_rf),
@@ -1157,10 +1162,17 @@ def send_tnc_state():
         "mode": str(HamlibParam.hamlib_mode),
         "bandwidth": str(HamlibParam.hamlib_bandwidth),
         "fft": str(AudioParam.fft),
+        "spectrum_stats": AudioParam.spectrum_stats,
         "channel_busy": str(ModemParam.channel_busy),
         "channel_busy_slot": str(ModemParam.channel_busy_slot),
+        "channel_occupancy": ModemParam.channel_occupancy,
         "is_codec2_traffic": str(ModemParam.is_codec2_traffic),
-        "scatter": ModemParam.scatter,
+        "scatter": demodulator.scatter_points(ModemParam.scatter),
+        "demodulator_stats": ModemParam.demodulator_stats,
+        "codec2_load_time": str(ModemParam.codec2_load_time),
+        "tx_coalesced_ptt_cycles": str(ModemParam.tx_coalesced_ptt_cycles),
+        "tx_coalesced_airtime": str(round(ModemParam.tx_coalesced_airtime, 3)),
+        "transmit_queue_stats": ModemParam.transmit_queue_stats,
         "rx_buffer_length": str(RX_BUFFER.qsize()),
         "rx_msg_buffer_length": str(len(ARQ.rx_msg_buffer)),
         "arq_bytes_per_minute": str(ARQ.bytes_per_minute),
@@ -1168,6 +1180,7 @@ def send_tnc_state():
         "arq_seconds_until_finish": str(ARQ.arq_seconds_until_finish),
         "arq_compression_factor": str(ARQ.arq_compression_factor),
         "arq_transmission_percent": str(ARQ.arq_transmission_percent),
+        "arq_ack_latency": str(ARQ.arq_ack_latency),
         "speed_list": ARQ.speed_list,
         "total_bytes": str(ARQ.total_bytes),
         "beacon_state": str(Beacon.beacon_state),
@@ -0,0 +1,165 @@
+"""
+Spectrum of the received and transmitted audio, for the waterfall and the busy detection.
+
+The audio threads push every block they handle, the FFT thread is woken by
+them and computes a spectrum once enough new samples have arrived, instead of
+polling the latest block. Spectra use a fixed power of two FFT size with a
+precomputed window, optionally averaged over overlapping segments (Welch), and
+are mapped to a fixed number of bins of BIN_WIDTH Hz for the GUI.
+"""
+import threading
+import time
+from typing import Optional
+
+import codec2
+import numpy as np
+
+FFT_SIZE = 1024  # 128 ms at 8 kHz, 7.8 Hz resolution
+# bins sent to the GUI, 0 Hz to 3150 Hz
+SPECTRUM_BINS = 315
+BIN_WIDTH = 10.0  # Hz
+# segments averaged for a spectrum, overlapping by OVERLAP, 1 disables the averaging
+WELCH_SEGMENTS = 1
+OVERLAP = 0.5
+# seconds of audio between spectra, and while no client is subscribed to them
+UPDATE_INTERVAL = 0.1
+REDUCED_INTERVAL = 0.5
+# spectra are scaled like the rfft of a block of this length without a window,
+# which the waterfall and the busy detection thresholds have been tuned for
+REFERENCE_LENGTH = 800
+
+
+class SpectrumEngine:
+    """
+    Event driven spectrum of an audio stream
+
+    push() may be called from several audio threads, update() is called by a
+    single consumer after wait() returned.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 8000,
+        fft_size: int = FFT_SIZE,
+        nbins: int = SPECTRUM_BINS,
+        bin_width: float = BIN_WIDTH,
+        segments: int = WELCH_SEGMENTS,
+        overlap: float = OVERLAP,
+    ) -> None:
+        assert fft_size & (fft_size - 1) == 0, "FFT size must be a power of two"
+        assert nbins * bin_width <= sample_rate / 2
+        self.sample_rate = sample_rate
+        self.fft_size = fft_size
+        self.nbins = nbins
+        self.segments = segments
+        self.hop = int(fft_size * (1 - overlap))
+        # samples needed for a spectrum
+        self.length = fft_size + (segments - 1) * self.hop
+        self.window = np.hanning(fft_size).astype(np.float32)
+        # power scale, so noise has the same level as without window at REFERENCE_LENGTH
+        self.scale = np.float32(REFERENCE_LENGTH / np.sum(self.window.astype(np.float64) ** 2))
+
+        # linear interpolation of the FFT bins at the frequencies of the output bins
+        position = np.arange(nbins) * bin_width * fft_size / sample_rate
+        self.bin_index = np.minimum(position.astype(np.intp), fft_size // 2 - 1)
+        self.bin_fraction = (position - self.bin_index).astype(np.float32)
+
+        self.store = codec2.shared_audio_buffer(max(self.length, sample_rate))
+        self.reader = self.store.reader(history=self.length)
+        self.reader.active = True
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+        # compute spectra every REDUCED_INTERVAL instead of UPDATE_INTERVAL
+        self.reduced = False
+        # seconds of audio covered by the latest spectrum and peak amplitude of its new samples
+        self.elapsed = 0.0
+        self.peak = 0
+        # cost of the spectra
+        self.spectra = 0
+        self.cpu_time = 0.0
+        self.audio_time = 0.0
+
+    @property
+    def interval(self) -> int:
+        """New samples needed for the next spectrum"""
+        seconds = REDUCED_INTERVAL if self.reduced else UPDATE_INTERVAL
+        return int(seconds * self.sample_rate)
+
+    def push(self, samples: np.ndarray) -> None:
+        """Add received or transmitted audio, wakes the consumer once enough samples are waiting"""
+        with self.lock:
+            for start in range(0, len(samples), self.store.size):
+                self.store.push(samples[start : start + self.store.size])
+        if self.reader.ready(self.length + self.interval):
+            self.event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for new audio, returns False on timeout"""
+        if not self.event.wait(timeout):
+            return False
+        self.event.clear()
+        return True
+
+    def update(self) -> Optional[np.ndarray]:
+        """
+        Spectrum of the latest audio, if enough samples arrived since the last one
+
+        Returns:
+            nbins dB values as float32 or None
+        """
+        reader = self.reader
+        # the reader keeps `length` samples of history, the rest is new audio
+        nnew = reader.nbuffer - self.length
+        if nnew < self.interval:
+            return None
+
+        cpu_start = time.thread_time()
+        nsamples = reader.nbuffer
+        samples = reader.buffer[:nsamples]
+        self.peak = int(np.max(np.abs(samples[-nnew:].astype(np.int32))))
+        spectrum = self.compute(samples[-self.length :])
+        reader.pop(nsamples - self.length)
+
+        self.elapsed = nnew / self.sample_rate
+        self.spectra += 1
+        self.audio_time += self.elapsed
+        self.cpu_time += time.thread_time() - cpu_start
+        return spectrum
+
+    def compute(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Spectrum of `length` samples
+
+        Values are 10*log10 of the magnitude, like the GUI expects them.
+        """
+        # overlapping views into the samples, sliding_window_view would need numpy 1.20
+        stride = samples.strides[0]
+        segments = np.lib.stride_tricks.as_strided(
+            samples,
+            shape=(self.segments, self.fft_size),
+            strides=(self.hop * stride, stride),
+            writeable=False,
+        )
+        segments = segments.astype(np.float32) * self.window
+        fft = np.fft.rfft(segments, axis=1)
+        power = fft.real.astype(np.float32) ** 2 + fft.imag.astype(np.float32) ** 2
+        power = np.mean(power, axis=0) if self.segments > 1 else power[0]
+
+        lower = power[self.bin_index]
+        bins = lower + (power[self.bin_index + 1] - lower) * self.bin_fraction
+        # 5*log10 of the power is 10*log10 of the magnitude
+        return 5.0 * np.log10(np.maximum(bins * self.scale, np.float32(1.0)))
+
+    @property
+    def cpu_load(self) -> float:
+        """CPU seconds spent per second of audio"""
+        return self.cpu_time / self.audio_time if self.audio_time else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "spectra": self.spectra,
+            "reduced": self.reduced,
+            "cpu_time": round(self.cpu_time, 3),
+            "cpu_load": round(self.cpu_load, 5),
+        }
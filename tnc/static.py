@@ -42,6 +42,7 @@ class ARQ:
     arq_save_to_folder: bool = False
     bytes_per_minute_burst: int = 0
     rx_msg_buffer = []
+    arq_ack_latency: int = 0  # ms from the last received data frame to keying up for its acknowledge
 
 
 @dataclass
@@ -53,11 +54,16 @@ class AudioParam:
     audio_output_device: int = -2
     audio_record: bool = False
     audio_record_file = ''
-    buffer_overflow_counter = [0, 0, 0, 0, 0]
+    buffer_overflow_counter = [0, 0, 0, 0, 0, 0, 0]
+    audio_input_overflows: int = 0  # blocks lost by the audio device or the DSP thread
+    audio_output_underflows: int = 0  # reported by the audio device
+    audio_callback_duration: float = 0  # ms
+    audio_callback_duration_max: float = 0  # ms
     audio_auto_tune: bool = False
     audio_dbfs: int = 0
     fft = []
     enable_fft: bool = True
+    spectrum_stats = {}  # number and cpu time of the spectra of calculate_fft
 
 
 @dataclass
@@ -100,12 +106,20 @@ class ModemParam:
     tuning_range_fmax: float = 50.0
     channel_busy: bool = False
     channel_busy_slot = [False] * 5
+    channel_occupancy = [0.0] * 5  # share of the last minute every slot has been busy
     snr: float = 0
     is_codec2_traffic: bool = False  # true if we have codec2 signalling mode traffic on channel
     frequency_offset: float = 0
     tx_delay: int = 0  # delay in ms before sending modulation for triggering VOX for example or slow PTT radios
     enable_scatter: bool = False
     scatter = []
+    demodulator_stats = {}  # per mode latency and cpu time of the demodulators
+    enable_demod_processes: bool = False  # run every codec2 demodulator in its own process
+    decoder_grace_period: float = 60.0  # seconds until an unused rx codec2 instance gets closed
+    codec2_load_time: float = 0  # ms spent finding and loading libcodec2
+    tx_coalesced_ptt_cycles: int = 0  # PTT cycles saved by sending queued requests in one burst
+    tx_coalesced_airtime: float = 0.0  # seconds of tx delay and repeat delay saved that way
+    transmit_queue_stats = {}  # per priority class sent and dropped requests and their queue wait
 
 @dataclass
 class Station:
@@ -0,0 +1,136 @@
+"""
+Continuous modem telemetry of the codec2 decoders.
+
+Every demodulator records a compact sample of its modem state after each
+freedv_rawdatarx call into a fixed-size numpy ring buffer. Rolling aggregates
+of the ring (SNR, sync ratio, decode success rate) are published with the
+demodulator statistics and used by the ARQ speed level selection, so every mode
+is judged by its own measurements instead of the SNR of the last decoded frame.
+"""
+import time
+
+import codec2
+import numpy as np
+
+# samples kept per decoder, about 40 s of audio with the 1200 samples nin of most modes
+TELEMETRY_SIZE = 256
+# weight of the SNR of a new frame for the average SNR
+SNR_AVG_WEIGHT = 0.25
+
+TELEMETRY_DTYPE = np.dtype(
+    [
+        ("time", np.float64),  # time.monotonic() of the sample
+        ("rx_status", np.uint8),  # freedv_get_rx_status
+        ("sync", np.bool_),
+        ("snr", np.float32),  # dB, only updated by codec2 if a frame has been decoded
+        ("foff", np.float32),  # Hz
+        ("rx_timing", np.float32),
+        ("clock_offset", np.float32),
+    ]
+)
+
+
+class DecoderTelemetry:
+    """
+    Ring buffer of the modem state samples of a single decoder
+
+    Samples are written by the thread or process demodulating the mode and
+    read by everybody else, so readers only ever get copies of the ring.
+    """
+
+    def __init__(self, size: int = TELEMETRY_SIZE) -> None:
+        self.size = size
+        self.samples = np.zeros(size, dtype=TELEMETRY_DTYPE)
+        self.count = 0  # samples recorded so far
+        self.sent = 0  # samples handed out by pending()
+        # SNR of the latest frame and the average of the frames decoded without errors,
+        # None until a frame is decoded
+        self.snr = None
+        self.snr_avg = None
+
+    def record(self, rx_status: int, stats: codec2.modem_stats) -> None:
+        """
+        Record the modem state after a freedv_rawdatarx call
+
+        :param rx_status: rx status returned by freedv_get_rx_status
+        :type rx_status: int
+        :param stats: modem stats of the same call
+        :type stats: codec2.modem_stats
+        """
+        stats = stats.stats
+        self.append(
+            (
+                time.monotonic(),
+                rx_status,
+                stats.sync,
+                stats.snr_est,
+                stats.foff,
+                stats.rx_timing,
+                stats.clock_offset,
+            )
+        )
+
+    def append(self, sample: tuple) -> None:
+        """Add a sample with the fields of TELEMETRY_DTYPE"""
+        self.samples[self.count % self.size] = sample
+        self.count += 1
+        rx_status = sample[1]
+        if not rx_status & codec2.api.FREEDV_RX_BITS:
+            return
+        self.snr = snr = round(float(sample[3]), 1)
+        if not rx_status & codec2.api.FREEDV_RX_BIT_ERRORS:
+            if self.snr_avg is None:
+                self.snr_avg = snr
+            else:
+                self.snr_avg += SNR_AVG_WEIGHT * (snr - self.snr_avg)
+
+    def extend(self, samples: np.ndarray) -> None:
+        """Add samples recorded by another process, see pending()"""
+        for sample in samples.tolist():
+            self.append(sample)
+
+    def last(self, nsamples: int) -> np.ndarray:
+        """Copy of the latest `nsamples` samples, oldest first"""
+        count = self.count
+        nsamples = min(nsamples, count, self.size)
+        return self.samples[np.arange(count - nsamples, count) % self.size]
+
+    def window(self) -> np.ndarray:
+        """Copy of all samples in the ring, oldest first"""
+        return self.last(self.size)
+
+    def pending(self) -> np.ndarray:
+        """Samples recorded since the last call, for sending them to the TNC process"""
+        count = self.count
+        samples = self.last(count - self.sent)
+        self.sent = count
+        return samples
+
+    def average_snr(self, default: float) -> float:
+        """Average SNR of the decoded frames, `default` if nothing has been decoded yet"""
+        if self.snr_avg is None:
+            return default
+        return round(self.snr_avg, 1)
+
+    def aggregates(self) -> dict:
+        """Rolling aggregates over the samples in the ring"""
+        window = self.window()
+        if not len(window):
+            return {"samples": 0}
+
+        rx_status = window["rx_status"]
+        errors = (rx_status & codec2.api.FREEDV_RX_BIT_ERRORS) != 0
+        failed = np.count_nonzero(errors)
+        decoded = np.count_nonzero(((rx_status & codec2.api.FREEDV_RX_BITS) != 0) & ~errors)
+        synced = window[window["sync"]]
+        return {
+            "samples": len(window),
+            "snr": self.snr,
+            "snr_avg": None if self.snr_avg is None else round(self.snr_avg, 1),
+            "sync_ratio": round(len(synced) / len(window), 3),
+            "decoded": decoded,
+            "failed": failed,
+            "decode_rate": round(decoded / (decoded + failed), 3) if decoded + failed else None,
+            "foff": round(float(synced["foff"][-1]), 1) if len(synced) else None,
+            "clock_offset": round(float(synced["clock_offset"][-1]), 6) if len(synced) else None,
+        }
@@ -0,0 +1,316 @@
+"""
+Priority and deadline aware scheduling of transmit requests.
+
+MODEM_TRANSMIT_QUEUE used to be a plain FIFO, so a pending mesh routing table
+broadcast or beacon could delay a burst ACK past the timeout of the peer.
+TransmitScheduler keeps the [mode, copies, repeat_delay, frames] items of the
+FIFO, but hands them to the transmit worker by priority class, which is derived
+from the type of the first frame. Items of the same class keep their order.
+
+Items can have a deadline. Items still waiting when it has passed are not
+transmitted anymore, but handed to `on_drop`, so their sender can be notified.
+
+get_burst() coalesces signalling requests with the same mode, copies and
+repeat delay which are pending at the same moment, so they share one PTT cycle
+and tx delay instead of paying their own.
+"""
+import heapq
+import itertools
+import queue
+import threading
+import time
+from enum import IntEnum
+
+from static import FRAME_TYPE
+
+
+class TX_PRIORITY(IntEnum):
+    """Priority classes of transmit requests, lower values are sent first"""
+
+    ACK_NACK = 0
+    ARQ_DATA = 1
+    SESSION = 2
+    FEC = 3
+    MESH = 4
+    BEACON = 5
+
+
+_ACK_NACK_FRAMES = {
+    FRAME_TYPE.BURST_ACK.value,
+    FRAME_TYPE.FR_ACK.value,
+    FRAME_TYPE.FR_REPEAT.value,
+    FRAME_TYPE.FR_NACK.value,
+    FRAME_TYPE.BURST_NACK.value,
+}
+_FEC_FRAMES = {FRAME_TYPE.FEC.value, FRAME_TYPE.FEC_WAKEUP.value}
+_MESH_FRAMES = {
+    FRAME_TYPE.MESH_BROADCAST.value,
+    FRAME_TYPE.MESH_SIGNALLING_PING.value,
+    FRAME_TYPE.MESH_SIGNALLING_PING_ACK.value,
+}
+
+# seconds a request may wait before it is dropped.
+# An ACK / NACK is useless once the peer's burst_ack_timeout_seconds has passed,
+# beacons and routing tables are sent again anyway.
+DEFAULT_TIMEOUTS = {
+    TX_PRIORITY.ACK_NACK: 4.5,
+    TX_PRIORITY.ARQ_DATA: float("inf"),
+    TX_PRIORITY.SESSION: float("inf"),
+    TX_PRIORITY.FEC: float("inf"),
+    TX_PRIORITY.MESH: 30.0,
+    TX_PRIORITY.BEACON: 30.0,
+}
+
+
+# Classes which can share a burst with other requests, and seconds a request of the class
+# may be held back for more requests to arrive. Other classes are sent on their own.
+# Only mesh signalling comes in bursts of requests, a beacon is sent right away
+# and just picks up what is pending.
+COALESCE_HOLD_TIMES = {
+    TX_PRIORITY.ACK_NACK: 0.0,
+    TX_PRIORITY.SESSION: 0.0,
+    TX_PRIORITY.MESH: 0.5,
+    TX_PRIORITY.BEACON: 0.0,
+}
+
+# most frames of a coalesced burst
+COALESCE_MAX_FRAMES = 4
+
+
+def get_priority(mode, frames) -> TX_PRIORITY:
+    """
+    Priority class of a transmit request
+
+    Args:
+      mode: codec2 mode or "morse"
+      frames: list of frames, the first byte of a frame is its FRAME_TYPE
+
+    Returns:
+        TX_PRIORITY
+    """
+    if mode == "morse":
+        # used for identification, like a beacon
+        return TX_PRIORITY.BEACON
+    try:
+        frametype = int(frames[0][0])
+    except (IndexError, TypeError, ValueError):
+        return TX_PRIORITY.SESSION
+
+    if frametype in _ACK_NACK_FRAMES:
+        return TX_PRIORITY.ACK_NACK
+    if FRAME_TYPE.BURST_01.value <= frametype <= FRAME_TYPE.BURST_51.value:
+        return TX_PRIORITY.ARQ_DATA
+    if frametype in _FEC_FRAMES:
+        return TX_PRIORITY.FEC
+    if frametype in _MESH_FRAMES:
+        return TX_PRIORITY.MESH
+    if frametype == FRAME_TYPE.BEACON.value:
+        return TX_PRIORITY.BEACON
+    return TX_PRIORITY.SESSION
+
+
+class TransmitScheduler:
+    """
+    Drop-in replacement of the queue.Queue of transmit requests
+
+    put() takes the same items as before, get() returns the item with the
+    highest priority, the oldest first within a class.
+    """
+
+    def __init__(self, on_drop=None) -> None:
+        # called with every item dropped because of its deadline, outside of the lock
+        self.on_drop = on_drop
+        self._heap = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._statistics = {
+            priority: {"sent": 0, "dropped": 0, "coalesced": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in TX_PRIORITY
+        }
+
+    def put(self, item, priority=None, timeout=None) -> None:
+        """
+        Queue a transmit request
+
+        Args:
+          item: [mode, copies, repeat_delay, frames, ...]
+          priority: TX_PRIORITY, derived from the first frame if None
+          timeout: seconds until the request is dropped, DEFAULT_TIMEOUTS of the
+            priority class if None
+        """
+        if priority is None:
+            priority = get_priority(item[0], item[3])
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUTS[priority]
+        queued = time.time()
+
+        with self._not_empty:
+            heapq.heappush(
+                self._heap, (priority, next(self._sequence), queued, queued + timeout, item)
+            )
+            self._not_empty.notify()
+
+    def get(self, block: bool = True, timeout=None):
+        """
+        Remove and return the next transmit request
+
+        Requests which have passed their deadline are dropped on the way.
+
+        Args:
+          block: wait for a request if the queue is empty
+          timeout: seconds to wait, forever if None
+
+        Returns:
+            item as passed to put()
+
+        Raises:
+            queue.Empty: no request within timeout or not blocking
+        """
+        priority, _, queued, _, item = self._get(block, timeout)
+        with self._lock:
+            self._record_sent(priority, time.time() - queued)
+        return item
+
+    def get_burst(self, block: bool = True, timeout=None) -> list:
+        """
+        Remove and return the next transmit request together with compatible ones
+
+        Like get(), but pending requests of coalescing classes with the same mode,
+        copies and repeat delay as the next request and no higher priority are
+        removed as well, up to COALESCE_MAX_FRAMES frames. The next request is held
+        back for more requests until the hold time of its class has passed since it
+        was queued. A request of a higher priority arriving meanwhile ends the hold,
+        the held requests are put back and the new one is returned instead.
+
+        Args:
+          block: wait for a request if the queue is empty
+          timeout: seconds to wait, forever if None
+
+        Returns:
+            list of items, the next request first
+
+        Raises:
+            queue.Empty: no request within timeout or not blocking
+        """
+        while True:
+            entries = self._hold_burst(self._get(block, timeout))
+            if entries:
+                break
+
+        now = time.time()
+        with self._lock:
+            for index, (priority, _, queued, _, _) in enumerate(entries):
+                self._record_sent(priority, now - queued)
+                if index:
+                    self._statistics[priority]["coalesced"] += 1
+        return [entry[-1] for entry in entries]
+
+    def _hold_burst(self, entry) -> list:
+        """
+        Coalesce pending requests with the heap entry `entry`, see get_burst()
+
+        Returns:
+            heap entries of the burst, empty if a request of a higher priority
+            ended the hold and all of them have been put back
+        """
+        priority, _, queued, _, item = entry
+        if priority not in COALESCE_HOLD_TIMES or item[0] == "morse":
+            return [entry]
+
+        entries = [entry]
+        nframes = len(item[3])
+        hold_until = queued + COALESCE_HOLD_TIMES[priority]
+        with self._not_empty:
+            while True:
+                if self._heap and self._heap[0][0] < priority:
+                    # e.g. an ACK queued while we were holding a mesh broadcast
+                    for held in entries:
+                        heapq.heappush(self._heap, held)
+                    return []
+
+                for other_entry in sorted(self._heap):
+                    if nframes >= COALESCE_MAX_FRAMES:
+                        break
+                    other_priority, _, _, deadline, other = other_entry
+                    if (
+                        other_priority not in COALESCE_HOLD_TIMES
+                        or other_priority < priority
+                        or other[:3] != item[:3]
+                        or nframes + len(other[3]) > COALESCE_MAX_FRAMES
+                        # left for get() to drop
+                        or time.time() > deadline
+                    ):
+                        continue
+                    self._heap.remove(other_entry)
+                    entries.append(other_entry)
+                    nframes += len(other[3])
+                heapq.heapify(self._heap)
+
+                remaining = hold_until - time.time()
+                if remaining <= 0 or nframes >= COALESCE_MAX_FRAMES:
+                    return entries
+                self._not_empty.wait(remaining)
+
+    def _record_sent(self, priority, wait: float) -> None:
+        statistics = self._statistics[priority]
+        statistics["sent"] += 1
+        statistics["wait_total"] += wait
+        statistics["wait_max"] = max(statistics["wait_max"], wait)
+
+    def _get(self, block: bool, timeout):
+        """get(), returning the whole heap entry without recording it as sent"""
+        endtime = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._not_empty:
+                while not self._heap:
+                    if not block:
+                        raise queue.Empty
+                    if endtime is None:
+                        self._not_empty.wait()
+                    else:
+                        remaining = endtime - time.monotonic()
+                        if remaining <= 0:
+                            raise queue.Empty
+                        self._not_empty.wait(remaining)
+
+                entry = heapq.heappop(self._heap)
+                priority, _, _, deadline, item = entry
+                if time.time() <= deadline:
+                    return entry
+                self._statistics[priority]["dropped"] += 1
+
+            if self.on_drop is not None:
+                self.on_drop(item)
+
+    def task_done(self) -> None:
+        """Kept for compatibility with queue.Queue, requests aren't joined"""
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._heap)
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def get_statistics(self) -> dict:
+        """
+        Queue wait time per priority class of the sent requests
+
+        Returns:
+            {class name: {"sent", "dropped", "coalesced", "wait_avg", "wait_max"}},
+            times in seconds. Coalesced requests are sent with an earlier one.
+        """
+        with self._lock:
+            return {
+                priority.name: {
+                    "sent": statistics["sent"],
+                    "dropped": statistics["dropped"],
+                    "coalesced": statistics["coalesced"],
+                    "wait_avg": statistics["wait_total"] / statistics["sent"]
+                    if statistics["sent"]
+                    else 0.0,
+                    "wait_max": statistics["wait_max"],
+                }
+                for priority, statistics in self._statistics.items()
+            }